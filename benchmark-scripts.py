@@ -0,0 +1,582 @@
+#! /usr/bin/env python3
+
+
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Run the scripts against a local stand-in GitLab server, and measure them.
+
+Each benchmark seeds a `dbnomics_gitlab_ci.mock_gitlab` server, runs scripts against
+it, and records the number of API calls and the wall time. The `startup` benchmark
+runs `dbnomics-ci` commands that make no API call, and records the number of modules
+they import at start. Benchmarks fail when a run makes more API calls or imports more
+modules than recorded in the baseline file: update it with --update-baseline after
+an intended change. Wall times are only displayed, as they depend on the machine.
+
+No network access is needed, nor a PRIVATE_TOKEN.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from dbnomics_gitlab_ci import cli, client, dispatcher
+from dbnomics_gitlab_ci.mock_gitlab import MockGitLab, MockGitLabServer, seed_fleet
+
+script_dir = Path(__file__).resolve().parent
+default_baseline_path = script_dir / "benchmark-baseline.json"
+
+BENCHMARKS = {}
+
+# Counters of a run compared to the baseline; a run may not have all of them.
+COUNTERS = ("api_calls", "modules")
+
+
+def benchmark(func):
+    """Register a benchmark, called with a `Bench` and returning nothing."""
+    BENCHMARKS[func.__name__.replace("_", "-")] = func
+    return func
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "names",
+        metavar="name",
+        nargs="*",
+        help="benchmarks to run, among {} (default: all)".format(
+            ", ".join(sorted(BENCHMARKS))
+        ),
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=default_baseline_path,
+        help="JSON file storing the expected counters of each run",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="store the counters of the runs in the baseline file",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.01,
+        help="seconds the server waits before answering each request",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="display the output of the scripts",
+    )
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark {!r}".format(name))
+
+    baseline = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+
+    results = {}
+    for name in args.names or sorted(BENCHMARKS):
+        bench = Bench(latency=args.latency, verbose=args.verbose)
+        try:
+            BENCHMARKS[name](bench)
+        finally:
+            bench.close()
+        for run_name, run in bench.runs.items():
+            results["{}/{}".format(name, run_name)] = run
+
+    print(format_results(results, baseline))
+
+    if args.update_baseline:
+        baseline.update(
+            {
+                name: {key: run[key] for key in COUNTERS if key in run}
+                for name, run in results.items()
+            }
+        )
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print("Baseline written to {}".format(args.baseline))
+        return 0
+
+    failed = [name for name, run in results.items() if not run["ok"]]
+    regressions = [
+        name for name, run in results.items() if is_regression(run, baseline.get(name))
+    ]
+    if failed:
+        print("Failed runs: {}".format(", ".join(failed)))
+    if regressions:
+        print("Regressions: {}".format(", ".join(regressions)))
+    return 1 if failed or regressions else 0
+
+
+class Bench:
+    """A stand-in GitLab server, with a way to run the scripts against it."""
+
+    def __init__(self, latency=0.0, verbose=False):
+        self.gitlab = MockGitLab()
+        self.latency = latency
+        self.server = MockGitLabServer(self.gitlab, latency=latency).start()
+        self.verbose = verbose
+        # Isolate the project index and other local stores of the scripts.
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="dbnomics-gitlab-ci-bench")
+        self.runs = {}
+
+    def close(self):
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def limit_rate(self, rate_limit):
+        """Serve the same state on a server answering 429 above `rate_limit` req/s."""
+        self.server.stop()
+        self.server = MockGitLabServer(
+            self.gitlab, latency=self.latency, rate_limit=rate_limit
+        ).start()
+
+    def run(self, name, script, *script_args, expected_returncode=0, env=None):
+        """Run a script with `--gitlab-url` pointing to the server, and record it."""
+        env = dict(
+            os.environ,
+            PRIVATE_TOKEN="benchmark",
+            GITLAB_URL=self.server.url,
+            XDG_CACHE_HOME=self.tmpdir.name,
+            XDG_DATA_HOME=self.tmpdir.name,
+            **(env or {})
+        )
+        with self.gitlab.lock:
+            self.gitlab.request_counts.clear()
+        start = time.monotonic()
+        completed = subprocess.run(
+            [sys.executable, str(script_dir / script), "--gitlab-url", self.server.url]
+            + list(script_args),
+            env=env,
+            cwd=str(script_dir),
+            stdout=None if self.verbose else subprocess.DEVNULL,
+            stderr=None if self.verbose else subprocess.DEVNULL,
+        )
+        duration = time.monotonic() - start
+        with self.gitlab.lock:
+            api_calls = sum(self.gitlab.request_counts.values())
+        self.runs[name] = {
+            "api_calls": api_calls,
+            "duration": duration,
+            "ok": completed.returncode == expected_returncode,
+        }
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        """Record the API calls made by the code of the block, as a run."""
+        with self.gitlab.lock:
+            self.gitlab.request_counts.clear()
+        start = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            duration = time.monotonic() - start
+            with self.gitlab.lock:
+                api_calls = sum(self.gitlab.request_counts.values())
+            self.runs[name] = {"api_calls": api_calls, "duration": duration, "ok": ok}
+
+    def run_startup(self, name, *cli_args):
+        """Run `dbnomics-ci` in a new interpreter, and record the modules it imports.
+
+        Modules are counted from the `-X importtime` report; the run must not need
+        the server.
+        """
+        start = time.monotonic()
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-m", "dbnomics_gitlab_ci"]
+            + list(cli_args),
+            cwd=str(script_dir),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        duration = time.monotonic() - start
+        report = [
+            line
+            for line in completed.stderr.splitlines()
+            if line.startswith("import time:") and not line.endswith("package")
+        ]
+        if self.verbose:
+            print(completed.stderr, file=sys.stderr)
+        self.runs[name] = {
+            "modules": len(report),
+            "duration": duration,
+            "ok": completed.returncode == 0,
+        }
+
+
+def is_regression(run, expected):
+    """Tell whether a run has a counter greater than in its `expected` baseline."""
+    return expected is not None and any(
+        key in run and key in expected and run[key] > expected[key] for key in COUNTERS
+    )
+
+
+def is_improvement(run, expected):
+    return expected is not None and any(
+        key in run and key in expected and run[key] < expected[key] for key in COUNTERS
+    )
+
+
+def format_results(results, baseline):
+    row_format = "{:<45} {:>9} {:>9} {:>8} {:>9} {:>8}  {}"
+    lines = [
+        row_format.format(
+            "benchmark/run",
+            "API calls",
+            "baseline",
+            "modules",
+            "baseline",
+            "time",
+            "status",
+        )
+    ]
+    for name, run in results.items():
+        expected = baseline.get(name)
+        if not run["ok"]:
+            status = "FAILED"
+        elif is_regression(run, expected):
+            status = "REGRESSION"
+        elif is_improvement(run, expected):
+            status = "improved"
+        else:
+            status = "ok"
+        counters = []
+        for key in COUNTERS:
+            counters += [run.get(key, ""), (expected or {}).get(key, "")]
+        lines.append(
+            row_format.format(
+                name, *counters, "{:.2f}s".format(run["duration"]), status
+            )
+        )
+    return "\n".join(lines)
+
+
+@benchmark
+def startup(bench):
+    bench.run_startup("usage", "--help")
+    for name in cli.COMMANDS:
+        bench.run_startup(name, name, "--help")
+
+
+@benchmark
+def dispatch_hooks(bench):
+    slugs = provider_slugs(10)
+    seed_fleet(bench.gitlab, slugs)
+    bench.gitlab.finish_pipelines_after = 2
+    json_data_paths = ["dbnomics-json-data/{}-json-data".format(slug) for slug in slugs]
+    bench.run("configure", "configure-ci-for-provider.py", "--all")
+    # A burst of 5 pushes to each JSON data repo, calling the trigger API directly.
+    with bench.measure("direct-burst"):
+        for _ in range(5):
+            for path in json_data_paths:
+                bench.gitlab.push(path)
+
+    gl = client.make_gitlab(bench.server.url, private_token="benchmark")
+    service = dispatcher.Dispatcher(gl, window=0.5, poll_interval=0.1)
+    with dispatcher.DispatcherServer(
+        service, tick=0.05, secret_token="benchmark-secret"
+    ) as server:
+        bench.run(
+            "configure-dispatcher",
+            "configure-ci-for-provider.py",
+            "--all",
+            "--dispatcher-url",
+            server.url,
+            "--dispatcher-token",
+            "benchmark-secret",
+        )
+        statuses = set()
+        with bench.measure("dispatched-burst"):
+            for _ in range(5):
+                for path in json_data_paths:
+                    statuses.update(bench.gitlab.push(path))
+            while service.status()["pending"]:
+                time.sleep(0.05)
+        # The hooks send the secret token, which other requests lack.
+        bench.runs["dispatched-burst"]["ok"] &= statuses == {202} and (
+            post_status(server.url + "/projects/42/ref/master/trigger/pipeline?token=t")
+            == 401
+        )
+
+
+def post_status(url):
+    try:
+        with urllib.request.urlopen(
+            urllib.request.Request(url, method="POST")
+        ) as response:
+            return response.status
+    except urllib.error.HTTPError as exc:
+        return exc.code
+
+
+def provider_slugs(count):
+    return ["provider{:02d}".format(index) for index in range(count)]
+
+
+@benchmark
+def configure_fleet(bench):
+    seed_fleet(bench.gitlab, provider_slugs(10))
+    options = ["--all", "--key-type", "ed25519"]
+    bench.run("new", "configure-ci-for-provider.py", *options)
+    bench.run("resume", "configure-ci-for-provider.py", "--resume", *options)
+    # The journal was written with other options: refused.
+    bench.run(
+        "resume-other-options",
+        "configure-ci-for-provider.py",
+        "--resume",
+        "--purge",
+        *options,
+        expected_returncode=1
+    )
+    bench.run("unchanged", "configure-ci-for-provider.py", *options)
+    bench.run("plan", "configure-ci-for-provider.py", "--plan", *options)
+
+
+@benchmark
+def stagger_schedules(bench):
+    seed_fleet(bench.gitlab, provider_slugs(10))
+    options = ["--all", "--key-type", "ed25519"]
+    bench.run("configure", "configure-ci-for-provider.py", *options)
+    bench.run(
+        "stagger", "configure-ci-for-provider.py", "--stagger", "0:00-6:00", *options
+    )
+    staggered = schedule_crons(bench.gitlab)
+    # Without --stagger nor --schedule-time, the staggered times are kept.
+    bench.run("unchanged", "configure-ci-for-provider.py", *options)
+    bench.runs["unchanged"]["ok"] &= schedule_crons(bench.gitlab) == staggered
+
+
+def schedule_crons(gitlab):
+    with gitlab.lock:
+        return {
+            (project_id, schedule["id"]): schedule["cron"]
+            for project_id, schedules in gitlab.schedules.items()
+            for schedule in schedules
+        }
+
+
+@benchmark
+def rate_limit(bench):
+    seed_fleet(bench.gitlab, provider_slugs(10))
+    options = ["--all", "--key-type", "ed25519"]
+    bench.run("configure", "configure-ci-for-provider.py", *options)
+    # 429 answers are counted as API calls.
+    bench.limit_rate(100)
+    bench.run(
+        "ungoverned",
+        "configure-ci-for-provider.py",
+        *options,
+        env={"GITLAB_MAX_CONCURRENCY": "0"}
+    )
+    bench.run("governed", "configure-ci-for-provider.py", *options)
+
+
+@benchmark
+def audit_fleet(bench):
+    seed_fleet(bench.gitlab, provider_slugs(30))
+    bench.run(
+        "configure", "configure-ci-for-provider.py", "--all", "--key-type", "ed25519"
+    )
+    bench.run("audit", "configure-ci-for-provider.py", "--all", "--audit")
+
+
+@benchmark
+def configure_dev_data(bench):
+    seed_fleet(bench.gitlab, provider_slugs(10))
+    bench.run(
+        "configure", "configure-ci-for-provider.py", "--all", "--key-type", "ed25519"
+    )
+    bench.run("new", "configure-ci-for-dev-data.py", "--all")
+    bench.run("unchanged", "configure-ci-for-dev-data.py", "--all")
+
+
+@benchmark
+def gc_deploy_keys(bench):
+    seed_fleet(bench.gitlab, provider_slugs(10))
+    bench.run(
+        "configure", "configure-ci-for-provider.py", "--all", "--key-type", "ed25519"
+    )
+    bench.run("unchanged", "gc-deploy-keys.py")
+
+
+@benchmark
+def configure_provider(bench):
+    seed_fleet(bench.gitlab, provider_slugs(1))
+    options = ["--key-type", "ed25519", "provider00"]
+    bench.run("new", "configure-ci-for-provider.py", *options)
+    bench.run("unchanged", "configure-ci-for-provider.py", *options)
+
+
+@benchmark
+def long_listings(bench):
+    seed_fleet(bench.gitlab, provider_slugs(1))
+    options = ["--key-type", "ed25519", "provider00"]
+    bench.run("configure", "configure-ci-for-provider.py", *options)
+    # Stale hooks filling several pages of 20, all to be deleted.
+    project = bench.gitlab.get_project("dbnomics-json-data/provider00-json-data")
+    for index in range(60):
+        bench.gitlab.hooks[project["id"]].append(
+            {
+                "id": bench.gitlab.next_id(),
+                "url": "https://stale.example/{}".format(index),
+                "project_id": project["id"],
+                "push_events": True,
+                "push_events_branch_filter": None,
+            }
+        )
+    bench.run("purge", "configure-ci-for-provider.py", "--purge", *options)
+
+
+@benchmark
+def create_repositories(bench):
+    seed_fleet(bench.gitlab, provider_slugs(10))
+    bench.run("new", "create-repositories-for-provider.py", "newprovider")
+    bench.run("existing", "create-repositories-for-provider.py", "newprovider")
+    batch = ["batch{:02d}".format(index) for index in range(10)]
+    bench.run("batch", "create-repositories-for-provider.py", *batch)
+    bench.run("resume", "create-repositories-for-provider.py", "--resume", *batch)
+
+
+@benchmark
+def trigger_job(bench):
+    slugs = provider_slugs(10)
+    seed_fleet(bench.gitlab, slugs)
+    for slug in slugs:
+        fetcher = bench.gitlab.get_project("dbnomics-fetchers/{}-fetcher".format(slug))
+        bench.gitlab.add_trigger(fetcher["id"], "{} CI jobs".format(slug))
+    bench.gitlab.finish_pipelines_after = 2
+    bench.run("one", "trigger-job-for-provider.py", "convert", slugs[0])
+    # Identical to the active pipeline of "one": skipped.
+    bench.run(
+        "duplicate",
+        "trigger-job-for-provider.py",
+        "--duplicates",
+        "skip",
+        "convert",
+        slugs[0],
+    )
+    bench.run("index", "trigger-job-for-provider.py", "index", slugs[0])
+    # Datasets changed since the last indexed commit, found behind the pipelines of
+    # other providers.
+    bench.gitlab.add_pipeline(
+        42,
+        status="success",
+        source="trigger",
+        variables={"PROVIDER_SLUG": slugs[1], "JSON_DATA_COMMIT": "a" * 40},
+    )
+    for slug in slugs[2:]:
+        for _ in range(2):
+            bench.gitlab.add_pipeline(
+                42,
+                status="success",
+                source="trigger",
+                variables={"PROVIDER_SLUG": slug},
+            )
+    json_data = bench.gitlab.get_project(
+        "dbnomics-json-data/{}-json-data".format(slugs[1])
+    )
+    json_data["_head_sha"] = "b" * 40
+    json_data["_compare_diffs"] = ["dataset1/series.jsonl", "dataset2/dataset.json"]
+    bench.run(
+        "index-incremental",
+        "trigger-job-for-provider.py",
+        "index",
+        "--incremental",
+        slugs[1],
+    )
+    # The last indexed commit is recorded by the previous run.
+    json_data["_head_sha"] = "c" * 40
+    bench.run(
+        "index-recorded",
+        "trigger-job-for-provider.py",
+        "index",
+        "--incremental",
+        slugs[1],
+    )
+    bench.run(
+        "bulk",
+        "trigger-job-for-provider.py",
+        "--max-in-flight",
+        "3",
+        "--poll-interval",
+        "0.05",
+        "convert",
+        *slugs
+    )
+
+
+@benchmark
+def cancel_pipelines(bench):
+    slugs = provider_slugs(20)
+    seed_fleet(bench.gitlab, slugs)
+    for slug in slugs:
+        project = bench.gitlab.get_project(
+            "dbnomics-json-data/{}-json-data".format(slug)
+        )
+        for _ in range(10):
+            bench.gitlab.add_pipeline(
+                project["id"], source="trigger", variables={"PROVIDER_SLUG": slug}
+            )
+        bench.gitlab.add_pipeline(project["id"], status="success")
+    bench.run(
+        "one-provider",
+        "cancel-project-pipelines.py",
+        "--group",
+        "dbnomics-json-data",
+        "--variable",
+        "PROVIDER_SLUG=provider00",
+    )
+    for name, extra_args in [
+        ("group-dry-run", []),
+        ("group-dry-run-graphql", ["--graphql"]),
+    ]:
+        bench.run(
+            name,
+            "cancel-project-pipelines.py",
+            "--group",
+            "dbnomics-json-data",
+            "--dry-run",
+            *extra_args
+        )
+    bench.run("group", "cancel-project-pipelines.py", "--group", "dbnomics-json-data")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
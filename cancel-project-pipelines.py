@@ -1,6 +1,5 @@
 #! /usr/bin/env python3
 
-
 # dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
 # By: Christophe Benz <christophe.benz@cepremap.org>
 #
@@ -21,59 +20,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-"""Cancel all the pipelines of a GitLab project."""
-
-# Inspired from https://gitlab.com/gitlab-org/gitlab/issues/16259#note_214895132
+"""Run `dbnomics-ci cancel-pipelines` (see dbnomics_gitlab_ci.cli)."""
 
-import argparse
-import itertools
-import logging
-import os
 import sys
 
-import daiquiri
-import gitlab
-from dotenv import load_dotenv
-
-logger = daiquiri.getLogger(__name__)
-
-
-def main():
-    load_dotenv()
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "project",
-        help='GitLab project to cancel its pipelines (example: "organization1/project1")',
-    )
-    parser.add_argument(
-        "--gitlab-url",
-        default=os.getenv("GITLAB_URL", "https://git.nomics.world"),
-        help="base URL of GitLab instance",
-    )
-    parser.add_argument(
-        "--debug", action="store_true", help="display debug logging messages",
-    )
-    args = parser.parse_args()
-
-    daiquiri.setup(level=logging.DEBUG if args.debug else logging.INFO)
-
-    gl = gitlab.Gitlab(
-        args.gitlab_url, private_token=os.getenv("PRIVATE_TOKEN"), api_version=4
-    )
-    gl.auth()
-    if args.debug:
-        gl.enable_debug()
-
-    project = gl.projects.get(args.project)
-    pipelines = itertools.chain.from_iterable(
-        project.pipelines.list(aslist=False, all=True, status=status)
-        for status in ["running", "pending"]
-    )
-    for pipeline in pipelines:
-        logger.info("Cancelling pipeline {} ({})".format(pipeline.id, pipeline.status))
-        pipeline.cancel()
-
+from dbnomics_gitlab_ci import cli
 
 if __name__ == "__main__":
-    sys.exit(main())
+    sys.exit(cli.run(["cancel-pipelines"] + sys.argv[1:]))
@@ -0,0 +1,30 @@
+#! /usr/bin/env python3
+
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Run `dbnomics-ci collect-durations` (see dbnomics_gitlab_ci.cli)."""
+
+import sys
+
+from dbnomics_gitlab_ci import cli
+
+if __name__ == "__main__":
+    sys.exit(cli.run(["collect-durations"] + sys.argv[1:]))
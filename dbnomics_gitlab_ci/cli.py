@@ -0,0 +1,138 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Command line entry point of the scripts: `dbnomics-ci <command> [options]`.
+
+Commands are imported only when run, so that starting a command does not import
+the dependencies of the others, and `dbnomics-ci --help` imports none of them.
+
+Commands can also be run in-process, for example from another Python program:
+
+    from dbnomics_gitlab_ci import cli
+    exit_code = cli.run(["trigger-job", "convert", "ecb"])
+"""
+
+import importlib
+import sys
+from collections import OrderedDict
+
+PROG = "dbnomics-ci"
+
+# Command name -> (module of dbnomics_gitlab_ci.commands, short help).
+COMMANDS = OrderedDict(
+    [
+        (
+            "configure",
+            ("configure_ci_for_provider", "configure the CI objects of providers"),
+        ),
+        (
+            "configure-dev-data",
+            (
+                "configure_ci_for_dev_data",
+                "enable the deploy keys of providers on their dev data repos",
+            ),
+        ),
+        (
+            "create-repositories",
+            (
+                "create_repositories_for_provider",
+                "create the repositories of new providers",
+            ),
+        ),
+        (
+            "trigger-job",
+            ("trigger_job_for_provider", "trigger a job of the pipeline of providers"),
+        ),
+        (
+            "cancel-pipelines",
+            ("cancel_project_pipelines", "cancel the pipelines of projects"),
+        ),
+        (
+            "collect-durations",
+            (
+                "collect_pipeline_durations",
+                "collect the durations of pipelines and jobs, and report them",
+            ),
+        ),
+        (
+            "gc-deploy-keys",
+            ("gc_deploy_keys", "remove the orphaned deploy keys of the instance"),
+        ),
+        (
+            "dispatch-hooks",
+            (
+                "dispatch_hooks",
+                "serve the hooks of the JSON data repos, coalescing pushes",
+            ),
+        ),
+    ]
+)
+
+
+def format_usage():
+    """Return the help of the entry point, listing the commands."""
+    lines = [
+        "usage: {} <command> [options]".format(PROG),
+        "",
+        "commands:",
+    ]
+    lines.extend(
+        "  {:<22}{}".format(name, help) for name, (_, help) in COMMANDS.items()
+    )
+    lines.extend(
+        ["", "Run `{} <command> --help` for the options of a command.".format(PROG)]
+    )
+    return "\n".join(lines)
+
+
+def load_command(name):
+    """Import the module of a command, and return its `main` function."""
+    module_name, _ = COMMANDS[name]
+    module = importlib.import_module("dbnomics_gitlab_ci.commands." + module_name)
+    return module.main
+
+
+def run(argv):
+    """Run the command given by `argv[0]` with the next arguments.
+
+    Return the exit code of the command. Exit with `SystemExit` on invalid arguments
+    or `--help`, like `argparse` does.
+    """
+    if not argv:
+        print(format_usage(), file=sys.stderr)
+        return 2
+    if argv[0] in {"-h", "--help"}:
+        print(format_usage())
+        return 0
+    name = argv[0]
+    if name not in COMMANDS:
+        print(format_usage(), file=sys.stderr)
+        print("\n{}: unknown command {!r}".format(PROG, name), file=sys.stderr)
+        return 2
+    main = load_command(name)
+    return main(argv[1:], prog="{} {}".format(PROG, name)) or 0
+
+
+def main():
+    sys.exit(run(sys.argv[1:]))
+
+
+if __name__ == "__main__":
+    main()
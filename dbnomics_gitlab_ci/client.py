@@ -0,0 +1,179 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""GitLab API client shared by the scripts.
+
+The client reuses a pool of keep-alive connections, and retries the requests failing
+because of a transient error (connection error, timeout, 502 while GitLab restarts...)
+with an exponential backoff and jitter.
+
+Only idempotent requests (GET, PUT, DELETE...) are retried when GitLab answered an
+error; POST requests are retried only if the connection could not be established,
+so that an object is never created twice. 429 responses are handled by
+python-gitlab, which obeys the Retry-After header.
+
+The number of concurrent requests is limited by a `dbnomics_gitlab_ci.governor`,
+adapting it to the load of GitLab, and shared with the other processes using the same
+token. Its maximum is given by the GITLAB_MAX_CONCURRENCY environment variable (32 by
+default); 0 disables it.
+
+Requests are recorded by `dbnomics_gitlab_ci.metrics`, when enabled.
+"""
+
+import os
+import random
+import time
+
+import gitlab
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import governor, metrics
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_TIMEOUT = 60
+TRANSIENT_STATUS_CODES = frozenset([500, 502, 503, 504])
+
+
+class RetryWithJitter(Retry):
+    """Retry policy whose exponential backoff is randomized.
+
+    This avoids many workers failing at the same time to retry all together.
+    """
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+class InstrumentedSession(requests.Session):
+    """Session recording its requests in `metrics`, retries included.
+
+    If `governor` is set, requests wait for it to allow them.
+    """
+
+    governor = None
+
+    def send(self, request, **kwargs):
+        if self.governor is None:
+            return self._send(request, **kwargs)
+        started = self.governor.acquire()
+        response = None
+        try:
+            response = self._send(request, **kwargs)
+            return response
+        finally:
+            if response is None:
+                self.governor.release(started, None, {})
+            else:
+                self.governor.release(started, response.status_code, response.headers)
+
+    def _send(self, request, **kwargs):
+        if metrics.registry is None:
+            return super().send(request, **kwargs)
+        start = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.RequestException:
+            metrics.record_request(
+                request.method, request.url, "error", time.monotonic() - start, 0
+            )
+            raise
+        if kwargs.get("stream"):
+            size = int(response.headers.get("Content-Length") or 0)
+        else:
+            size = len(response.content)
+        metrics.record_request(
+            request.method,
+            request.url,
+            response.status_code,
+            time.monotonic() - start,
+            size,
+        )
+        return response
+
+
+def make_session(
+    pool_size=DEFAULT_POOL_SIZE,
+    max_retries=DEFAULT_MAX_RETRIES,
+    backoff_factor=DEFAULT_BACKOFF_FACTOR,
+    request_governor=None,
+):
+    """Return a requests session with a connection pool and a retry policy.
+
+    Requests are limited by `request_governor`, if given.
+    """
+    retry = RetryWithJitter(
+        total=max_retries,
+        status_forcelist=TRANSIENT_STATUS_CODES,
+        backoff_factor=backoff_factor,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = InstrumentedSession()
+    session.governor = request_governor
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def make_gitlab(
+    gitlab_url,
+    private_token=None,
+    pool_size=DEFAULT_POOL_SIZE,
+    timeout=DEFAULT_TIMEOUT,
+    auth=False,
+    debug=False,
+    max_concurrency=None,
+):
+    """Return a `gitlab.Gitlab` client using a pooled session with retries.
+
+    The token is not checked by default (`auth=False`): the first API call fails
+    anyway if it is wrong, so this saves a request.
+
+    `max_concurrency` defaults to the GITLAB_MAX_CONCURRENCY environment variable.
+    """
+    if max_concurrency is None:
+        max_concurrency = int(
+            os.getenv("GITLAB_MAX_CONCURRENCY") or governor.DEFAULT_MAX_CONCURRENCY
+        )
+    request_governor = None
+    if max_concurrency > 0:
+        request_governor = governor.Governor(
+            governor.get_default_state(gitlab_url, private_token),
+            max_concurrency=max_concurrency,
+        )
+    gl = gitlab.Gitlab(
+        gitlab_url.rstrip("/"),
+        private_token=private_token,
+        api_version=4,
+        timeout=timeout,
+        session=make_session(pool_size=pool_size, request_governor=request_governor),
+    )
+    if auth:
+        gl.auth()
+    if debug:
+        gl.enable_debug()
+    return gl
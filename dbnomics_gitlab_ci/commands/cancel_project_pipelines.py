@@ -0,0 +1,430 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+r"""Cancel the pipelines of GitLab projects.
+
+Projects are given by path, or by group with --group. Pipelines are listed and
+cancelled by a bounded pool of workers, and can be filtered by ref, source, age
+and pipeline variables.
+
+With --graphql, the pipelines of many projects are listed by a few batched GraphQL
+queries instead of one REST request per project.
+
+Example: cancel the validation pipelines triggered for all the providers, except
+the last 10 minutes:
+
+    ./cancel-project-pipelines.py --group dbnomics-json-data \
+        --source trigger --older-than 10
+"""
+
+# Inspired from https://gitlab.com/gitlab-org/gitlab/issues/16259#note_214895132
+
+import argparse
+import itertools
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import daiquiri
+import requests
+from dotenv import load_dotenv
+from gitlab.exceptions import GitlabError
+from gitlab.v4.objects import ProjectPipeline
+
+from dbnomics_gitlab_ci import client, fleet, graphql, metrics
+from dbnomics_gitlab_ci.pagination import iter_all
+from dbnomics_gitlab_ci.pipelines import parse_datetime
+from dbnomics_gitlab_ci.project_index import ProjectIndex
+
+logger = daiquiri.getLogger(__name__)
+
+CANCELLABLE_STATUSES = ["running", "pending"]
+PIPELINE_SOURCES = [
+    "api",
+    "merge_request_event",
+    "pipeline",
+    "push",
+    "schedule",
+    "trigger",
+    "web",
+]
+
+
+def main(argv=None, prog=None):
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "projects",
+        metavar="project",
+        nargs="*",
+        help='GitLab project to cancel its pipelines (example: "organization1/project1")',
+    )
+    parser.add_argument(
+        "--group",
+        action="append",
+        default=[],
+        help="cancel the pipelines of all the projects of this group (can be repeated)",
+    )
+    parser.add_argument("--ref", help="only cancel pipelines of this ref")
+    parser.add_argument(
+        "--source",
+        choices=PIPELINE_SOURCES,
+        help="only cancel pipelines started this way",
+    )
+    parser.add_argument(
+        "--older-than",
+        type=float,
+        metavar="MINUTES",
+        help="only cancel pipelines created more than MINUTES ago",
+    )
+    parser.add_argument(
+        "--newer-than",
+        type=float,
+        metavar="MINUTES",
+        help="only cancel pipelines created less than MINUTES ago",
+    )
+    parser.add_argument(
+        "--variable",
+        action="append",
+        default=[],
+        type=parse_variable,
+        metavar="KEY=VALUE",
+        help="only cancel pipelines having this variable, "
+        'for example "PROVIDER_SLUG=ecb" (can be repeated)',
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=fleet.DEFAULT_JOBS,
+        help="maximum number of concurrent requests",
+    )
+    parser.add_argument(
+        "--graphql",
+        action="store_true",
+        help="list the pipelines with batched GraphQL queries, "
+        "falling back to the REST API if GitLab does not serve GraphQL",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="display the pipelines to cancel without cancelling them",
+    )
+    parser.add_argument(
+        "--gitlab-url",
+        default=os.getenv("GITLAB_URL", "https://git.nomics.world"),
+        help="base URL of GitLab instance",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="display debug logging messages",
+    )
+    metrics.add_argument(parser)
+    args = parser.parse_args(argv)
+    metrics.setup(args.metrics, __file__)
+
+    daiquiri.setup(level=logging.DEBUG if args.debug else logging.INFO)
+
+    if not args.projects and not args.group:
+        parser.error("Give projects or --group.")
+
+    gl = client.make_gitlab(
+        args.gitlab_url,
+        private_token=os.getenv("PRIVATE_TOKEN"),
+        pool_size=max(args.jobs, client.DEFAULT_POOL_SIZE),
+        debug=args.debug,
+    )
+
+    index = ProjectIndex(args.gitlab_url)
+    project_paths = list(args.projects)
+    for group in args.group:
+        project_paths.extend(index.list_project_paths(gl, group))
+
+    pipeline_filter = PipelineFilter(
+        ref=args.ref,
+        source=args.source,
+        older_than=(
+            None if args.older_than is None else timedelta(minutes=args.older_than)
+        ),
+        newer_than=(
+            None if args.newer_than is None else timedelta(minutes=args.newer_than)
+        ),
+        variables=dict(args.variable),
+    )
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        found = None
+        if args.graphql:
+            found = find_pipelines_with_graphql(
+                gl, index, project_paths, pipeline_filter, executor
+            )
+        if found is None:
+            found = find_pipelines_of_projects(
+                gl, index, project_paths, pipeline_filter, executor
+            )
+        pipelines, failed_project_paths = found
+        if failed_project_paths:
+            logger.error(
+                "Could not list the pipelines of {} projects: {}".format(
+                    len(failed_project_paths), ", ".join(failed_project_paths)
+                )
+            )
+        if args.dry_run:
+            for pipeline in pipelines:
+                logger.info("Would cancel {}".format(describe_pipeline(pipeline)))
+            return 1 if failed_project_paths else 0
+        cancelled = list(executor.map(cancel_pipeline, pipelines))
+    duration = time.monotonic() - start
+
+    cancelled_count = sum(cancelled)
+    logger.info(
+        "{} pipelines cancelled, {} failed, in {} projects, "
+        "in {:.1f}s ({:.1f} pipelines/s)".format(
+            cancelled_count,
+            len(cancelled) - cancelled_count,
+            len(project_paths),
+            duration,
+            cancelled_count / duration if duration else 0,
+        )
+    )
+    return 0 if all(cancelled) and not failed_project_paths else 1
+
+
+def parse_variable(value):
+    key, sep, value = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected KEY=VALUE")
+    return (key, value)
+
+
+class PipelineFilter:
+    """Criteria that the pipelines to cancel must match."""
+
+    def __init__(
+        self, ref=None, source=None, older_than=None, newer_than=None, variables=None
+    ):
+        self.ref = ref
+        self.source = source
+        self.older_than = older_than
+        self.newer_than = newer_than
+        self.variables = variables or {}
+
+    def list_params(self):
+        """Return the parameters filtering the pipelines listed by GitLab."""
+        params = {}
+        if self.ref is not None:
+            params["ref"] = self.ref
+        if self.source is not None:
+            params["source"] = self.source
+        return params
+
+    def matches(self, pipeline, now):
+        """Return whether `pipeline` matches, without its variables."""
+        attributes = pipeline.attributes
+        if self.ref is not None and attributes.get("ref") != self.ref:
+            return False
+        # Old GitLab versions neither filter by source, nor return it.
+        if (
+            self.source is not None
+            and attributes.get("source", self.source) != self.source
+        ):
+            return False
+        if self.older_than is not None or self.newer_than is not None:
+            age = now - parse_datetime(attributes["created_at"])
+            if self.older_than is not None and age < self.older_than:
+                return False
+            if self.newer_than is not None and age > self.newer_than:
+                return False
+        return True
+
+    def matches_variables(self, pipeline):
+        """Return whether `pipeline` has the expected variables (one API call)."""
+        if not self.variables:
+            return True
+        variables = {
+            variable.key: variable.value for variable in iter_all(pipeline.variables)
+        }
+        return all(variables.get(key) == value for key, value in self.variables.items())
+
+
+def find_pipelines(gl, index, project_path, pipeline_filter):
+    """Return the cancellable pipelines of a project matching `pipeline_filter`.
+
+    Return None if they could not be listed.
+    """
+
+    def find(project):
+        now = datetime.now(timezone.utc)
+        pipelines = itertools.chain.from_iterable(
+            iter_all(
+                project.pipelines,
+                prefetch=True,
+                status=status,
+                **pipeline_filter.list_params()
+            )
+            for status in CANCELLABLE_STATUSES
+        )
+        return [
+            pipeline
+            for pipeline in pipelines
+            if pipeline_filter.matches(pipeline, now)
+            and pipeline_filter.matches_variables(pipeline)
+        ]
+
+    try:
+        pipelines = index.call_with_projects(gl, [project_path], find)
+    except (GitlabError, requests.RequestException):
+        logger.exception("Could not list the pipelines of {}".format(project_path))
+        return None
+    logger.debug("{} pipelines to cancel in {}".format(len(pipelines), project_path))
+    return pipelines
+
+
+def find_pipelines_of_projects(gl, index, project_paths, pipeline_filter, executor):
+    """Return the cancellable pipelines of projects, listed with the REST API.
+
+    Return `(pipelines, failed_project_paths)`, the latter being the paths of the
+    projects whose pipelines could not be listed.
+    """
+    pipelines = []
+    failed_project_paths = []
+    for project_path, project_pipelines in zip(
+        project_paths,
+        executor.map(
+            lambda path: find_pipelines(gl, index, path, pipeline_filter),
+            project_paths,
+        ),
+    ):
+        if project_pipelines is None:
+            failed_project_paths.append(project_path)
+        else:
+            pipelines.extend(project_pipelines)
+    return (pipelines, failed_project_paths)
+
+
+def find_pipelines_with_graphql(gl, index, project_paths, pipeline_filter, executor):
+    """Return the cancellable pipelines of projects, listed with GraphQL.
+
+    The projects that GraphQL could not read entirely are read with the REST API,
+    and so are the pipeline variables. Return `(pipelines, failed_project_paths)`
+    like `find_pipelines_of_projects`, or None if GraphQL is not available.
+    """
+    try:
+        projects = graphql.list_pipelines(
+            gl,
+            project_paths,
+            statuses=CANCELLABLE_STATUSES,
+            ref=pipeline_filter.ref,
+            source=pipeline_filter.source,
+        )
+    except graphql.GraphQLError as exc:
+        logger.warning(
+            "Could not list the pipelines with GraphQL, using the REST API: {}".format(
+                exc
+            )
+        )
+        return None
+
+    now = datetime.now(timezone.utc)
+    candidates = []  # (project path, pipeline) tuples
+    rest_project_paths = []
+    for project_path in project_paths:
+        project = projects.get(project_path)
+        if project is None or not project.complete:
+            rest_project_paths.append(project_path)
+            continue
+        manager = gl.projects.get(project.project_id, lazy=True).pipelines
+        candidates.extend(
+            (project_path, pipeline)
+            for pipeline in (
+                ProjectPipeline(manager, attributes) for attributes in project.pipelines
+            )
+            if pipeline_filter.matches(pipeline, now)
+        )
+
+    def matches_variables(candidate):
+        project_path, pipeline = candidate
+        try:
+            return pipeline_filter.matches_variables(pipeline)
+        except (GitlabError, requests.RequestException):
+            logger.exception(
+                "Could not get the variables of pipeline {} of {}".format(
+                    pipeline.id, project_path
+                )
+            )
+            return None
+
+    matches = list(executor.map(matches_variables, candidates))
+    # Like with the REST API, no pipeline of a project that failed is cancelled.
+    graphql_failed_project_paths = {
+        project_path
+        for (project_path, _), match in zip(candidates, matches)
+        if match is None
+    }
+    pipelines = [
+        pipeline
+        for (project_path, pipeline), match in zip(candidates, matches)
+        if match and project_path not in graphql_failed_project_paths
+    ]
+    if rest_project_paths:
+        logger.debug(
+            "{} projects listed with the REST API".format(len(rest_project_paths))
+        )
+    rest_pipelines, failed_project_paths = find_pipelines_of_projects(
+        gl, index, rest_project_paths, pipeline_filter, executor
+    )
+    failed_project_paths = [
+        project_path
+        for project_path in project_paths
+        if project_path in graphql_failed_project_paths
+        or project_path in failed_project_paths
+    ]
+    return (pipelines + rest_pipelines, failed_project_paths)
+
+
+def describe_pipeline(pipeline):
+    return "pipeline {} ({}, ref {})".format(
+        pipeline.id, pipeline.status, pipeline.attributes.get("ref")
+    )
+
+
+def cancel_pipeline(pipeline):
+    """Cancel `pipeline`, returning whether it succeeded."""
+    logger.info("Cancelling {}".format(describe_pipeline(pipeline)))
+    try:
+        pipeline.cancel()
+    except GitlabError:
+        logger.exception("Could not cancel pipeline {}".format(pipeline.id))
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(main())
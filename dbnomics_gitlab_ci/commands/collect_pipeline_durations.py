@@ -0,0 +1,202 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Collect the durations of the pipelines and jobs of DBnomics, and report them.
+
+The pipelines of the fetcher, importer and data model projects are synchronized
+incrementally in a local database (see dbnomics_gitlab_ci.durations), then the
+percentiles of the job durations over the last --days are displayed, per provider
+and job name, with the change of the median since the previous period.
+
+Example: which fetchers got slower this month?
+
+    ./collect-pipeline-durations.py --days 30
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+import daiquiri
+import requests
+from dotenv import load_dotenv
+from gitlab.exceptions import GitlabError
+
+from dbnomics_gitlab_ci import client, durations, fleet, metrics
+from dbnomics_gitlab_ci.project_index import ProjectIndex
+
+logger = daiquiri.getLogger(__name__)
+
+dbnomics_fetchers_namespace = "dbnomics-fetchers"
+shared_project_paths = ["dbnomics/dbnomics-importer", "dbnomics/dbnomics-data-model"]
+
+
+def main(argv=None, prog=None):
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=30,
+        help="report the jobs finished during the last DAYS days",
+    )
+    parser.add_argument(
+        "--by-job",
+        action="store_true",
+        help="group the jobs by name only, instead of by provider and name",
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=90,
+        metavar="DAYS",
+        help="collect DAYS days of pipelines of the projects never synchronized",
+    )
+    parser.add_argument(
+        "--no-sync",
+        action="store_true",
+        help="only report the durations already collected",
+    )
+    parser.add_argument(
+        "--no-report",
+        action="store_true",
+        help="only collect the durations",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=fleet.DEFAULT_JOBS,
+        help="maximum number of projects synchronized at the same time",
+    )
+    parser.add_argument(
+        "--gitlab-url",
+        default=os.getenv("GITLAB_URL", "https://git.nomics.world"),
+        help="base URL of GitLab instance",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="display debug logging messages",
+    )
+    metrics.add_argument(parser)
+    args = parser.parse_args(argv)
+    metrics.setup(args.metrics, __file__)
+
+    daiquiri.setup(level=logging.DEBUG if args.debug else logging.INFO)
+
+    store = durations.DurationStore(args.gitlab_url)
+
+    failed = False
+    if not args.no_sync:
+        gl = client.make_gitlab(
+            args.gitlab_url,
+            private_token=os.getenv("PRIVATE_TOKEN"),
+            pool_size=max(args.jobs, client.DEFAULT_POOL_SIZE),
+            debug=args.debug,
+        )
+        index = ProjectIndex(args.gitlab_url)
+        default_updated_after = durations.format_datetime(
+            datetime.now(timezone.utc) - timedelta(days=args.history)
+        )
+        failed = not sync(gl, index, store, default_updated_after, jobs=args.jobs)
+
+    if not args.no_report:
+        previous_start, start = durations.get_period_bounds(args.days)
+        by_provider = not args.by_job
+        stats = durations.compute_stats(
+            store.get_job_durations(start), by_provider=by_provider
+        )
+        previous_stats = durations.compute_stats(
+            store.get_job_durations(previous_start, start), by_provider=by_provider
+        )
+        print(durations.format_report(stats, previous_stats))
+
+    return 1 if failed else 0
+
+
+def sync(gl, index, store, default_updated_after, jobs=fleet.DEFAULT_JOBS):
+    """Store the pipelines updated since the last synchronization of each project.
+
+    Projects are synchronized concurrently, and saved as soon as they are fetched.
+    Return False if a project failed.
+    """
+    project_paths = (
+        index.list_project_paths(gl, dbnomics_fetchers_namespace) + shared_project_paths
+    )
+
+    def fetch(project_path):
+        provider_slug = None
+        if project_path.startswith(dbnomics_fetchers_namespace + "/"):
+            provider_slug = project_path.rpartition("/")[2]
+            if provider_slug.endswith("-fetcher"):
+                provider_slug = provider_slug[: -len("-fetcher")]
+        updated_after = store.get_updated_after(project_path, default_updated_after)
+        known = store.get_known_pipelines(project_path, updated_after)
+        return index.call_with_projects(
+            gl,
+            [project_path],
+            lambda project: durations.fetch_project_runs(
+                project, updated_after, provider_slug=provider_slug, known=known
+            ),
+        )
+
+    start = time.monotonic()
+    ok = True
+    job_count = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {
+            executor.submit(fetch, project_path): project_path
+            for project_path in project_paths
+        }
+        for future in as_completed(futures):
+            project_path = futures[future]
+            try:
+                project_runs = future.result()
+            except (GitlabError, requests.RequestException):
+                logger.exception("Could not synchronize {}".format(project_path))
+                ok = False
+                continue
+            store.save(project_path, project_runs)
+            job_count += len(project_runs.jobs)
+            logger.debug(
+                "{}: {} pipelines, {} jobs".format(
+                    project_path, len(project_runs.pipelines), len(project_runs.jobs)
+                )
+            )
+    logger.info(
+        "{} projects synchronized in {:.1f}s: {} new jobs".format(
+            len(project_paths), time.monotonic() - start, job_count
+        )
+    )
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Configure data and json test repos for given providers:
+- get the deploy key of prod source-data and enable it for source and json dev data repos
+
+Keys already enabled on the dev repos are found by fingerprint and left as is, so
+running it again only changes what is missing. With --all, the keys of the whole
+fleet are synchronized concurrently (see --jobs), for example after a key rotation:
+
+    ./configure-ci-for-dev-data.py --all
+
+If a run stops, run it again with --resume to skip the providers that are done.
+"""
+
+
+import argparse
+import http.client
+import logging
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from dbnomics_gitlab_ci import client, fleet, journal, metrics, reconcile
+from dbnomics_gitlab_ci.project_index import ProjectIndex
+
+args = None
+log = logging.getLogger(__name__)
+
+dbnomics_source_data_namespace = "dbnomics-source-data"
+dbnomics_dev_data_namespace = "dbnomics-data-dev"
+
+
+def main(argv=None, prog=None):
+    global args
+    parser = argparse.ArgumentParser(prog=prog, description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('provider_slugs', metavar='provider_slug', nargs='*', help='slug of the provider')
+    parser.add_argument('--all', action='store_true',
+                        help='configure all the providers having a source data repo in both {} and {}'.format(
+                            dbnomics_source_data_namespace, dbnomics_dev_data_namespace))
+    parser.add_argument('-j', '--jobs', type=int, default=fleet.DEFAULT_JOBS,
+                        help='maximum number of providers configured at once')
+    parser.add_argument('--gitlab-url', default='https://git.nomics.world', help='base URL of GitLab instance')
+    parser.add_argument('--plan', action='store_true', help='display the changes to apply, without applying them')
+    parser.add_argument('--purge', action='store_true',
+                        help='delete all the deploy keys of the dev repos, not only those named as the provider key')
+    parser.add_argument('--no-delete', action='store_true', help='disable deletion of existing items - for debugging')
+    parser.add_argument('--debug-http', action='store_true', help='display http.client debug messages')
+    parser.add_argument('-v', '--verbose', action='store_true', help='display logging messages from debug level')
+    journal.add_arguments(parser)
+    metrics.add_argument(parser)
+    args = parser.parse_args(argv)
+    metrics.setup(args.metrics, __file__)
+
+    logging.basicConfig(
+        format="%(levelname)s:%(name)s:%(asctime)s:%(message)s",
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        stream=sys.stdout,
+    )
+    logging.getLogger("urllib3").setLevel(logging.DEBUG if args.debug_http else logging.WARNING)
+    if args.debug_http:
+        http.client.HTTPConnection.debuglevel = 1
+
+    load_dotenv()
+
+    if not os.getenv('PRIVATE_TOKEN'):
+        log.error("Please set PRIVATE_TOKEN environment variable before using this tool! (see README.md)")
+        return 1
+
+    if bool(args.provider_slugs) == args.all:
+        parser.error("Give either provider slugs or --all.")
+    for provider_slug in args.provider_slugs:
+        if provider_slug != provider_slug.lower():
+            parser.error("provider_slug must be lowercase: {!r}".format(provider_slug))
+
+    if args.gitlab_url.endswith('/'):
+        args.gitlab_url = args.gitlab_url[:-1]
+
+    gl = client.make_gitlab(args.gitlab_url, private_token=os.getenv('PRIVATE_TOKEN'),
+                            pool_size=max(args.jobs * 3, client.DEFAULT_POOL_SIZE), debug=args.debug_http)
+
+    index = ProjectIndex(args.gitlab_url)
+
+    provider_slugs = args.provider_slugs
+    if args.all:
+        dev_provider_slugs = fleet.list_provider_slugs(gl, dbnomics_dev_data_namespace, '-source-data', index=index)
+        prod_provider_slugs = set(
+            fleet.list_provider_slugs(gl, dbnomics_source_data_namespace, '-source-data', index=index))
+        provider_slugs = [
+            provider_slug for provider_slug in dev_provider_slugs if provider_slug in prod_provider_slugs]
+        log.info('{} providers to configure'.format(len(provider_slugs)))
+
+    if args.plan:
+        return report_plans(gl, index, provider_slugs)
+
+    journal_arguments = journal.run_arguments(args, ['no_delete', 'purge'])
+    try:
+        run_journal = journal.open_journal(args, 'configure-dev-data', args.gitlab_url, journal_arguments)
+    except journal.JournalError as exc:
+        log.error(exc)
+        return 1
+    with run_journal:
+        if len(provider_slugs) == 1:
+            provider_slug = provider_slugs[0]
+            if run_journal.is_done(provider_slug):
+                log.info('provider {} already configured by a previous run'.format(provider_slug))
+                return 0
+            configure_dev_data(gl, index, provider_slug, run_journal)
+            run_journal.finish(provider_slug)
+            return 0
+
+        results = fleet.run_for_providers(
+            lambda provider_slug: configure_dev_data(gl, index, provider_slug, run_journal),
+            provider_slugs,
+            jobs=args.jobs,
+            journal=run_journal,
+        )
+    print(fleet.format_summary(results))
+    return 0 if all(result.ok for result in results) else 1
+
+
+def report_plans(gl, index, provider_slugs):
+    """Build the plans of the providers without applying them, and print them."""
+    if len(provider_slugs) == 1:
+        print(configure_dev_data(gl, index, provider_slugs[0]).format())
+        return 0
+
+    results = fleet.run_for_providers(
+        lambda provider_slug: configure_dev_data(gl, index, provider_slug),
+        provider_slugs,
+        jobs=args.jobs,
+    )
+    # Print plans once all are built, to avoid mixing the lines of concurrent providers.
+    for result in results:
+        if result.ok:
+            print(result.value.format())
+    print(fleet.format_summary(results))
+    return 0 if all(result.ok for result in results) else 1
+
+
+def configure_dev_data(gl, index, provider_slug, run_journal=None):
+    """Enable the deploy key of the prod source data repo on the dev data repos of a provider.
+
+    The actions applied are recorded as steps in `run_journal`, if given.
+    """
+    log = logging.getLogger(__name__).getChild(provider_slug)
+
+    def build_plan(prod_source_data_project, dev_source_data_project, dev_json_data_project):
+        for project in (prod_source_data_project, dev_source_data_project, dev_json_data_project):
+            log.debug('project: {}'.format((project.path_with_namespace, project.id)))
+        return reconcile.build_dev_data_plan(
+            provider_slug, prod_source_data_project, dev_source_data_project, dev_json_data_project,
+            purge=args.purge)
+
+    plan = index.call_with_projects(gl, [
+        "{}/{}-source-data".format(dbnomics_source_data_namespace, provider_slug),
+        "{}/{}-source-data".format(dbnomics_dev_data_namespace, provider_slug),
+        "{}/{}-json-data".format(dbnomics_dev_data_namespace, provider_slug),
+    ], build_plan)
+    if args.plan:
+        return plan
+
+    verbs = {'create', 'update', 'delete'}
+    if args.no_delete:
+        verbs.discard('delete')
+    on_done = None
+    if run_journal is not None:
+        def on_done(action):
+            run_journal.record(provider_slug, str(action))
+    plan.apply(verbs=verbs, log=log, on_done=on_done)
+    log.info('dev data repos configured ({} changes, {} API calls)'.format(
+        len(plan.actions), plan.read_api_calls + plan.write_api_calls))
+    return plan
+
+
+if __name__ == '__main__':
+    sys.exit(main())
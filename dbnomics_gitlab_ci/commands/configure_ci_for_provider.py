@@ -0,0 +1,464 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Configure a provider in DBnomics GitLab-CI:
+- create trigger in the fetcher repo
+- create a hook in the source data repo, to trigger the convert job
+- generate private key and enable them for source and json data repos
+- create a hook in the JSON data repo to trigger the Solr indexation job
+- create a hook in the JSON data repo, to trigger the validation job
+- create pipeline schedule in the fetcher repo
+
+Existing objects are compared to the expected ones, and only the needed changes are
+applied. Use --plan to display them without applying them.
+
+Use --audit to check the providers without changing them: the differences with the
+expected layout are printed as JSON lines, for example:
+
+    {"provider_slug": "ecb", "violation": "missing", "object": "fetcher repo trigger 'CI jobs'"}
+
+Use --stagger to spread the schedules of the providers over a time window, instead of
+starting all the downloads at --schedule-time. With --graphql, the download durations
+of all the providers are read by a few batched GraphQL queries.
+
+Use --dispatcher-url to point the hooks of the JSON data repos at a `dispatch-hooks`
+service, which coalesces bursts of pushes into one pipeline per provider and job;
+run without it to point them back at the trigger API. The hooks send the secret token
+given by --dispatcher-token (or DISPATCHER_TOKEN) to the service; as GitLab does not
+return it, it is only set on the hooks created or whose URL changes.
+
+The steps done for each provider are recorded in a journal: if a run stops, for
+example on a network error, run the same command with --resume to skip the providers
+that are done. The other providers are planned again from their live state, so the
+steps already done are not repeated.
+
+See https://git.nomics.world/dbnomics-fetchers/documentation/wikis/ci-jobs
+"""
+
+
+import argparse
+import functools
+import http.client
+import json
+import logging
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from dbnomics_gitlab_ci import client, fleet, graphql, journal, metrics, reconcile, schedules, ssh_keys
+from dbnomics_gitlab_ci.project_index import ProjectIndex
+
+args = None
+log = logging.getLogger(__name__)
+
+dbnomics_fetchers_namespace = "dbnomics-fetchers"
+dbnomics_source_data_namespace = "dbnomics-source-data"
+dbnomics_json_data_namespace = "dbnomics-json-data"
+default_data_model_project_id = 40  # Project ID of repo https://git.nomics.world/dbnomics/dbnomics-data-model/
+default_importer_project_id = 42  # Project ID of repo https://git.nomics.world/dbnomics/dbnomics-importer/
+
+
+def main(argv=None, prog=None):
+    global args
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument('provider_slugs', metavar='provider_slug', nargs='*',
+                        help='slug of the provider to configure (many can be given)')
+    parser.add_argument('--audit', action='store_true',
+                        help='only check the providers: print the differences with the expected layout as JSON lines '
+                        '(including the objects --purge would delete), and exit with status 1 if there are any')
+    parser.add_argument('--all', action='store_true',
+                        help='configure all the providers having a project in {}'.format(dbnomics_fetchers_namespace))
+    parser.add_argument('-j', '--jobs', type=int, default=fleet.DEFAULT_JOBS,
+                        help='maximum number of providers configured at the same time')
+    parser.add_argument('--debug-http', action='store_true', help='display http.client debug messages')
+    parser.add_argument('--gitlab-url', default='https://git.nomics.world', help='base URL of GitLab instance')
+    parser.add_argument('--data-model-project-id', type=int, default=default_data_model_project_id,
+                        help='ID of the dbnomics-data-model project')
+    parser.add_argument('--importer-project-id', type=int, default=default_importer_project_id,
+                        help='ID of the dbnomics-importer project')
+    parser.add_argument('--no-delete', action='store_true', help='disable deletion of existing items - for debugging')
+    parser.add_argument('--no-create', action='store_true', help='disable creation of items - for debugging')
+    parser.add_argument('--plan', action='store_true',
+                        help='display the changes to apply and the number of API calls, without applying them')
+    parser.add_argument('--purge', action='store_true',
+                        help='delete all triggers, hooks and deploy keys, not only those created by this script')
+    parser.add_argument('--key-type', choices=ssh_keys.KEY_TYPES, default=ssh_keys.DEFAULT_KEY_TYPE,
+                        help='type of the SSH keys generated for deploy keys')
+    parser.add_argument('--key-pool', type=int, default=0, metavar='SIZE',
+                        help='generate SIZE SSH keys ahead of need, in parallel - useful with many providers')
+    parser.add_argument('--schedule-time', type=parse_time,
+                        help='time to run the scheduled pipeline (default: 1:0 for new schedules; existing schedules keep their time)')
+    parser.add_argument('--stagger', type=parse_window, metavar='START-END',
+                        help='spread the schedule times of the providers between START and END (example: 0:00-6:00), '
+                        'placing longest downloads first, instead of using --schedule-time')
+    parser.add_argument('--stagger-slot', type=int, default=schedules.DEFAULT_SLOT_MINUTES, metavar='MINUTES',
+                        help='with --stagger: minutes between two possible schedule times')
+    parser.add_argument('--graphql', action='store_true',
+                        help='with --stagger: read the download durations with batched GraphQL queries, '
+                        'falling back to the REST API if GitLab does not serve GraphQL')
+    parser.add_argument('--dispatcher-url', metavar='URL',
+                        help='base URL of the dispatch-hooks service to be called by the JSON data repo hooks, '
+                        'instead of the trigger API')
+    parser.add_argument('--dispatcher-token', default=os.getenv('DISPATCHER_TOKEN'), metavar='TOKEN',
+                        help='with --dispatcher-url: secret token sent by the hooks to the dispatch-hooks service '
+                        '(default: DISPATCHER_TOKEN environment variable)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='display logging messages from debug level')
+    journal.add_arguments(parser)
+    metrics.add_argument(parser)
+    args = parser.parse_args(argv)
+    metrics.setup(args.metrics, __file__)
+
+    if args.audit:
+        args.plan = True
+
+    logging.basicConfig(
+        format="%(levelname)s:%(name)s:%(asctime)s:%(message)s",
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        # Keep the standard output for violations, when auditing.
+        stream=sys.stderr if args.audit else sys.stdout,
+    )
+    logging.getLogger("urllib3").setLevel(logging.DEBUG if args.debug_http else logging.WARNING)
+    if args.debug_http:
+        http.client.HTTPConnection.debuglevel = 1
+
+    load_dotenv()
+
+    if not os.getenv('PRIVATE_TOKEN'):
+        log.error("Please set PRIVATE_TOKEN environment variable before using this tool! (see README.md)")
+        return 1
+
+    if bool(args.provider_slugs) == args.all:
+        parser.error("Give either provider slugs or --all.")
+
+    for provider_slug in args.provider_slugs:
+        if provider_slug != provider_slug.lower():
+            parser.error("provider_slug must be lowercase.")
+
+    if args.stagger_slot < 1:
+        parser.error("--stagger-slot must be at least 1.")
+
+    if args.gitlab_url.endswith('/'):
+        args.gitlab_url = args.gitlab_url[:-1]
+
+    gl = client.make_gitlab(
+        args.gitlab_url,
+        private_token=os.getenv('PRIVATE_TOKEN'),
+        pool_size=max(args.jobs * reconcile.MAX_CONCURRENT_CALLS, client.DEFAULT_POOL_SIZE),
+        debug=args.debug_http,
+    )
+
+    # Start generating keys as soon as possible, while requesting GitLab.
+    key_pool = None
+    if args.key_pool > 0 and not args.plan:
+        key_pool = ssh_keys.KeyPool(args.key_pool, key_type=args.key_type)
+    try:
+        return configure_providers(gl, key_pool)
+    finally:
+        if key_pool is not None:
+            key_pool.close()
+
+
+def configure_providers(gl, key_pool):
+    index = ProjectIndex(args.gitlab_url)
+
+    provider_slugs = args.provider_slugs
+    if args.all:
+        provider_slugs = fleet.list_provider_slugs(gl, dbnomics_fetchers_namespace, '-fetcher', index=index)
+        log.info('{} providers found in {}'.format(len(provider_slugs), dbnomics_fetchers_namespace))
+
+    schedule_times = None
+    if args.stagger is not None:
+        schedule_times = stagger_schedules(gl, index, provider_slugs)
+
+    # Importer and data model projects are shared by all the providers.
+    # Their project IDs are passed by a script argument, because they almost never change.
+    data_model_project = gl.projects.get(args.data_model_project_id, lazy=True)
+    importer_project = gl.projects.get(args.importer_project_id, lazy=True)
+
+    violations = []
+
+    # Get data model repo trigger.
+    data_model_trigger_token = get_shared_trigger_token(index, data_model_project, "data model repo", violations)
+    log.debug('data model repo trigger fetched')
+
+    # Get importer repo trigger.
+    importer_trigger_token = get_shared_trigger_token(index, importer_project, "importer repo", violations)
+    log.debug('importer repo trigger fetched')
+
+    settings = reconcile.Settings(
+        api_base_url=args.gitlab_url + '/api/v4',
+        importer_project_id=args.importer_project_id,
+        importer_trigger_token=importer_trigger_token,
+        data_model_project_id=args.data_model_project_id,
+        data_model_trigger_token=data_model_trigger_token,
+        # Without --schedule-time, the time of existing schedules is kept.
+        schedule_time=args.schedule_time,
+        schedule_times=schedule_times,
+        # Enable the existing deploy key of a private key, rather than creating a new pair.
+        find_deploy_key=functools.partial(index.find_deploy_key, gl),
+        dispatcher_url=args.dispatcher_url,
+        dispatcher_token=args.dispatcher_token or None,
+        # Report the objects that --purge would delete, like duplicate triggers.
+        purge=args.purge or args.audit,
+        generate_ssh_key=(
+            functools.partial(ssh_keys.generate_ssh_key, key_type=args.key_type)
+            if key_pool is None
+            else key_pool.generate_ssh_key
+        ),
+    )
+
+    if args.plan:
+        return report_plans(gl, index, provider_slugs, settings, violations)
+
+    # A run can't be resumed with options changing the configuration of the providers.
+    journal_arguments = journal.run_arguments(args, [
+        'data_model_project_id', 'importer_project_id', 'no_create', 'no_delete', 'purge', 'key_type',
+        'schedule_time', 'stagger', 'stagger_slot', 'dispatcher_url',
+    ], secret_names=['dispatcher_token'])
+    try:
+        run_journal = journal.open_journal(args, 'configure', args.gitlab_url, journal_arguments)
+    except journal.JournalError as exc:
+        log.error(exc)
+        return 1
+    with run_journal:
+        if len(provider_slugs) == 1:
+            provider_slug = provider_slugs[0]
+            if run_journal.is_done(provider_slug):
+                log.info('provider {} already configured by a previous run'.format(provider_slug))
+                return 0
+            configure_provider(gl, index, provider_slug, settings, run_journal)
+            run_journal.finish(provider_slug)
+            return 0
+
+        results = fleet.run_for_providers(
+            lambda provider_slug: configure_provider(gl, index, provider_slug, settings, run_journal),
+            provider_slugs,
+            jobs=args.jobs,
+            journal=run_journal,
+        )
+    print(fleet.format_summary(results))
+    return 0 if all(result.ok for result in results) else 1
+
+
+def report_plans(gl, index, provider_slugs, settings, violations):
+    """Build the plans of the providers without applying them, and print them.
+
+    With --audit, the differences with the expected layout are printed instead.
+    """
+    if len(provider_slugs) == 1 and not args.audit:
+        plan = configure_provider(gl, index, provider_slugs[0], settings)
+        print(plan.format())
+        return 0
+
+    results = fleet.run_for_providers(
+        lambda provider_slug: configure_provider(gl, index, provider_slug, settings),
+        provider_slugs,
+        jobs=args.jobs,
+    )
+    if args.audit:
+        for result in results:
+            if result.ok:
+                violations.extend(result.value.violations())
+            else:
+                violations.append({
+                    "provider_slug": result.provider_slug,
+                    "violation": "error",
+                    "object": "{}: {}".format(type(result.error).__name__, result.error),
+                })
+        for violation in violations:
+            print(json.dumps(violation))
+        log.info('{} violations found for {} providers'.format(len(violations), len(provider_slugs)))
+        return 1 if violations else 0
+    # Print plans once all are built, to avoid mixing the lines of concurrent providers.
+    for result in results:
+        if result.ok:
+            print(result.value.format())
+    print(fleet.format_summary(results))
+    return 0 if all(result.ok for result in results) else 1
+
+
+def get_shared_trigger_token(index, project, repo_name, violations):
+    """Return the token of the trigger of a project shared by the providers.
+
+    The project must have exactly one trigger: when auditing, a violation is added
+    instead of failing.
+
+    Triggers are listed from the API at each run, not read from the index: if the
+    trigger was rotated, hooks must not be updated with the revoked token.
+    """
+    index.forget_triggers(project)
+    triggers = index.get_triggers(project)
+    if len(triggers) != 1:
+        if not args.audit:
+            raise AssertionError(triggers)
+        violations.append({
+            "provider_slug": None,
+            "violation": "missing" if not triggers else "unexpected",
+            "object": "{} trigger ({} found, 1 expected)".format(repo_name, len(triggers)),
+        })
+    return triggers[0].token if triggers else "<missing trigger token>"
+
+
+def configure_provider(gl, index, provider_slug, settings, run_journal=None):
+    """Reconcile the CI objects of a provider (see module docstring).
+
+    The actions applied are recorded as steps in `run_journal`, if given.
+    """
+    log = logging.getLogger(__name__).getChild(provider_slug)
+
+    def build_plan(fetcher_project, source_data_project, json_data_project):
+        log.debug('projects: {}'.format([
+            (project.path_with_namespace, project.id)
+            for project in (fetcher_project, source_data_project, json_data_project)
+        ]))
+        return reconcile.build_plan(provider_slug, fetcher_project, source_data_project, json_data_project, settings)
+
+    plan = index.call_with_projects(gl, [
+        "{}/{}-fetcher".format(dbnomics_fetchers_namespace, provider_slug),
+        "{}/{}-source-data".format(dbnomics_source_data_namespace, provider_slug),
+        "{}/{}-json-data".format(dbnomics_json_data_namespace, provider_slug),
+    ], build_plan)
+    if args.plan:
+        return plan
+
+    verbs = {'create', 'update', 'delete'}
+    if args.no_delete:
+        verbs.discard('delete')
+    if args.no_create:
+        verbs -= {'create', 'update'}
+    on_done = None
+    if run_journal is not None:
+        for action in plan.actions:
+            if run_journal.is_step_done(provider_slug, str(action)):
+                log.warning('step done by a previous run is needed again: {}'.format(action))
+
+        def on_done(action):
+            run_journal.record(provider_slug, str(action))
+
+    plan.apply(verbs=verbs, log=log, on_done=on_done)
+    log.info('provider configured ({} changes, {} API calls)'.format(
+        len(plan.actions), plan.read_api_calls + plan.write_api_calls))
+    return plan
+
+
+def stagger_schedules(gl, index, provider_slugs):
+    """Return the schedule times of the providers, spread over the --stagger window.
+
+    Download durations are read concurrently, or with GraphQL if --graphql is given.
+    They are unknown for providers failing to be read, which are placed using the
+    median duration.
+    """
+    provider_slugs = [provider_slug for provider_slug in provider_slugs if provider_slug != "dummy"]
+    durations = None
+    if args.graphql:
+        try:
+            fetcher_durations = schedules.get_download_durations(
+                gl, ["{}/{}-fetcher".format(dbnomics_fetchers_namespace, provider_slug)
+                     for provider_slug in provider_slugs])
+        except graphql.GraphQLError as exc:
+            log.warning('Could not read the download durations with GraphQL, using the REST API: {}'.format(exc))
+        else:
+            durations = {
+                provider_slug: fetcher_durations.get("{}/{}-fetcher".format(dbnomics_fetchers_namespace, provider_slug))
+                for provider_slug in provider_slugs
+            }
+    if durations is None:
+        results = fleet.run_for_providers(
+            lambda provider_slug: index.call_with_projects(
+                gl, ["{}/{}-fetcher".format(dbnomics_fetchers_namespace, provider_slug)],
+                schedules.get_download_duration),
+            provider_slugs,
+            jobs=args.jobs,
+        )
+        durations = {result.provider_slug: result.value for result in results}
+    schedule_times = schedules.stagger(durations, args.stagger, slot_minutes=args.stagger_slot)
+    for provider_slug, (hour, minute) in schedule_times.items():
+        duration = durations[provider_slug]
+        log.debug('schedule time of {}: {}:{:02d} (download duration: {})'.format(
+            provider_slug, hour, minute, "unknown" if duration is None else "{:.0f}s".format(duration)))
+    return schedule_times
+
+
+def parse_time(time):
+    """Transform a "hour:minute" string to a (hour, minute) tuple of integers.
+
+    >>> parse_time('')
+    Traceback (most recent call last):
+    ValueError: Invalid time ''
+    >>> parse_time(':')
+    Traceback (most recent call last):
+    ValueError: Invalid time ':'
+    >>> parse_time('1')
+    Traceback (most recent call last):
+    ValueError: Invalid time '1'
+    >>> parse_time('1:')
+    Traceback (most recent call last):
+    ValueError: Invalid time '1:'
+    >>> parse_time('1:1:1')
+    Traceback (most recent call last):
+    ValueError: Invalid time '1:1:1'
+    >>> parse_time('99:99')
+    Traceback (most recent call last):
+    ValueError: Invalid time '99:99'
+    >>> parse_time('-1:-1')
+    Traceback (most recent call last):
+    ValueError: Invalid time '-1:-1'
+    >>> parse_time('0:0')
+    (0, 0)
+    >>> parse_time('1:1')
+    (1, 1)
+    >>> parse_time('23:59')
+    (23, 59)
+    """
+    parts = time.split(':')
+    exc = ValueError('Invalid time {!r}'.format(time))
+    if len(parts) != 2:
+        raise exc
+    hour, minute = parts
+    try:
+        hour = int(hour)
+        minute = int(minute)
+    except ValueError:
+        raise exc
+    if hour < 0 or hour > 23 or minute < 0 or minute > 59:
+        raise exc
+    return (hour, minute)
+
+
+def parse_window(window):
+    """Transform a "hour:minute-hour:minute" string to a pair of (hour, minute) tuples.
+
+    >>> parse_window('0:00-6:30')
+    ((0, 0), (6, 30))
+    >>> parse_window('22:0-2:0')
+    ((22, 0), (2, 0))
+    >>> parse_window('1:0')
+    Traceback (most recent call last):
+    ValueError: Invalid time window '1:0'
+    """
+    parts = window.split('-')
+    if len(parts) != 2:
+        raise ValueError('Invalid time window {!r}'.format(window))
+    return (parse_time(parts[0]), parse_time(parts[1]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Create repositories for providers in DBnomics GitLab-CI:
+   - dbnomics-fetchers/XXX-fetcher
+   - dbnomics-source-data/XXX-source-data
+   - dbnomics-json-data/XXX-json-data
+
+Many provider slugs can be given, to onboard a batch of new providers at once.
+
+Existing repositories are found by exact path, from one listing of the projects of
+each namespace; the missing ones are created concurrently (see --jobs).
+
+If a run stops, run it again with --resume: the repositories created or found by the
+previous run are skipped, and the namespaces are listed only if needed.
+"""
+
+
+import argparse
+import http.client
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from gitlab.exceptions import GitlabCreateError, GitlabError
+from gitlab.v4.objects import VISIBILITY_PUBLIC
+
+from dbnomics_gitlab_ci import client, fleet, journal, metrics
+from dbnomics_gitlab_ci.project_index import ProjectIndex
+
+args = None
+log = logging.getLogger(__name__)
+
+# (namespace, project name suffix, label, description format)
+REPOSITORIES = [
+    ('dbnomics-fetchers', '-fetcher', 'fetcher',
+     "DBnomics fetcher for series from {} database."),
+    ('dbnomics-source-data', '-source-data', 'source data',
+     "Source data as downloaded from provider {}"),
+    ('dbnomics-json-data', '-json-data', 'JSON data',
+     "JSON data as converted from source data of provider {}"),
+]
+
+
+def main(argv=None, prog=None):
+    global args
+    parser = argparse.ArgumentParser(prog=prog, description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('provider_slugs', metavar='provider_slug', nargs='+',
+                        help='slug of a provider to create repositories for')
+    parser.add_argument('--gitlab-url', default='https://git.nomics.world', help='base URL of GitLab instance')
+    parser.add_argument('-j', '--jobs', type=int, default=fleet.DEFAULT_JOBS,
+                        help='maximum number of repositories created at once')
+    parser.add_argument('--debug-http', action='store_true', help='display http.client debug messages')
+    parser.add_argument('-v', '--verbose', action='store_true', help='display logging messages from debug level')
+    journal.add_arguments(parser)
+    metrics.add_argument(parser)
+    args = parser.parse_args(argv)
+    metrics.setup(args.metrics, __file__)
+
+    logging.basicConfig(
+        format="%(levelname)s:%(name)s:%(asctime)s:%(message)s",
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        stream=sys.stdout,
+    )
+    logging.getLogger("urllib3").setLevel(logging.DEBUG if args.debug_http else logging.WARNING)
+    if args.debug_http:
+        http.client.HTTPConnection.debuglevel = 1
+
+    load_dotenv()
+
+    for provider_slug in args.provider_slugs:
+        if provider_slug != provider_slug.lower():
+            parser.error("provider_slug must be lowercase: {!r}".format(provider_slug))
+
+    if not os.getenv('PRIVATE_TOKEN'):
+        log.error("Please set PRIVATE_TOKEN environment variable before using this tool! (see README.md)")
+        return 1
+
+    if args.gitlab_url.endswith('/'):
+        args.gitlab_url = args.gitlab_url[:-1]
+
+    gl = client.make_gitlab(args.gitlab_url, private_token=os.getenv('PRIVATE_TOKEN'),
+                            pool_size=max(args.jobs, client.DEFAULT_POOL_SIZE), debug=args.debug_http)
+    index = ProjectIndex(args.gitlab_url)
+
+    with journal.open_journal(args, 'create-repositories', args.gitlab_url) as run_journal, \
+            ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        repositories = [
+            (provider_slug, namespace_name, suffix, label, description)
+            for provider_slug in args.provider_slugs
+            for namespace_name, suffix, label, description in REPOSITORIES
+            if not run_journal.is_step_done(provider_slug, label)
+        ]
+        done_count = len(args.provider_slugs) * len(REPOSITORIES) - len(repositories)
+        if done_count:
+            log.info('{} repositories done by a previous run'.format(done_count))
+
+        # Resolve each namespace once, and list its projects to check existence by exact path.
+        # The index is refreshed, as creating a repository must not rely on an outdated cache.
+        namespace_names = [
+            namespace_name for namespace_name, _, _, _ in REPOSITORIES
+            if any(repository[1] == namespace_name for repository in repositories)
+        ]
+        namespaces = dict(zip(namespace_names, executor.map(
+            lambda namespace_name: resolve_namespace(gl, index, namespace_name), namespace_names)))
+
+        created = list(executor.map(
+            lambda repository: create_repository(
+                gl, index, repository[0], namespaces[repository[1]], *repository[2:], run_journal=run_journal),
+            repositories))
+        for provider_slug in args.provider_slugs:
+            if all(run_journal.is_step_done(provider_slug, label) for _, _, label, _ in REPOSITORIES):
+                run_journal.finish(provider_slug)
+
+    failed_count = created.count(None)
+    log.info('{} repositories created, {} existing, {} failed'.format(
+        created.count(True), created.count(False), failed_count))
+    return 1 if failed_count else 0
+
+
+def resolve_namespace(gl, index, namespace_name):
+    """Return the namespace of `namespace_name`, found by exact path, and index its projects."""
+    namespace = gl.namespaces.get(namespace_name)
+    index.refresh_namespace(gl, namespace.full_path)
+    return namespace
+
+
+def create_repository(gl, index, provider_slug, namespace, suffix, label, description, run_journal=None):
+    """Create the repository of a provider in `namespace`, unless it exists.
+
+    Return whether it was created, or None if it failed. Unless it failed, `label` is
+    recorded as a step of the provider in `run_journal`, if given.
+    """
+    created = create_missing_repository(gl, index, provider_slug, namespace, suffix, label, description)
+    if created is not None and run_journal is not None:
+        run_journal.record(provider_slug, label)
+    return created
+
+
+def create_missing_repository(gl, index, provider_slug, namespace, suffix, label, description):
+    project_name = '{}{}'.format(provider_slug, suffix)
+    project_path = '{}/{}'.format(namespace.full_path, project_name)
+    if index.get_project_id(gl, project_path) is not None:
+        log.info('{} repository exists: {}'.format(label, project_path))
+        return False
+    try:
+        project = gl.projects.create({
+            'name': project_name,
+            'namespace_id': namespace.id,
+            'description': description.format(provider_slug),
+            'visibility': VISIBILITY_PUBLIC,
+        })
+    except GitlabCreateError as exc:
+        # Created by someone else since the namespace was listed.
+        if exc.response_code == 400 and 'has already been taken' in str(exc.error_message):
+            log.info('{} repository exists: {}'.format(label, project_path))
+            return False
+        log.exception('Could not create {} repository {}'.format(label, project_path))
+        return None
+    except GitlabError:
+        log.exception('Could not create {} repository {}'.format(label, project_path))
+        return None
+    index.add_project(project)
+    log.info('Repository created: {}'.format(project.http_url_to_repo))
+    log.debug('JSON info: {}'.format(project))
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(main())
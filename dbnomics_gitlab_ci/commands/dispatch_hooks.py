@@ -0,0 +1,173 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Serve the hooks of the JSON data repos, coalescing bursts of pushes.
+
+Instead of triggering the Solr indexation and validation pipelines at each push, the
+hooks of the JSON data repos can call this service (see `configure --dispatcher-url`).
+It triggers one pipeline per provider and job once the pushes stop for --window
+seconds, and limits the number of active pipelines per target project:
+
+    export DISPATCHER_TOKEN=...
+    ./dispatch-hooks.py --port 8080 --window 120
+    ./configure-ci-for-provider.py --all --dispatcher-url http://dispatcher.example:8080
+
+Requests must send the secret token given by --secret-token or DISPATCHER_TOKEN in
+their X-Gitlab-Token header, which configure sets on the hooks. The service does not
+start without a token, unless --insecure is given.
+
+GET /status returns counters of the service. Pending requests are dispatched when it
+is stopped (Ctrl-C or SIGTERM).
+"""
+
+import argparse
+import logging
+import os
+import signal
+import threading
+
+import daiquiri
+from dotenv import load_dotenv
+
+from dbnomics_gitlab_ci import client, dispatcher, metrics
+
+logger = daiquiri.getLogger(__name__)
+
+
+def main(argv=None, prog=None):
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--host", default="0.0.0.0", help="address to listen on (default: all)"
+    )
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument(
+        "--window",
+        type=float,
+        default=dispatcher.DEFAULT_WINDOW,
+        help="seconds without new push after which a pipeline is triggered",
+    )
+    parser.add_argument(
+        "--max-wait",
+        type=float,
+        default=dispatcher.DEFAULT_MAX_WAIT,
+        help="maximum seconds between the first push and the pipeline, "
+        "even if pushes continue",
+    )
+    parser.add_argument(
+        "--max-per-project",
+        type=int,
+        default=dispatcher.DEFAULT_MAX_PER_PROJECT,
+        help="maximum number of active pipelines triggered in each target project",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=dispatcher.DEFAULT_POLL_INTERVAL,
+        help="seconds between checks of the status of active pipelines",
+    )
+    parser.add_argument(
+        "--secret-token",
+        default=os.getenv("DISPATCHER_TOKEN"),
+        help="token the hooks must send in their X-Gitlab-Token header "
+        "(default: DISPATCHER_TOKEN environment variable)",
+    )
+    parser.add_argument(
+        "--insecure",
+        action="store_true",
+        help="start without secret token, accepting requests without "
+        "X-Gitlab-Token header",
+    )
+    parser.add_argument(
+        "--max-refresh-failures",
+        type=int,
+        default=dispatcher.DEFAULT_MAX_REFRESH_FAILURES,
+        help="stop waiting for an active pipeline after failing to get its status "
+        "this number of times in a row",
+    )
+    parser.add_argument(
+        "--gitlab-url",
+        default=os.getenv("GITLAB_URL", "https://git.nomics.world"),
+        help="base URL of GitLab instance",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="display debug logging messages",
+    )
+    metrics.add_argument(parser)
+    args = parser.parse_args(argv)
+    metrics.setup(args.metrics, __file__)
+
+    daiquiri.setup(level=logging.DEBUG if args.debug else logging.INFO)
+
+    if not os.getenv("PRIVATE_TOKEN"):
+        logger.error(
+            "Please set PRIVATE_TOKEN environment variable "
+            "before using this tool! (see README.md)"
+        )
+        return 1
+    if args.max_per_project < 1:
+        parser.error("--max-per-project must be at least 1.")
+    if not args.secret_token:
+        if not args.insecure:
+            logger.error(
+                "Please set DISPATCHER_TOKEN environment variable or --secret-token "
+                "before starting this service, or use --insecure (see README.md)"
+            )
+            return 1
+        logger.warning(
+            "No secret token: requests are accepted without X-Gitlab-Token header"
+        )
+
+    gl = client.make_gitlab(
+        args.gitlab_url, private_token=os.getenv("PRIVATE_TOKEN"), debug=args.debug
+    )
+    server = dispatcher.DispatcherServer(
+        dispatcher.Dispatcher(
+            gl,
+            window=args.window,
+            max_wait=args.max_wait,
+            max_per_project=args.max_per_project,
+            poll_interval=args.poll_interval,
+            max_refresh_failures=args.max_refresh_failures,
+        ),
+        host=args.host,
+        port=args.port,
+        secret_token=args.secret_token or None,
+    )
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    server.start()
+    logger.info("Dispatching hooks received on {}".format(server.url))
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    logger.info("Stopping, dispatching pending requests")
+    server.stop()
+    logger.info("Stopped: {}".format(server.dispatcher.status()))
+    return 0
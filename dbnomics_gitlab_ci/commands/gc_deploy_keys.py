@@ -0,0 +1,219 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+
+
+"""Remove the orphaned "CI jobs" deploy keys of the instance, in bulk.
+
+A deploy key named "{provider_slug} CI jobs" is orphaned when it is not the key of
+the SSH_PRIVATE_KEY variable of the fetcher repo of its provider (for example after
+a key rotation), or when this fetcher repo has no such variable or doesn't exist.
+Keys are kept when the key of the fetcher repo can't be known: when the fetcher repo
+can't be read, or when its SSH_PRIVATE_KEY variable is not a readable private key.
+Orphaned keys are removed from all the projects where they are enabled, including
+the dev data repos; GitLab deletes a key removed from its last project.
+
+Keys are compared by fingerprint. Listing all the deploy keys of the instance
+requires an administrator token. Use --dry-run to only display the keys to remove:
+
+    ./gc-deploy-keys.py --dry-run
+"""
+
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import daiquiri
+from dotenv import load_dotenv
+from gitlab.exceptions import GitlabError, GitlabGetError
+
+from dbnomics_gitlab_ci import client, fleet, metrics, reconcile, ssh_keys
+from dbnomics_gitlab_ci.pagination import iter_all, list_all
+from dbnomics_gitlab_ci.project_index import ProjectIndex
+
+logger = daiquiri.getLogger(__name__)
+
+dbnomics_fetchers_namespace = "dbnomics-fetchers"
+key_title_suffix = " " + reconcile.GENERATED_OBJECTS_TAG
+
+
+def main(argv=None, prog=None):
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=fleet.DEFAULT_JOBS,
+        help="maximum number of concurrent requests",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="display the deploy keys to remove without removing them",
+    )
+    parser.add_argument(
+        "--gitlab-url",
+        default=os.getenv("GITLAB_URL", "https://git.nomics.world"),
+        help="base URL of GitLab instance",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="display debug logging messages",
+    )
+    metrics.add_argument(parser)
+    args = parser.parse_args(argv)
+    metrics.setup(args.metrics, __file__)
+
+    daiquiri.setup(level=logging.DEBUG if args.debug else logging.INFO)
+
+    gl = client.make_gitlab(
+        args.gitlab_url,
+        private_token=os.getenv("PRIVATE_TOKEN"),
+        pool_size=max(args.jobs, client.DEFAULT_POOL_SIZE),
+        debug=args.debug,
+    )
+    index = ProjectIndex(args.gitlab_url)
+
+    keys = list_all(gl.deploykeys)
+    index.refresh_deploy_keys(gl, keys)
+    ci_keys = [key for key in keys if key.title.endswith(key_title_suffix)]
+    provider_slugs = sorted({key.title[: -len(key_title_suffix)] for key in ci_keys})
+    logger.info(
+        "{} deploy keys, {} CI keys of {} providers".format(
+            len(keys), len(ci_keys), len(provider_slugs)
+        )
+    )
+
+    results = fleet.run_for_providers(
+        lambda provider_slug: get_fetcher_key_fingerprint(gl, index, provider_slug),
+        provider_slugs,
+        jobs=args.jobs,
+    )
+    fingerprints = {result.provider_slug: result for result in results}
+
+    removals = []
+    for key in ci_keys:
+        result = fingerprints[key.title[: -len(key_title_suffix)]]
+        if not result.ok:
+            logger.warning(
+                "Keeping deploy key {} {!r}: the key of its fetcher repo is "
+                "unknown".format(key.id, key.title)
+            )
+            continue
+        if result.value == ssh_keys.get_fingerprint(key.key):
+            continue
+        projects = key.attributes.get(
+            "projects_with_write_access", []
+        ) + key.attributes.get("projects_with_readonly_access", [])
+        removals.extend((key, project) for project in projects)
+
+    if args.dry_run:
+        for key, project in removals:
+            logger.info(
+                "Would remove deploy key {} {!r} from {}".format(
+                    key.id, key.title, project["path_with_namespace"]
+                )
+            )
+        return 0
+
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        removed = list(
+            executor.map(
+                lambda removal: remove_deploy_key(gl, *removal),
+                removals,
+            )
+        )
+    index.forget_deploy_keys(*{key.id for key, _ in removals})
+    removed_count = sum(removed)
+    logger.info(
+        "{} orphaned deploy keys removed from {} projects, {} failed".format(
+            len({key.id for key, _ in removals}),
+            removed_count,
+            len(removed) - removed_count,
+        )
+    )
+    return 0 if all(removed) else 1
+
+
+def get_fetcher_key_fingerprint(gl, index, provider_slug):
+    """Return the fingerprint of the deploy key of the fetcher repo of a provider.
+
+    Return None if the fetcher repo or its SSH_PRIVATE_KEY variable doesn't exist.
+    Raise ValueError if the SSH_PRIVATE_KEY variable can't be read as a private key:
+    its deploy key is unknown, rather than missing.
+    """
+    fetcher_path = "{}/{}-fetcher".format(dbnomics_fetchers_namespace, provider_slug)
+
+    def get_fingerprint(fetcher_project):
+        variable = next(
+            (
+                variable
+                for variable in iter_all(fetcher_project.variables)
+                if variable.key == "SSH_PRIVATE_KEY"
+            ),
+            None,
+        )
+        if variable is None:
+            return None
+        public_key = ssh_keys.get_public_key(variable.value)
+        if public_key is None:
+            raise ValueError(
+                "SSH_PRIVATE_KEY of {} can't be read as a private key".format(
+                    fetcher_path
+                )
+            )
+        return ssh_keys.get_fingerprint(public_key)
+
+    try:
+        return index.call_with_projects(gl, [fetcher_path], get_fingerprint)
+    except GitlabGetError as exc:
+        if exc.response_code == 404:
+            return None
+        raise
+
+
+def remove_deploy_key(gl, key, project):
+    """Remove `key` from `project`, returning whether it succeeded."""
+    logger.info(
+        "Removing deploy key {} {!r} from {}".format(
+            key.id, key.title, project["path_with_namespace"]
+        )
+    )
+    try:
+        gl.projects.get(project["id"], lazy=True).keys.delete(key.id)
+    except GitlabError as exc:
+        if exc.response_code == 404:
+            return True
+        logger.exception(
+            "Could not remove deploy key {} from {}".format(
+                key.id, project["path_with_namespace"]
+            )
+        )
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,320 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Trigger a job for specific providers.
+
+When many providers are given, at most --max-in-flight pipelines are active at once:
+the next provider is triggered as soon as the pipeline of another one finishes.
+
+With --follow, the logs of the jobs of the triggered pipeline are displayed while they
+run, and the exit status tells whether the pipeline succeeded.
+
+With --incremental, the "index" job only indexes the datasets changed since the last
+indexed commit of the JSON data repo, falling back to a full indexation when they
+can't be known or are too many (see dbnomics_gitlab_ci.indexing). Nothing is
+triggered if no dataset changed.
+
+By default, a pipeline is triggered even if an identical one (same project, ref and
+variables) is already active. Use --duplicates to use the active one instead (skip),
+to cancel it after triggering the new one (supersede), or to wait for it to finish
+before triggering (queue).
+
+See https://git.nomics.world/dbnomics-fetchers/documentation/wikis/Setup-CI-jobs
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import gitlab
+from dotenv import load_dotenv
+
+from dbnomics_gitlab_ci import client, fleet, indexing, metrics, pipelines
+from dbnomics_gitlab_ci.project_index import ProjectIndex, is_not_found
+
+dbnomics_namespace = "dbnomics"
+dbnomics_fetchers_namespace = "dbnomics-fetchers"
+dbnomics_json_data_namespace = "dbnomics-json-data"
+log = logging.getLogger(__name__)
+
+
+class TriggerNotFound(Exception):
+    """The project running a job does not have exactly one trigger."""
+
+
+def main(argv=None, prog=None):
+    global args
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument('job_name', choices=['download', 'convert', 'index', 'validate'], help='job name to trigger')
+    parser.add_argument('provider_slugs', metavar='provider_slug', nargs='+',
+                        help='slug of the provider to trigger the job for (many can be given)')
+    parser.add_argument('--follow', action='store_true',
+                        help='display the job logs until the pipeline finishes, and exit with its status')
+    parser.add_argument('--duplicates', choices=pipelines.DUPLICATE_POLICIES, default=pipelines.DEFAULT_DUPLICATE_POLICY,
+                        help='what to do if an identical pipeline is active: allow both (default), skip triggering, '
+                        'supersede it (cancel it), or queue behind it')
+    parser.add_argument('--full', action='store_true', help='only for "index" action: index all datasets')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only for "index" action: index the datasets changed since the last indexed commit')
+    parser.add_argument('--max-datasets', type=int, default=indexing.DEFAULT_MAX_DATASETS,
+                        help='with --incremental: index all datasets if more datasets than this changed')
+    parser.add_argument('--gitlab-url', default='https://git.nomics.world', help='base URL of GitLab instance')
+    parser.add_argument('--max-in-flight', type=int, default=pipelines.DEFAULT_MAX_IN_FLIGHT,
+                        help='with many providers: maximum number of pipelines running at the same time')
+    parser.add_argument('--poll-interval', type=float, default=pipelines.DEFAULT_POLL_INTERVAL,
+                        help='with many providers or "--duplicates queue": '
+                        'seconds between checks of the status of running pipelines')
+    parser.add_argument('--ref', default='master', help='ref of fetcher repo (branch name) on which to start the job')
+    parser.add_argument('-v', '--verbose', action='store_true', help='display logging messages from debug level')
+    metrics.add_argument(parser)
+    if argv is None:
+        argv = sys.argv[1:]
+    remaining_args = []
+    if '--' in argv:
+        # Only parse arguments before the '--' separator
+        args = parser.parse_args(argv[:argv.index('--')])
+        # Arguments after '--' are saved in remaining_args variable
+        remaining_args = argv[argv.index('--') + 1:]
+    else:
+        args = parser.parse_args(argv)
+    metrics.setup(args.metrics, __file__)
+
+    logging.basicConfig(
+        format="%(levelname)s:%(name)s:%(asctime)s:%(message)s",
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        stream=sys.stdout,
+    )
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+    load_dotenv()
+
+    if not os.getenv('PRIVATE_TOKEN'):
+        log.error("Please set PRIVATE_TOKEN environment variable before using this tool! (see README.md)")
+        return 1
+
+    for provider_slug in args.provider_slugs:
+        if provider_slug != provider_slug.lower():
+            parser.error("provider_slug must be lowercase.")
+
+    if args.full and args.job_name != "index":
+        parser.error("--full is only allowed with \"index\" job.")
+
+    if args.incremental and args.job_name != "index":
+        parser.error("--incremental is only allowed with \"index\" job.")
+
+    if args.incremental and args.full:
+        parser.error("--incremental and --full are mutually exclusive.")
+
+    if args.follow and len(args.provider_slugs) > 1:
+        parser.error("--follow is only allowed with one provider.")
+
+    if args.max_in_flight < 1:
+        parser.error("--max-in-flight must be at least 1.")
+
+    if args.gitlab_url.endswith('/'):
+        args.gitlab_url = args.gitlab_url[:-1]
+
+    gl = client.make_gitlab(args.gitlab_url, private_token=os.getenv('PRIVATE_TOKEN'))
+
+    index = ProjectIndex(args.gitlab_url)
+
+    if len(args.provider_slugs) == 1:
+        provider_slug = args.provider_slugs[0]
+        try:
+            pipeline = trigger_job(gl, index, provider_slug, remaining_args)
+        except TriggerNotFound as exc:
+            log.error(exc)
+            return 1
+        except gitlab.GitlabCreateError:
+            log.exception("Hint: check that your PRIVATE_TOKEN env variable is correct !")
+            return 1
+        if pipeline is None:
+            print('Nothing to index for {}'.format(provider_slug))
+            return 0
+        print('Check job: {}'.format(get_repo_url(provider_slug) + '/-/jobs'))
+        if not args.follow:
+            return 0
+        pipeline = pipelines.follow_pipeline(gl, pipeline)
+        print('Pipeline {} finished: {}'.format(pipeline.id, pipeline.status))
+        return 0 if pipeline.status == "success" else 1
+
+    results = pipelines.run_with_limit(
+        lambda provider_slug: trigger_job(gl, index, provider_slug, remaining_args),
+        args.provider_slugs,
+        max_in_flight=args.max_in_flight,
+        poll_interval=args.poll_interval,
+    )
+    print(fleet.format_summary(results))
+    return 0 if all(result.ok for result in results) else 1
+
+
+def get_project_path(provider_slug):
+    """Return the path of the project running the job for a provider."""
+    if args.job_name in {"download", "convert"}:
+        return "{}/{}-fetcher".format(dbnomics_fetchers_namespace, provider_slug)
+    elif args.job_name == "validate":
+        return "{}/dbnomics-data-model".format(dbnomics_namespace)
+    else:
+        assert args.job_name == "index", args.job_name
+        return "{}/dbnomics-importer".format(dbnomics_namespace)
+
+
+def get_repo_url(provider_slug):
+    return '/'.join([args.gitlab_url, get_project_path(provider_slug)])
+
+
+def get_pipeline_variables(provider_slug, remaining_args):
+    if args.job_name in {"download", "convert"}:
+        pipeline_variables = {'JOB': args.job_name}
+        if remaining_args:
+            pipeline_variables['JOB_ARGS'] = " ".join(
+                '"{}"'.format(arg) if ' ' in arg else arg
+                for arg in remaining_args
+            )
+        return pipeline_variables
+    elif args.job_name == "validate":
+        return {'PROVIDER_SLUG': provider_slug}
+    else:
+        assert args.job_name == "index", args.job_name
+        return {
+            'FULL': "1" if args.full else "0",
+            'PROVIDER_SLUG': provider_slug,
+        }
+
+
+def get_json_data_path(provider_slug):
+    return "{}/{}-json-data".format(dbnomics_json_data_namespace, provider_slug)
+
+
+def get_incremental_index_variables(gl, index, provider_slug):
+    """Return the variables of the "index" job for the changed datasets of a provider.
+
+    Return `(variables, last_commit)`, like `indexing.get_index_variables`: `variables`
+    is None if no dataset changed since the last indexed commit.
+    """
+    return index.call_with_projects(
+        gl,
+        [get_json_data_path(provider_slug), get_project_path(provider_slug)],
+        lambda json_data_project, importer_project: indexing.get_index_variables(
+            json_data_project, importer_project, provider_slug, max_datasets=args.max_datasets),
+    )
+
+
+def trigger_job(gl, index, provider_slug, remaining_args):
+    """Trigger the pipeline running the job for a provider, and return it.
+
+    Return None if there is nothing to index, with --incremental.
+    Raise TriggerNotFound if the project does not have exactly one trigger.
+    """
+    if args.incremental:
+        pipeline_variables, last_commit = get_incremental_index_variables(gl, index, provider_slug)
+        if pipeline_variables is None:
+            return None
+    else:
+        pipeline_variables = get_pipeline_variables(provider_slug, remaining_args)
+    log.debug('Triggering pipeline for ref {!r} with variables {!r}'.format(args.ref, pipeline_variables))
+    pipeline = trigger_pipeline(gl, index, get_project_path(provider_slug), args.ref, pipeline_variables,
+                                duplicate_policy=args.duplicates, poll_interval=args.poll_interval)
+    if pipeline is None:
+        ci_settings_url = get_repo_url(provider_slug) + '/settings/ci_cd'
+        raise TriggerNotFound("Project should have one trigger. See {}".format(ci_settings_url))
+    log.debug('pipeline triggered for ref {!r} with variables {!r}'.format(args.ref, pipeline_variables))
+    if args.incremental:
+        # Next incremental runs read the last indexed commit from there.
+        index.call_with_projects(
+            gl,
+            [get_json_data_path(provider_slug)],
+            lambda json_data_project: indexing.record_index_pipeline(
+                json_data_project, pipeline.id, pipeline_variables[indexing.INDEXED_COMMIT_VARIABLE], last_commit),
+        )
+    return pipeline
+
+
+def trigger_pipeline(gl, index, project_path, ref, pipeline_variables, duplicate_policy='allow',
+                     poll_interval=pipelines.DEFAULT_POLL_INTERVAL):
+    """Trigger a pipeline of a project, using its trigger.
+
+    Project ID and trigger token are read from the project index: if GitLab answers 404
+    while they are used to list the duplicates and the triggers, they are refreshed and
+    listed again. Triggering the pipeline and cancelling duplicates are not repeated,
+    except after a 404 on the trigger request, which creates no pipeline.
+
+    Active pipelines having the same ref and variables are handled according to
+    `duplicate_policy`, one of `pipelines.DUPLICATE_POLICIES`.
+
+    Return the created pipeline (or the active one, when skipping), or None if the project
+    does not have exactly one trigger.
+    """
+    def resolve(project):
+        log.debug('project: {}'.format((project.path_with_namespace, project.id)))
+        duplicates = []
+        if duplicate_policy != 'allow':
+            duplicates = pipelines.find_duplicates(project, ref, pipeline_variables)
+        if duplicates and duplicate_policy == 'skip':
+            return (project, duplicates, None)
+        triggers = index.get_triggers(project)
+        if len(triggers) != 1:
+            # Indexed triggers may be outdated: list them again before giving up.
+            index.forget_triggers(project)
+            triggers = index.get_triggers(project)
+            if len(triggers) != 1:
+                return None
+        log.debug('trigger of {} fetched'.format(project.path_with_namespace))
+        return (project, duplicates, triggers[0].token)
+
+    for attempt in range(2):
+        resolved = index.call_with_projects(gl, [project_path], resolve)
+        if resolved is None:
+            return None
+        project, duplicates, token = resolved
+        if duplicates and duplicate_policy == 'skip':
+            log.info('Identical pipeline {} of {} is already active: not triggering another one'
+                     .format(duplicates[0].id, project_path))
+            return duplicates[0]
+        if duplicates and duplicate_policy == 'queue':
+            log.info('Waiting for identical pipelines of {} to finish: {}'.format(
+                project_path, ', '.join(str(pipeline.id) for pipeline in duplicates)))
+            pipelines.wait_for_pipelines(duplicates, poll_interval=poll_interval)
+        try:
+            pipeline = project.trigger_pipeline(ref, token, pipeline_variables)
+        except gitlab.GitlabError as exc:
+            if not is_not_found(exc) or attempt:
+                raise
+            # Outdated project ID or trigger token: no pipeline was created.
+            log.debug('Trigger of {} not found, refreshing it'.format(project_path))
+            index.forget_triggers(project)
+            index.forget(project_path)
+            continue
+        break
+
+    if duplicate_policy == 'supersede':
+        for duplicate in duplicates:
+            log.info('Cancelling pipeline {}, superseded by pipeline {}'.format(duplicate.id, pipeline.id))
+            try:
+                duplicate.cancel()
+            except gitlab.GitlabError as exc:
+                if not is_not_found(exc):
+                    raise
+                log.info('Pipeline {} is already gone'.format(duplicate.id))
+    return pipeline
+
+if __name__ == '__main__':
+    sys.exit(main())
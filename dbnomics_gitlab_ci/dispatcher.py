@@ -0,0 +1,397 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Receive the hooks of the JSON data repos, and trigger coalesced pipelines.
+
+Hooks configured with `configure --dispatcher-url` call the dispatcher instead of the
+trigger API of GitLab, with the same path and query string:
+
+    POST /projects/42/ref/master/trigger/pipeline?token=...&variables[PROVIDER_SLUG]=ecb
+
+Requests for the same project, ref and variables (that is the same provider and job)
+are coalesced: the pipeline is triggered once no other request came for `window`
+seconds, or `max_wait` seconds after the first one, so that a burst of pushes gives
+one pipeline. A pipeline is not triggered while another one for the same request is
+still active, nor while `max_per_project` pipelines triggered by the dispatcher are
+active in the target project: requests received meanwhile wait, coalesced. A
+pipeline whose status could not be read `max_refresh_failures` times in a row is
+not waited for anymore.
+
+When the server has a secret token, requests must send it in the `X-Gitlab-Token`
+header, like the hooks configured with `configure --dispatcher-token` do: requests
+without it are answered 401, with another token 403.
+"""
+
+import hmac
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import requests
+from gitlab.exceptions import GitlabError
+
+from .pipelines import is_active
+
+DEFAULT_WINDOW = 60
+DEFAULT_MAX_WAIT = 600
+DEFAULT_MAX_PER_PROJECT = 2
+DEFAULT_POLL_INTERVAL = 10
+DEFAULT_MAX_REFRESH_FAILURES = 5
+
+log = logging.getLogger(__name__)
+
+
+def parse_trigger_path(path):
+    """Return `(project_id, ref)` from the path of a trigger API request, or None.
+
+    The `/api/v4` prefix is optional.
+
+    >>> parse_trigger_path("/api/v4/projects/42/ref/master/trigger/pipeline")
+    ('42', 'master')
+    >>> parse_trigger_path("/projects/dbnomics%2Fimporter/ref/master/trigger/pipeline")
+    ('dbnomics/importer', 'master')
+    >>> parse_trigger_path("/projects/42/hooks") is None
+    True
+    """
+    parts = path.strip("/").split("/")
+    if parts[:2] == ["api", "v4"]:
+        parts = parts[2:]
+    if len(parts) != 6 or parts[0] != "projects" or parts[2] != "ref":
+        return None
+    if parts[4:] != ["trigger", "pipeline"]:
+        return None
+    return (unquote(parts[1]), unquote(parts[3]))
+
+
+def parse_trigger_query(query):
+    """Return `(token, variables)` from the query string of a trigger API request.
+
+    >>> parse_trigger_query("token=abc&variables[PROVIDER_SLUG]=ecb")
+    ('abc', {'PROVIDER_SLUG': 'ecb'})
+    """
+    token = None
+    variables = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        if key == "token":
+            token = value
+        elif key.startswith("variables[") and key.endswith("]"):
+            variables[key[len("variables[") : -1]] = value
+    return (token, variables)
+
+
+class PendingTrigger:
+    """Requests for the same pipeline, waiting to be dispatched."""
+
+    def __init__(self, project_id, ref, token, variables, now):
+        self.project_id = project_id
+        self.ref = ref
+        self.token = token
+        self.variables = variables
+        self.first_request = now
+        self.last_request = now
+        self.requests = 1
+
+    def due_time(self, window, max_wait):
+        return min(self.last_request + window, self.first_request + max_wait)
+
+    def __str__(self):
+        return "project {} ref {} {}".format(
+            self.project_id,
+            self.ref,
+            " ".join("{}={}".format(key, value) for key, value in self.variables),
+        )
+
+
+class Dispatcher:
+    """Coalesce trigger requests, and trigger their pipelines with `gl`.
+
+    Requests are added by `receive`, from any thread; `dispatch` triggers the
+    pipelines that are due and can start. `run` calls it in a loop.
+    """
+
+    def __init__(
+        self,
+        gl,
+        window=DEFAULT_WINDOW,
+        max_wait=DEFAULT_MAX_WAIT,
+        max_per_project=DEFAULT_MAX_PER_PROJECT,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        max_refresh_failures=DEFAULT_MAX_REFRESH_FAILURES,
+        clock=time.monotonic,
+    ):
+        self.gl = gl
+        self.window = window
+        self.max_wait = max_wait
+        self.max_per_project = max_per_project
+        self.poll_interval = poll_interval
+        self.max_refresh_failures = max_refresh_failures
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()  # (project ID, ref, variables) -> PendingTrigger
+        # Target project ID -> {(project ID, ref, variables): pipeline}
+        self.in_flight = defaultdict(dict)
+        self.last_poll = {}  # target project ID -> time
+        self.refresh_failures = {}  # pipeline ID -> consecutive failures
+        self.requests = 0
+        self.triggered = 0
+
+    def receive(self, project_id, ref, token, variables):
+        """Add a trigger request, returning the number of requests coalesced with it."""
+        key = (str(project_id), ref, tuple(sorted(variables.items())))
+        now = self.clock()
+        with self.lock:
+            self.requests += 1
+            pending = self.pending.get(key)
+            if pending is None:
+                self.pending[key] = PendingTrigger(*key[:2], token, key[2], now)
+                return 1
+            pending.last_request = now
+            pending.token = token
+            pending.requests += 1
+            return pending.requests
+
+    def status(self):
+        """Return counters describing the state of the dispatcher."""
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "triggered": self.triggered,
+                "pending": len(self.pending),
+                "in_flight": sum(
+                    len(pipelines) for pipelines in self.in_flight.values()
+                ),
+            }
+
+    def dispatch(self, force=False):
+        """Trigger the pipelines that are due, and return their number.
+
+        With `force`, pending requests are dispatched without waiting for the end of
+        their window, nor for the active pipelines.
+        """
+        now = self.clock()
+        with self.lock:
+            due = [
+                (key, pending)
+                for key, pending in self.pending.items()
+                if force or pending.due_time(self.window, self.max_wait) <= now
+            ]
+        triggered = 0
+        for key, pending in due:
+            if not force and not self._can_start(key, now):
+                continue
+            with self.lock:
+                # Requests received from now on will trigger another pipeline.
+                del self.pending[key]
+            if self._trigger(key, pending):
+                triggered += 1
+        return triggered
+
+    def _can_start(self, key, now):
+        project_id = key[0]
+        with self.lock:
+            in_flight = self.in_flight[project_id]
+        if key not in in_flight and len(in_flight) < self.max_per_project:
+            return True
+        # Active pipelines are polled only when they prevent a trigger.
+        if now - self.last_poll.get(project_id, float("-inf")) >= self.poll_interval:
+            self.last_poll[project_id] = now
+            self._refresh(project_id)
+        return key not in in_flight and len(in_flight) < self.max_per_project
+
+    def _refresh(self, project_id):
+        in_flight = self.in_flight[project_id]
+        for key, pipeline in list(in_flight.items()):
+            try:
+                pipeline.refresh()
+            except (GitlabError, requests.RequestException):
+                log.exception("Could not get pipeline {}".format(pipeline.id))
+                failures = self.refresh_failures.get(pipeline.id, 0) + 1
+                if failures < self.max_refresh_failures:
+                    self.refresh_failures[pipeline.id] = failures
+                    continue
+                log.warning(
+                    "Pipeline {} not waited for anymore: its status could not be "
+                    "read {} times".format(pipeline.id, failures)
+                )
+            else:
+                if is_active(pipeline):
+                    self.refresh_failures.pop(pipeline.id, None)
+                    continue
+                log.info(
+                    "Pipeline {} finished: {}".format(pipeline.id, pipeline.status)
+                )
+            self.refresh_failures.pop(pipeline.id, None)
+            with self.lock:
+                del in_flight[key]
+
+    def _trigger(self, key, pending):
+        project = self.gl.projects.get(pending.project_id, lazy=True)
+        try:
+            pipeline = project.trigger_pipeline(
+                pending.ref, pending.token, dict(pending.variables)
+            )
+        except (GitlabError, requests.RequestException) as exc:
+            response_code = getattr(exc, "response_code", None)
+            if response_code is not None and 400 <= response_code < 500:
+                log.error("Could not trigger pipeline of {}: {}".format(pending, exc))
+                return False
+            # Transient error (including connection errors and timeouts): retry with
+            # the requests received meanwhile.
+            log.exception("Could not trigger pipeline of {}".format(pending))
+            with self.lock:
+                retry = self.pending.setdefault(key, pending)
+                if retry is not pending:
+                    retry.first_request = pending.first_request
+                    retry.requests += pending.requests
+            return False
+        log.info(
+            "Pipeline {} triggered for {} ({} requests coalesced)".format(
+                pipeline.id, pending, pending.requests
+            )
+        )
+        with self.lock:
+            self.in_flight[key[0]][key] = pipeline
+            self.triggered += 1
+        return True
+
+    def run(self, stop, tick=1.0):
+        """Dispatch pipelines every `tick` seconds until the `stop` event is set.
+
+        Pending requests are then dispatched without waiting. An unexpected error is
+        logged, and does not stop the loop.
+        """
+        while not stop.wait(tick):
+            self._dispatch_logging_errors()
+        self._dispatch_logging_errors(force=True)
+
+    def _dispatch_logging_errors(self, force=False):
+        try:
+            self.dispatch(force=force)
+        except Exception:
+            log.exception("Could not dispatch pending requests")
+
+
+def check_token(secret_token, token):
+    """Return the HTTP status answering a request sending `token`, or None if allowed.
+
+    >>> check_token("s3cret", "s3cret") is None, check_token(None, None) is None
+    (True, True)
+    >>> check_token("s3cret", None), check_token("s3cret", "guess")
+    (401, 403)
+    """
+    if secret_token is None:
+        return None
+    if not token:
+        return 401
+    if not hmac.compare_digest(token.encode("utf-8"), secret_token.encode("utf-8")):
+        return 403
+    return None
+
+
+def make_handler(dispatcher, secret_token=None):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+        def do_GET(self):
+            if urlsplit(self.path).path.rstrip("/") == "/status":
+                self.send(200, dispatcher.status())
+                return
+            self.send(404, {"message": "404 Not Found"})
+
+        def do_POST(self):
+            # Read the body, sent by GitLab hooks, even if it is not used.
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                self.rfile.read(length)
+            denied = check_token(secret_token, self.headers.get("X-Gitlab-Token"))
+            if denied is not None:
+                self.send(denied, {"message": "Invalid X-Gitlab-Token header"})
+                return
+            split = urlsplit(self.path)
+            target = parse_trigger_path(split.path)
+            token, variables = parse_trigger_query(split.query)
+            if target is None or not token:
+                self.send(404, {"message": "404 Not Found"})
+                return
+            project_id, ref = target
+            requests = dispatcher.receive(project_id, ref, token, variables)
+            self.send(202, {"coalesced_requests": requests})
+
+        def send(self, status, data):
+            payload = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+
+class DispatcherServer:
+    """Serve a `Dispatcher` over HTTP, dispatching pipelines in background threads.
+
+    Use it as a context manager; `url` is the base URL to give to
+    `configure --dispatcher-url`, and `secret_token` the one to give to
+    `configure --dispatcher-token`. Pending requests are dispatched when it stops.
+    """
+
+    def __init__(
+        self, dispatcher, host="127.0.0.1", port=0, tick=1.0, secret_token=None
+    ):
+        self.dispatcher = dispatcher
+        self.tick = tick
+        self.httpd = ThreadingHTTPServer(
+            (host, port), make_handler(dispatcher, secret_token=secret_token)
+        )
+        self.httpd.daemon_threads = True
+        host, port = self.httpd.server_address[:2]
+        self.url = "http://{}:{}".format(host, port)
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def start(self):
+        self.threads = [
+            threading.Thread(target=self.httpd.serve_forever, daemon=True),
+            threading.Thread(
+                target=self.dispatcher.run, args=(self.stop_event, self.tick)
+            ),
+        ]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,432 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Local store of the durations of the pipelines and jobs, in a SQLite database.
+
+The pipelines of each project are synchronized incrementally: only those updated
+since the last synchronization are listed (`updated_after`), and the jobs of those
+which are finished are stored with their duration, queue time and status.
+
+Pipelines are listed by ID, which does not change when a pipeline is updated during
+the listing, so that no pipeline is skipped by the pagination. The listing starts
+`CHECKPOINT_OVERLAP` before the last update time seen by the previous one, to catch
+the pipelines updated while it ran; the pipelines already stored with the same update
+time are not requested again.
+
+Percentiles of the durations are computed from the store, per provider and job name,
+without requesting GitLab.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from .pagination import iter_all
+from .pipelines import ACTIVE_STATUSES, parse_datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    gitlab_url TEXT NOT NULL,
+    project_path TEXT NOT NULL,
+    updated_after TEXT NOT NULL,
+    PRIMARY KEY (gitlab_url, project_path)
+);
+CREATE TABLE IF NOT EXISTS pipelines (
+    gitlab_url TEXT NOT NULL,
+    pipeline_id INTEGER NOT NULL,
+    project_path TEXT NOT NULL,
+    provider_slug TEXT,
+    status TEXT NOT NULL,
+    ref TEXT,
+    source TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (gitlab_url, pipeline_id)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    gitlab_url TEXT NOT NULL,
+    job_id INTEGER NOT NULL,
+    pipeline_id INTEGER NOT NULL,
+    project_path TEXT NOT NULL,
+    provider_slug TEXT,
+    name TEXT NOT NULL,
+    stage TEXT,
+    status TEXT NOT NULL,
+    created_at TEXT,
+    started_at TEXT,
+    finished_at TEXT,
+    duration REAL,
+    queued_duration REAL,
+    PRIMARY KEY (gitlab_url, job_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (gitlab_url, finished_at);
+"""
+
+PERCENTILES = (50, 90, 95)
+
+CHECKPOINT_OVERLAP = timedelta(minutes=10)
+
+log = logging.getLogger(__name__)
+
+ProjectRuns = namedtuple("ProjectRuns", ["pipelines", "jobs", "checkpoint"])
+
+
+def get_default_path():
+    """Return the path of the database, in the user data directory."""
+    data_dir = os.getenv("XDG_DATA_HOME") or Path.home() / ".local" / "share"
+    return Path(data_dir) / "dbnomics-gitlab-ci" / "durations.sqlite"
+
+
+def format_datetime(value):
+    """Format a date-time like GitLab does.
+
+    >>> format_datetime(datetime(2020, 1, 31, 1, 0, 0, 123456, tzinfo=timezone.utc))
+    '2020-01-31T01:00:00.123Z'
+    """
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def fetch_project_runs(project, updated_after, provider_slug=None, known=None):
+    """Return the finished pipelines of `project` updated after `updated_after`.
+
+    Pipelines are returned with their jobs, as rows of the `pipelines` and `jobs`
+    tables (without the `gitlab_url` column), with the new checkpoint: the last
+    update time of the listed pipelines. `known` maps the IDs of pipelines already
+    stored to their update time: they are skipped unless updated since.
+
+    If `provider_slug` is None, it is read from the `PROVIDER_SLUG` variable of each
+    pipeline (one more API call per pipeline), as for the importer and data model
+    projects.
+    """
+    project_path = project.path_with_namespace
+    pipeline_rows = []
+    job_rows = []
+    known = known or {}
+    listed_ids = set()
+    checkpoint = updated_after
+    for pipeline in iter_all(
+        project.pipelines,
+        prefetch=True,
+        updated_after=updated_after,
+        order_by="id",
+        sort="asc",
+    ):
+        # A pipeline updated during the listing is listed twice if it was not
+        # matched by `updated_after` when the previous pages were requested.
+        if pipeline.id in listed_ids:
+            continue
+        listed_ids.add(pipeline.id)
+        attributes = pipeline.attributes
+        updated_at = attributes.get("updated_at")
+        if updated_at is not None and (checkpoint is None or updated_at > checkpoint):
+            checkpoint = updated_at
+        if pipeline.status in ACTIVE_STATUSES:
+            # It will be listed again when finished, being updated.
+            continue
+        if updated_at is not None and known.get(pipeline.id) == updated_at:
+            continue
+        pipeline_provider_slug = provider_slug
+        if pipeline_provider_slug is None:
+            variables = {
+                variable.key: variable.value
+                for variable in iter_all(pipeline.variables)
+            }
+            pipeline_provider_slug = variables.get("PROVIDER_SLUG")
+        pipeline_rows.append(
+            (
+                pipeline.id,
+                project_path,
+                pipeline_provider_slug,
+                pipeline.status,
+                attributes.get("ref"),
+                attributes.get("source"),
+                attributes.get("created_at"),
+                updated_at,
+            )
+        )
+        for job in iter_all(pipeline.jobs):
+            job_rows.append(
+                (
+                    job.id,
+                    pipeline.id,
+                    project_path,
+                    pipeline_provider_slug,
+                    job.name,
+                    job.attributes.get("stage"),
+                    job.status,
+                    job.attributes.get("created_at"),
+                    job.attributes.get("started_at"),
+                    job.attributes.get("finished_at"),
+                    job.attributes.get("duration"),
+                    _get_queued_duration(job.attributes),
+                )
+            )
+    return ProjectRuns(pipeline_rows, job_rows, checkpoint)
+
+
+def _get_queued_duration(attributes):
+    # Only recent GitLab versions return the queued duration.
+    queued_duration = attributes.get("queued_duration")
+    if queued_duration is not None:
+        return queued_duration
+    if attributes.get("created_at") and attributes.get("started_at"):
+        return (
+            parse_datetime(attributes["started_at"])
+            - parse_datetime(attributes["created_at"])
+        ).total_seconds()
+    return None
+
+
+class DurationStore:
+    """Durations of the pipelines and jobs of a GitLab instance.
+
+    It can be shared by threads: the SQLite connection is protected by a lock.
+    """
+
+    def __init__(self, gitlab_url, path=None):
+        self.gitlab_url = gitlab_url.rstrip("/")
+        self.lock = threading.Lock()
+        path = get_default_path() if path is None else path
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(
+            str(path), timeout=30, check_same_thread=False
+        )
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def get_checkpoint(self, project_path):
+        """Return the update time after which pipelines must be listed, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT updated_after FROM checkpoints "
+                "WHERE gitlab_url = ? AND project_path = ?",
+                (self.gitlab_url, project_path),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def get_updated_after(self, project_path, default):
+        """Return the update time after which the pipelines of a project are listed.
+
+        It is `CHECKPOINT_OVERLAP` before the checkpoint, or `default` if the project
+        was never synchronized.
+        """
+        checkpoint = self.get_checkpoint(project_path)
+        if checkpoint is None:
+            return default
+        return format_datetime(parse_datetime(checkpoint) - CHECKPOINT_OVERLAP)
+
+    def get_known_pipelines(self, project_path, updated_after):
+        """Return the update time of the pipelines stored after `updated_after`.
+
+        The result maps pipeline IDs to update times, to be given to
+        `fetch_project_runs`.
+        """
+        with self.lock:
+            return dict(
+                self.connection.execute(
+                    "SELECT pipeline_id, updated_at FROM pipelines "
+                    "WHERE gitlab_url = ? AND project_path = ? AND updated_at > ?",
+                    (self.gitlab_url, project_path, updated_after),
+                ).fetchall()
+            )
+
+    def save(self, project_path, project_runs):
+        """Store the pipelines and jobs of a project, then move its checkpoint."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO pipelines VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(self.gitlab_url,) + row for row in project_runs.pipelines],
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO jobs "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(self.gitlab_url,) + row for row in project_runs.jobs],
+            )
+            if project_runs.checkpoint is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)",
+                    (self.gitlab_url, project_path, project_runs.checkpoint),
+                )
+
+    def get_job_durations(self, finished_after, finished_before=None):
+        """Return the successful jobs finished in a period.
+
+        Jobs are returned as `(provider_slug, name, duration, queued_duration)`
+        tuples.
+        """
+        query = (
+            "SELECT provider_slug, name, duration, queued_duration FROM jobs "
+            "WHERE gitlab_url = ? AND status = 'success' AND duration IS NOT NULL "
+            "AND finished_at > ?"
+        )
+        params = [self.gitlab_url, format_datetime(finished_after)]
+        if finished_before is not None:
+            query += " AND finished_at <= ?"
+            params.append(format_datetime(finished_before))
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+
+def percentile(sorted_values, percent):
+    """Return a percentile of sorted values, interpolating linearly between them.
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2.5
+    >>> percentile([1, 2, 3, 4], 90)
+    3.7
+    >>> percentile([5], 95)
+    5
+    """
+    position = (len(sorted_values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = position - lower
+    if not fraction:
+        return sorted_values[lower]
+    return round(
+        sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction,
+        6,
+    )
+
+
+class DurationStats:
+    """Statistics of the durations of a group of jobs."""
+
+    def __init__(self, durations, queued_durations):
+        durations = sorted(durations)
+        queued_durations = sorted(queued_durations)
+        self.count = len(durations)
+        self.percentiles = {
+            percent: percentile(durations, percent) for percent in PERCENTILES
+        }
+        self.max = durations[-1]
+        self.queued_median = (
+            percentile(queued_durations, 50) if queued_durations else None
+        )
+
+
+def compute_stats(rows, by_provider=True):
+    """Return the `DurationStats` of jobs, grouped by provider and job name.
+
+    `rows` are returned by `DurationStore.get_job_durations`. Groups are keyed by
+    `(provider_slug, name)` tuples, or by `name` if `by_provider` is false.
+
+    >>> stats = compute_stats([("ecb", "download", 10, 1), ("ecb", "download", 20, 3)])
+    >>> stats[("ecb", "download")].percentiles[50], stats[("ecb", "download")].max
+    (15.0, 20)
+    """
+    groups = defaultdict(lambda: ([], []))
+    for provider_slug, name, duration, queued_duration in rows:
+        durations, queued_durations = groups[
+            (provider_slug, name) if by_provider else name
+        ]
+        durations.append(duration)
+        if queued_duration is not None:
+            queued_durations.append(queued_duration)
+    return {
+        key: DurationStats(durations, queued_durations)
+        for key, (durations, queued_durations) in groups.items()
+    }
+
+
+def format_report(stats, previous_stats=None):
+    """Return a table of `stats`, as a string, slowest median change first.
+
+    If `previous_stats` are given, the change of the median duration with the
+    previous period is displayed.
+    """
+    previous_stats = previous_stats or {}
+
+    def change(key):
+        previous = previous_stats.get(key)
+        if previous is None or not previous.percentiles[50]:
+            return None
+        return stats[key].percentiles[50] / previous.percentiles[50] - 1
+
+    def sort_key(key):
+        key_change = change(key)
+        return (key_change is None, -(key_change or 0), str(key))
+
+    lines = [
+        "{:<40} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+            "provider/job" if any(isinstance(key, tuple) for key in stats) else "job",
+            "count",
+            "p50",
+            "p90",
+            "p95",
+            "max",
+            "queue50",
+            "change",
+        )
+    ]
+    for key in sorted(stats, key=sort_key):
+        key_stats = stats[key]
+        key_change = change(key)
+        lines.append(
+            "{:<40} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+                "/".join(str(part) for part in key) if isinstance(key, tuple) else key,
+                key_stats.count,
+                *[
+                    format_duration(value)
+                    for value in (
+                        key_stats.percentiles[50],
+                        key_stats.percentiles[90],
+                        key_stats.percentiles[95],
+                        key_stats.max,
+                        key_stats.queued_median,
+                    )
+                ],
+                "" if key_change is None else "{:+.0%}".format(key_change)
+            )
+        )
+    return "\n".join(lines)
+
+
+def format_duration(seconds):
+    """Format a duration in seconds.
+
+    >>> format_duration(42.4), format_duration(125), format_duration(7300)
+    ('42s', '2m05s', '2h01m')
+    """
+    if seconds is None:
+        return ""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "{}s".format(seconds)
+    if seconds < 3600:
+        return "{}m{:02d}s".format(*divmod(seconds, 60))
+    return "{}h{:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+
+
+def get_period_bounds(days, now=None):
+    """Return the start of the current period and of the previous one.
+
+    >>> now = datetime(2020, 3, 1, tzinfo=timezone.utc)
+    >>> [bound.date().isoformat() for bound in get_period_bounds(30, now=now)]
+    ['2020-01-01', '2020-01-31']
+    """
+    now = datetime.now(timezone.utc) if now is None else now
+    start = now - timedelta(days=days)
+    return (start - timedelta(days=days), start)
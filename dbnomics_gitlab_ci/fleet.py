@@ -0,0 +1,142 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Run an operation for many providers at once, with a bounded pool of workers."""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .pagination import iter_all
+
+log = logging.getLogger(__name__)
+
+DEFAULT_JOBS = 8
+
+
+class ProviderResult:
+    """Outcome of an operation run for a provider."""
+
+    def __init__(
+        self, provider_slug, value=None, error=None, duration=0.0, resumed=False
+    ):
+        self.provider_slug = provider_slug
+        self.value = value
+        self.error = error
+        self.duration = duration
+        # True if the provider was done by a previous run, and skipped (see `journal`).
+        self.resumed = resumed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "ProviderResult({!r}, ok={!r})".format(self.provider_slug, self.ok)
+
+
+def run_for_providers(func, provider_slugs, jobs=DEFAULT_JOBS, journal=None):
+    """Call `func(provider_slug)` for each provider, at most `jobs` at once.
+
+    An exception raised for a provider is logged and recorded in its result:
+    it does not abort the other providers.
+
+    If a `journal.Journal` is given, the providers it records as done are skipped,
+    and the providers succeeding are recorded as done.
+
+    Return the results in the order of `provider_slugs`.
+    """
+
+    def run(provider_slug):
+        if journal is not None and journal.is_done(provider_slug):
+            log.debug("Provider {!r} already done".format(provider_slug))
+            return ProviderResult(provider_slug, resumed=True)
+        start = time.monotonic()
+        try:
+            value = func(provider_slug)
+        except Exception as exc:
+            log.exception("Provider {!r} failed".format(provider_slug))
+            return ProviderResult(
+                provider_slug, error=exc, duration=time.monotonic() - start
+            )
+        if journal is not None:
+            journal.finish(provider_slug)
+        return ProviderResult(
+            provider_slug, value=value, duration=time.monotonic() - start
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return list(executor.map(run, provider_slugs))
+
+
+def format_summary(results):
+    """Return a per-provider summary of `results`, as a string.
+
+    >>> print(format_summary([
+    ...     ProviderResult("ecb", duration=1.5),
+    ...     ProviderResult("imf", error=ValueError("boom"), duration=0.25),
+    ...     ProviderResult("insee", resumed=True),
+    ... ]))
+    OK      ecb (1.5s)
+    FAILED  imf (0.2s): ValueError: boom
+    DONE    insee (by a previous run)
+    2 succeeded, 1 failed (1 by a previous run)
+    """
+    lines = []
+    for result in results:
+        if result.resumed:
+            lines.append(
+                "{:<7} {} (by a previous run)".format("DONE", result.provider_slug)
+            )
+            continue
+        line = "{:<7} {} ({:.1f}s)".format(
+            "OK" if result.ok else "FAILED", result.provider_slug, result.duration
+        )
+        if not result.ok:
+            line += ": {}: {}".format(type(result.error).__name__, result.error)
+        lines.append(line)
+    failed_count = sum(1 for result in results if not result.ok)
+    resumed_count = sum(1 for result in results if result.resumed)
+    lines.append(
+        "{} succeeded, {} failed{}".format(
+            len(results) - failed_count,
+            failed_count,
+            " ({} by a previous run)".format(resumed_count) if resumed_count else "",
+        )
+    )
+    return "\n".join(lines)
+
+
+def list_provider_slugs(gl, namespace, suffix, index=None):
+    """Return the sorted slugs of the providers having a project in `namespace`.
+
+    Projects are named `{slug}{suffix}`. They are read from `index` if given (see
+    `dbnomics_gitlab_ci.project_index`), else listed from the API.
+
+    Example: `list_provider_slugs(gl, "dbnomics-fetchers", "-fetcher")`
+    """
+    if index is None:
+        group = gl.groups.get(namespace, lazy=True)
+        paths = [project.path for project in iter_all(group.projects, simple=True)]
+    else:
+        paths = [
+            path.rpartition("/")[2] for path in index.list_project_paths(gl, namespace)
+        ]
+    return sorted(path[: -len(suffix)] for path in paths if path.endswith(suffix))
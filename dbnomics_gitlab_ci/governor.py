@@ -0,0 +1,310 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Adapt the number of concurrent GitLab API requests to the load of the server.
+
+A `Governor` lets at most `limit` requests be in flight at once, and adjusts the limit
+from the responses, with additive increase and multiplicative decrease:
+
+- each successful request increases it by 1 / limit, that is by 1 for each round of
+  `limit` requests; until the first decrease, it is increased by 1 per successful
+  request instead, to reach the right limit quickly;
+- it is halved when GitLab is overloaded: 429, 502, 503 or 504 responses, connection
+  errors and timeouts, responses slower than `slow_latency` seconds, or
+  `RateLimit-Remaining` below a tenth of `RateLimit-Limit`. The responses to the
+  requests started before the last decrease do not decrease it again.
+
+When GitLab asks to wait, with a `Retry-After` header or `RateLimit-Remaining: 0` and
+`RateLimit-Reset`, no request is started until then.
+
+The limit is a budget of the token: the processes using the same token share it
+through a state file (see `get_default_state`), each one being allowed an even part
+of it, and a wait asked by GitLab applies to all of them.
+"""
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_INITIAL_CONCURRENCY = 4
+DEFAULT_SLOW_LATENCY = 10
+DEFAULT_SYNC_INTERVAL = 1.0
+
+DECREASE_FACTOR = 0.5
+LOW_REMAINING_RATIO = 0.1
+OVERLOAD_STATUS_CODES = frozenset([429, 502, 503, 504])
+
+# A process that did not synchronize its state for this number of seconds is
+# considered stopped, and its part of the budget is given back to the others.
+PROCESS_TIMEOUT = 10
+
+
+def parse_retry_after(value, now):
+    """Return the time given by a `Retry-After` header, or None if it is invalid.
+
+    >>> parse_retry_after("120", now=1000.0)
+    1120.0
+    >>> parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT", now=0)
+    1445412480.0
+    >>> parse_retry_after("soon", now=0) is None
+    True
+    """
+    try:
+        return now + float(value)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _int_header(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def assess(status_code, headers, latency, now, slow_latency=DEFAULT_SLOW_LATENCY):
+    """Return `(overloaded, resume_at)` from the response to a request.
+
+    `status_code` is None if no response was received. `resume_at` is the time before
+    which no request should be sent, or None.
+
+    >>> assess(200, {"RateLimit-Limit": "600", "RateLimit-Remaining": "500"}, 0.1, 0)
+    (False, None)
+    >>> assess(200, {"RateLimit-Limit": "600", "RateLimit-Remaining": "30"}, 0.1, 0)
+    (True, None)
+    >>> assess(429, {"Retry-After": "2"}, 0.1, now=1000.0)
+    (True, 1002.0)
+    >>> assess(200, {"RateLimit-Remaining": "0", "RateLimit-Reset": "1030"}, 0.1, 1000)
+    (True, 1030)
+    >>> assess(None, {}, 60, 0)
+    (True, None)
+    >>> assess(404, {}, 0.1, 0)
+    (False, None)
+    >>> assess(200, {}, 12, 0)
+    (True, None)
+    """
+    overloaded = (
+        status_code is None
+        or status_code in OVERLOAD_STATUS_CODES
+        or latency > slow_latency
+    )
+    resume_at = None
+    if "Retry-After" in headers:
+        resume_at = parse_retry_after(headers["Retry-After"], now)
+    remaining = _int_header(headers, "RateLimit-Remaining")
+    if remaining is not None:
+        limit = _int_header(headers, "RateLimit-Limit")
+        if remaining == 0 or (limit and remaining < limit * LOW_REMAINING_RATIO):
+            overloaded = True
+        if remaining == 0 and resume_at is None:
+            resume_at = _int_header(headers, "RateLimit-Reset")
+    if resume_at is not None and resume_at <= now:
+        resume_at = None
+    return (overloaded, resume_at)
+
+
+class MemoryState:
+    """State of a governor, not shared with other processes."""
+
+    def __init__(self):
+        self.data = {}
+
+    @contextlib.contextmanager
+    def transaction(self):
+        yield self.data
+
+
+class FileState:
+    """State of governors shared by processes, through a JSON file.
+
+    The file is locked with `flock` while it is read and written.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "r+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                data = json.loads(file.read() or "{}")
+            except ValueError:
+                data = {}
+            yield data
+            file.seek(0)
+            file.truncate()
+            file.write(json.dumps(data))
+
+
+def get_default_state(gitlab_url, private_token):
+    """Return the state shared by the processes using `private_token` on a GitLab.
+
+    It is stored in `~/.cache/dbnomics-gitlab-ci/governor/`, in a file named after a
+    hash of the token. A `MemoryState` is returned where files can't be locked.
+    """
+    if fcntl is None:
+        return MemoryState()
+    key = hashlib.sha256(
+        "{}\n{}".format(gitlab_url.rstrip("/"), private_token or "").encode("utf-8")
+    ).hexdigest()[:16]
+    cache_dir = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
+    try:
+        return FileState(
+            Path(cache_dir) / "dbnomics-gitlab-ci" / "governor" / (key + ".json")
+        )
+    except OSError as exc:
+        log.warning("Request budget not shared with other processes: {}".format(exc))
+        return MemoryState()
+
+
+class Governor:
+    """Limit the number of concurrent requests, adapting it to the load of GitLab.
+
+    Call `acquire` before sending a request, and `release` with its outcome. It can be
+    shared by threads; `state` is shared with the governors of other processes.
+    """
+
+    def __init__(
+        self,
+        state=None,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        initial_concurrency=DEFAULT_INITIAL_CONCURRENCY,
+        slow_latency=DEFAULT_SLOW_LATENCY,
+        sync_interval=DEFAULT_SYNC_INTERVAL,
+        clock=time.time,
+    ):
+        self.state = MemoryState() if state is None else state
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = min(initial_concurrency, max_concurrency)
+        self.slow_latency = slow_latency
+        self.sync_interval = sync_interval
+        self.clock = clock
+        self.key = "{}-{}".format(os.getpid(), id(self))
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.limit = float(self.initial_concurrency)  # shared by the processes
+        self.processes = 1
+        self.increase = 0.0  # not synchronized yet
+        self.last_sync = None
+        self.last_decrease = None
+        self.resume_at = None
+
+    @property
+    def allowed(self):
+        """Number of requests this process may have in flight."""
+        return max(1, int(self.limit / self.processes))
+
+    def acquire(self):
+        """Wait until a request can be sent, and return the time it starts."""
+        with self.condition:
+            while True:
+                now = self.clock()
+                if self.last_sync is None or now - self.last_sync >= self.sync_interval:
+                    self._sync(now)
+                if self.resume_at is not None and now < self.resume_at:
+                    self.condition.wait(min(self.resume_at - now, self.sync_interval))
+                elif self.in_flight < self.allowed:
+                    self.in_flight += 1
+                    return now
+                else:
+                    self.condition.wait(self.sync_interval)
+
+    def release(self, started, status_code, headers):
+        """Adapt the limit to the outcome of a request started at `started`.
+
+        `status_code` is None if no response was received.
+        """
+        now = self.clock()
+        overloaded, resume_at = assess(
+            status_code, headers, now - started, now, self.slow_latency
+        )
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded or resume_at is not None:
+                self._sync(
+                    now,
+                    decrease_since=started if overloaded else None,
+                    resume_at=resume_at,
+                )
+            elif status_code < 400:
+                increase = 1 if self.last_decrease is None else 1 / self.limit
+                increase = min(increase, self.max_concurrency - self.limit)
+                self.increase += increase
+                self.limit += increase
+            self.condition.notify_all()
+
+    def _sync(self, now, decrease_since=None, resume_at=None):
+        """Merge the state of this governor with the shared one."""
+        with self.state.transaction() as data:
+            processes = {
+                key: seen
+                for key, seen in data.get("processes", {}).items()
+                if now - seen < PROCESS_TIMEOUT
+            }
+            if not processes:
+                # Start again from the initial limit, as the load may have changed
+                # since the last process stopped.
+                data.pop("limit", None)
+                data.pop("last_decrease", None)
+            processes[self.key] = now
+            limit = data.get("limit", self.initial_concurrency) + self.increase
+            last_decrease = data.get("last_decrease")
+            if decrease_since is not None and (
+                last_decrease is None or last_decrease < decrease_since
+            ):
+                log.debug(
+                    "GitLab is overloaded, decreasing the concurrency limit from "
+                    "{:.1f}".format(limit)
+                )
+                limit *= DECREASE_FACTOR
+                last_decrease = now
+            if resume_at is not None and resume_at > (data.get("resume_at") or 0):
+                log.info("GitLab asked to wait {:.1f}s".format(resume_at - now))
+                data["resume_at"] = resume_at
+            data["limit"] = min(max(limit, 1.0), self.max_concurrency)
+            data["last_decrease"] = last_decrease
+            data["processes"] = processes
+        self.limit = data["limit"]
+        self.processes = len(processes)
+        self.last_decrease = last_decrease
+        self.resume_at = data.get("resume_at")
+        self.increase = 0.0
+        self.last_sync = now
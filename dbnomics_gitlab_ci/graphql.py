@@ -0,0 +1,229 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Read the CI objects of many projects at once, with the GitLab GraphQL API.
+
+Through the REST API, reading the pipelines of N projects costs at least N requests.
+The GraphQL API returns the fields of many projects in one request: projects are
+selected by full path, by batches of `DEFAULT_BATCH_SIZE`, and their nested
+connections (pipelines...) are read in the same query.
+
+Only the first page of a nested connection is read: projects having more items are
+marked as incomplete, and should be read with the REST API, like the objects that
+GraphQL does not expose (pipeline variables, hooks, deploy keys...).
+
+GraphQL is optional: `GraphQLUnavailable` is raised when the GitLab instance does
+not serve it, and the scripts fall back to the REST API.
+"""
+
+import logging
+import time
+from collections import namedtuple
+
+import requests
+
+from . import client
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+PIPELINE_FIELDS = "id iid status ref source createdAt updatedAt duration"
+
+ProjectPipelines = namedtuple(
+    "ProjectPipelines", ["project_id", "full_path", "pipelines", "complete"]
+)
+
+
+class GraphQLError(Exception):
+    """The GraphQL API answered errors."""
+
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+class GraphQLUnavailable(GraphQLError):
+    """The GitLab instance does not serve the GraphQL API."""
+
+
+def parse_global_id(global_id):
+    """Return the numeric ID of a GraphQL global ID.
+
+    >>> parse_global_id("gid://gitlab/Ci::Pipeline/123")
+    123
+    """
+    return int(global_id.rpartition("/")[2])
+
+
+def execute(gl, query, variables=None, max_retries=client.DEFAULT_MAX_RETRIES):
+    """Run a GraphQL query with the session of `gl`, and return its data.
+
+    Requests answered "429 Too Many Requests" are retried after the delay given by
+    the Retry-After header; transient errors are retried by the session.
+    """
+    url = gl.url + "/api/graphql"
+    for attempt in range(max_retries + 1):
+        try:
+            response = gl.session.post(
+                url,
+                json={"query": query, "variables": variables or {}},
+                headers=gl.headers,
+                timeout=gl.timeout,
+            )
+        except requests.RequestException as exc:
+            raise GraphQLUnavailable("Could not request {}: {}".format(url, exc))
+        if response.status_code != 429 or attempt == max_retries:
+            break
+        time.sleep(float(response.headers.get("Retry-After") or 2**attempt))
+    if response.status_code in {404, 405}:
+        raise GraphQLUnavailable("{} answered {}".format(url, response.status_code))
+    try:
+        payload = response.json()
+    except ValueError:
+        raise GraphQLError(
+            "{} answered {}: {}".format(url, response.status_code, response.text[:200])
+        )
+    errors = payload.get("errors")
+    if errors or response.status_code != 200:
+        raise GraphQLError(
+            "; ".join(error.get("message", str(error)) for error in errors or [])
+            or "{} answered {}".format(url, response.status_code),
+            errors,
+        )
+    return payload["data"]
+
+
+def iter_projects(
+    gl, full_paths, fields, variables=None, batch_size=DEFAULT_BATCH_SIZE
+):
+    """Yield the project nodes of `full_paths`, with their `id`, `fullPath` and `fields`.
+
+    `fields` is a GraphQL selection, using `variables` if needed. Projects that do
+    not exist, or that the token cannot read, are not yielded.
+    """
+    full_paths = list(full_paths)
+    query = """
+query projects($fullPaths: [String!], $first: Int, $after: String{declarations}) {{
+  projects(fullPaths: $fullPaths, first: $first, after: $after) {{
+    pageInfo {{ hasNextPage endCursor }}
+    nodes {{ id fullPath {fields} }}
+  }}
+}}""".format(
+        declarations="".join(
+            ", ${}: {}".format(name, type_)
+            for name, (type_, _) in (variables or {}).items()
+        ),
+        fields=fields,
+    )
+    values = {name: value for name, (_, value) in (variables or {}).items()}
+    for start in range(0, len(full_paths), batch_size):
+        batch = full_paths[start : start + batch_size]
+        after = None
+        while True:
+            data = execute(
+                gl,
+                query,
+                dict(values, fullPaths=batch, first=len(batch), after=after),
+            )
+            connection = data["projects"]
+            yield from connection["nodes"]
+            if not connection["pageInfo"]["hasNextPage"]:
+                break
+            after = connection["pageInfo"]["endCursor"]
+
+
+def to_rest_pipeline(node, project_id):
+    """Return a GraphQL pipeline node with the attributes of the REST API."""
+    return {
+        "id": parse_global_id(node["id"]),
+        "iid": int(node["iid"]),
+        "project_id": project_id,
+        "status": node["status"].lower(),
+        "ref": node["ref"],
+        "source": node["source"].lower() if node.get("source") else None,
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+        "duration": node["duration"],
+    }
+
+
+def list_pipelines(
+    gl,
+    full_paths,
+    statuses=None,
+    ref=None,
+    source=None,
+    per_project=MAX_PAGE_SIZE,
+    batch_size=DEFAULT_BATCH_SIZE,
+):
+    """Return the last pipelines of projects, as `ProjectPipelines` by full path.
+
+    Pipelines can be filtered by `statuses` (for example `["running", "pending"]`),
+    `ref` and `source`. At most `per_project` pipelines are read by status: if a
+    project has more, its `complete` attribute is False.
+
+    Pipelines are dicts having the attributes of the REST API, sorted from the most
+    recent one; `duration` is also set.
+    """
+    aliases = ["pipelines"] if not statuses else list(statuses)
+    fields = " ".join(
+        "{alias}: pipelines({status}ref: $ref, source: $source, first: $perProject) "
+        "{{ pageInfo {{ hasNextPage }} nodes {{ {fields} }} }}".format(
+            alias=alias,
+            status="" if not statuses else "status: {}, ".format(alias.upper()),
+            fields=PIPELINE_FIELDS,
+        )
+        for alias in aliases
+    )
+    projects = {}
+    for node in iter_projects(
+        gl,
+        full_paths,
+        fields,
+        variables={
+            "ref": ("String", ref),
+            "source": ("String", source),
+            "perProject": ("Int", min(per_project, MAX_PAGE_SIZE)),
+        },
+        batch_size=batch_size,
+    ):
+        project_id = parse_global_id(node["id"])
+        pipelines = [
+            to_rest_pipeline(pipeline, project_id)
+            for alias in aliases
+            for pipeline in node[alias]["nodes"]
+        ]
+        projects[node["fullPath"]] = ProjectPipelines(
+            project_id=project_id,
+            full_path=node["fullPath"],
+            pipelines=sorted(pipelines, key=lambda pipeline: -pipeline["id"]),
+            complete=not any(
+                node[alias]["pageInfo"]["hasNextPage"] for alias in aliases
+            ),
+        )
+    log.debug(
+        "Pipelines of {} projects read with GraphQL, {} incomplete".format(
+            len(projects),
+            sum(1 for project in projects.values() if not project.complete),
+        )
+    )
+    return projects
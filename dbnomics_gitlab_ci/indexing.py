@@ -0,0 +1,276 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Compute the variables of incremental indexation pipelines.
+
+The JSON data repo of a provider has a directory per dataset. An incremental
+indexation pipeline of the importer receives the codes of the datasets changed since
+the last indexed commit, in the `DATASETS` variable (separated by spaces), and the
+commit it indexes, in the `JSON_DATA_COMMIT` variable.
+
+Each triggered pipeline is recorded in the `DBNOMICS_INDEX_PIPELINE` variable of the
+JSON data repo, with the commit it indexes and the last commit indexed before it (see
+`record_index_pipeline`): the last indexed commit is read from there with two requests,
+one for the variable and one for the status of the pipeline. When it is not recorded,
+it is read from the variables of the last successful importer pipeline of the provider
+having `JSON_DATA_COMMIT`, one request per pipeline.
+
+The changed datasets are the directories having a changed file between the last
+indexed commit and the head of the JSON data repo, according to the repository
+compare API. Full indexation is used instead when the last indexed commit is not
+found, when a file outside of the dataset directories changed, or when too many
+datasets changed.
+"""
+
+import logging
+
+from gitlab.exceptions import GitlabError, GitlabGetError, GitlabUpdateError
+
+from .pagination import iter_all
+
+log = logging.getLogger(__name__)
+
+DATASETS_VARIABLE = "DATASETS"
+INDEXED_COMMIT_VARIABLE = "JSON_DATA_COMMIT"
+INDEX_PIPELINE_VARIABLE = "DBNOMICS_INDEX_PIPELINE"
+
+# Above this number of changed datasets, a full indexation is triggered.
+DEFAULT_MAX_DATASETS = 100
+
+# Number of successful importer pipelines whose variables are read, at most, to find
+# the last indexed commit of a provider when it is not recorded (one request each).
+DEFAULT_MAX_PIPELINES = 100
+
+# GitLab stops listing the diffs of a comparison after this number of files.
+MAX_COMPARE_DIFFS = 1000
+
+
+def format_index_pipeline(pipeline_id, commit, last_commit):
+    """Return the value of the variable recording an indexation pipeline.
+
+    >>> format_index_pipeline(12, "b" * 8, "a" * 8)
+    '12 bbbbbbbb aaaaaaaa'
+    >>> parse_index_pipeline(format_index_pipeline(12, "b" * 8, None))
+    (12, 'bbbbbbbb', None)
+    """
+    return " ".join([str(pipeline_id), commit, last_commit or ""]).rstrip()
+
+
+def parse_index_pipeline(value):
+    """Return `(pipeline_id, commit, last_commit)` from a variable value, or None."""
+    parts = value.split()
+    if len(parts) not in {2, 3} or not parts[0].isdigit():
+        return None
+    return (int(parts[0]), parts[1], parts[2] if len(parts) == 3 else None)
+
+
+def read_recorded_commit(json_data_project, importer_project):
+    """Return the last indexed commit recorded in the JSON data repo, or None.
+
+    It is the commit indexed by the recorded pipeline if it succeeded, otherwise the
+    commit indexed before it.
+    """
+    try:
+        variable = json_data_project.variables.get(INDEX_PIPELINE_VARIABLE)
+    except GitlabGetError as exc:
+        if exc.response_code not in {403, 404}:
+            raise
+        return None
+    recorded = parse_index_pipeline(variable.value)
+    if recorded is None:
+        return None
+    pipeline_id, commit, last_commit = recorded
+    try:
+        pipeline = importer_project.pipelines.get(pipeline_id)
+    except GitlabGetError as exc:
+        if exc.response_code != 404:
+            raise
+        return last_commit
+    return commit if pipeline.status == "success" else last_commit
+
+
+def record_index_pipeline(json_data_project, pipeline_id, commit, last_commit):
+    """Record an indexation pipeline in the JSON data repo, for `read_recorded_commit`.
+
+    `last_commit` is the commit indexed before `commit`, or None. Failures are logged:
+    the last indexed commit is then found from the importer pipelines.
+    """
+    data = {"value": format_index_pipeline(pipeline_id, commit, last_commit)}
+    try:
+        try:
+            json_data_project.variables.update(INDEX_PIPELINE_VARIABLE, data)
+        except GitlabUpdateError as exc:
+            if exc.response_code != 404:
+                raise
+            json_data_project.variables.create(dict(data, key=INDEX_PIPELINE_VARIABLE))
+    except GitlabError as exc:
+        log.warning(
+            "Could not record indexation pipeline {}: {}".format(pipeline_id, exc)
+        )
+
+
+def find_last_indexed_commit(
+    importer_project, provider_slug, ref="master", max_pipelines=DEFAULT_MAX_PIPELINES
+):
+    """Return the JSON data commit indexed by the last successful pipeline.
+
+    Only the successful pipelines started by a trigger are listed, most recent first.
+    Return None if none of the first `max_pipelines` has the variables of the provider.
+    """
+    pipelines = iter_all(
+        importer_project.pipelines,
+        per_page=max_pipelines,
+        status="success",
+        ref=ref,
+        source="trigger",
+        order_by="id",
+        sort="desc",
+    )
+    for count, pipeline in enumerate(pipelines, start=1):
+        variables = {
+            variable.key: variable.value for variable in iter_all(pipeline.variables)
+        }
+        if variables.get("PROVIDER_SLUG") == provider_slug and variables.get(
+            INDEXED_COMMIT_VARIABLE
+        ):
+            return variables[INDEXED_COMMIT_VARIABLE]
+        if count >= max_pipelines:
+            break
+    return None
+
+
+def get_changed_datasets(diffs):
+    """Return the sorted codes of the datasets changed by `diffs`, or None.
+
+    `diffs` are returned by the repository compare API. Return None if a file outside
+    of the dataset directories changed; hidden files are ignored.
+
+    >>> get_changed_datasets([
+    ...     {"old_path": "ds2/series.jsonl", "new_path": "ds2/series.jsonl"},
+    ...     {"old_path": "ds1/dataset.json", "new_path": "ds3/dataset.json"},
+    ... ])
+    ['ds1', 'ds2', 'ds3']
+    >>> get_changed_datasets([{"old_path": ".gitignore", "new_path": ".gitignore"}])
+    []
+    >>> get_changed_datasets([{"old_path": "a.json", "new_path": "a.json"}]) is None
+    True
+    """
+    datasets = set()
+    for diff in diffs:
+        for path in {diff["old_path"], diff["new_path"]}:
+            if path.startswith("."):
+                continue
+            dataset_code, sep, _ = path.partition("/")
+            if not sep:
+                return None
+            datasets.add(dataset_code)
+    return sorted(datasets)
+
+
+def get_index_variables(
+    json_data_project,
+    importer_project,
+    provider_slug,
+    ref="master",
+    max_datasets=DEFAULT_MAX_DATASETS,
+    max_pipelines=DEFAULT_MAX_PIPELINES,
+):
+    """Return the variables of an incremental indexation pipeline for a provider.
+
+    Return `(variables, last_commit)`, `last_commit` being the last indexed commit, or
+    None if it is not found. `variables` is None if no dataset changed since the last
+    indexed commit. The variables ask for a full indexation if the changed datasets
+    can't be used (see the module documentation).
+    """
+    head = json_data_project.branches.get(ref).commit["id"]
+    last_commit = read_recorded_commit(
+        json_data_project, importer_project
+    ) or find_last_indexed_commit(
+        importer_project, provider_slug, max_pipelines=max_pipelines
+    )
+    return (
+        _get_index_variables(
+            json_data_project, provider_slug, head, last_commit, max_datasets
+        ),
+        last_commit,
+    )
+
+
+def _get_index_variables(
+    json_data_project, provider_slug, head, last_commit, max_datasets
+):
+    variables = {
+        "FULL": "1",
+        "PROVIDER_SLUG": provider_slug,
+        INDEXED_COMMIT_VARIABLE: head,
+    }
+    if last_commit is None:
+        log.info(
+            "No indexed commit found for {!r}: full indexation".format(provider_slug)
+        )
+        return variables
+    if last_commit == head:
+        log.info("Commit {} of {!r} is already indexed".format(head, provider_slug))
+        return None
+
+    try:
+        comparison = json_data_project.repository_compare(last_commit, head)
+    except GitlabGetError as exc:
+        if exc.response_code != 404:
+            raise
+        # The indexed commit was removed from the repository, by a force push.
+        log.info(
+            "Indexed commit {} of {!r} not found: full indexation".format(
+                last_commit, provider_slug
+            )
+        )
+        return variables
+    diffs = comparison["diffs"]
+    if comparison.get("compare_timeout") or len(diffs) >= MAX_COMPARE_DIFFS:
+        log.info("Too many changes for {!r}: full indexation".format(provider_slug))
+        return variables
+    datasets = get_changed_datasets(diffs)
+    if datasets is None:
+        log.info(
+            "Files outside of datasets changed for {!r}: full indexation".format(
+                provider_slug
+            )
+        )
+        return variables
+    if not datasets:
+        log.info(
+            "No dataset of {!r} changed since {}".format(provider_slug, last_commit)
+        )
+        return None
+    if len(datasets) > max_datasets:
+        log.info(
+            "{} datasets of {!r} changed: full indexation".format(
+                len(datasets), provider_slug
+            )
+        )
+        return variables
+    log.info(
+        "{} datasets of {!r} changed since {}".format(
+            len(datasets), provider_slug, last_commit
+        )
+    )
+    variables["FULL"] = "0"
+    variables[DATASETS_VARIABLE] = " ".join(datasets)
+    return variables
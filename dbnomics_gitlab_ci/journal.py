@@ -0,0 +1,211 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Journal of the steps done by a run of a command for many providers.
+
+Each step done for a provider (deploy key created, hook created...) is appended to a
+JSON lines file as soon as it is done, then a last step marks the provider as done.
+A run given `--resume` reads the journal of the previous run of the same command,
+and skips the providers that are done (see `fleet.run_for_providers`). For the other
+providers, commands skip the steps that are done, or do not plan them again because
+their plan is built from the live state of the projects.
+
+Journals are stored in `~/.local/share/dbnomics-gitlab-ci/journals/`, one per command.
+A journal written for another GitLab instance is ignored. The options changing what a
+run does are recorded in the journal (see `run_arguments`): a run can't be resumed
+with other values.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+DONE_STEP = "done"
+
+
+class JournalError(Exception):
+    pass
+
+
+def get_default_path(command):
+    """Return the path of the journal of `command`, in the user data directory."""
+    data_dir = os.getenv("XDG_DATA_HOME") or Path.home() / ".local" / "share"
+    return Path(data_dir) / "dbnomics-gitlab-ci" / "journals" / (command + ".jsonl")
+
+
+def add_arguments(parser):
+    """Add the `--resume` and `--journal` options to an `argparse` parser."""
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the previous run where it stopped, skipping the steps and "
+        "the providers it finished",
+    )
+    parser.add_argument(
+        "--journal",
+        metavar="PATH",
+        help="file recording the finished steps, to be read by --resume "
+        "(default: one per command in ~/.local/share/dbnomics-gitlab-ci/journals/)",
+    )
+
+
+def run_arguments(args, names, secret_names=()):
+    """Return the values of the options `names` of `args`, to be given to `Journal`.
+
+    Values must be serializable to JSON. The options of `secret_names` are replaced
+    by a hash of their value.
+
+    >>> from argparse import Namespace
+    >>> run_arguments(Namespace(key_type="rsa", token=None), ["key_type"], ["token"])
+    {'key_type': 'rsa', 'token': None}
+    """
+    arguments = {name: getattr(args, name) for name in names}
+    for name in secret_names:
+        value = getattr(args, name)
+        arguments[name] = (
+            None
+            if value is None
+            else hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+        )
+    return arguments
+
+
+def open_journal(args, command, gitlab_url, arguments=None):
+    """Return the `Journal` given by the `--resume` and `--journal` options.
+
+    Raise `JournalError` if the previous run can't be resumed with `arguments`.
+    """
+    path = get_default_path(command) if args.journal is None else Path(args.journal)
+    return Journal(path, gitlab_url, resume=args.resume, arguments=arguments)
+
+
+class Journal:
+    """Steps done for each provider, appended to a JSON lines file.
+
+    Unless `resume` is true, the previous journal is replaced. `arguments` are the
+    options of the run (see `run_arguments`): resuming a journal written with other
+    ones raises `JournalError`. It can be shared by threads.
+    """
+
+    def __init__(self, path, gitlab_url, resume=False, arguments=None):
+        self.path = Path(path)
+        self.gitlab_url = gitlab_url.rstrip("/")
+        # Compared with the arguments read from the journal, as JSON.
+        self.arguments = json.loads(json.dumps(arguments or {}))
+        self.lock = threading.Lock()
+        self.steps = defaultdict(set)  # provider slug -> steps done
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if resume and self._load():
+            self.file = self.path.open("a")
+        else:
+            self.file = self.path.open("w")
+            self._write(
+                {
+                    "gitlab_url": self.gitlab_url,
+                    "started_at": time.time(),
+                    "arguments": self.arguments,
+                }
+            )
+
+    def _load(self):
+        """Read the steps of the journal, returning whether it can be resumed."""
+        try:
+            lines = self.path.read_text().splitlines()
+        except FileNotFoundError:
+            log.warning("No journal {} to resume from".format(self.path))
+            return False
+        for line_number, line in enumerate(lines, start=1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be truncated, if the run was killed while writing.
+                log.warning("Ignoring line {} of {}".format(line_number, self.path))
+                continue
+            if "gitlab_url" in record and record["gitlab_url"] != self.gitlab_url:
+                log.warning(
+                    "Ignoring journal {} of another GitLab instance: {}".format(
+                        self.path, record["gitlab_url"]
+                    )
+                )
+                self.steps.clear()
+                return False
+            if "gitlab_url" in record:
+                self._check_arguments(record.get("arguments", {}))
+            if "provider_slug" in record:
+                self.steps[record["provider_slug"]].add(record["step"])
+        log.info(
+            "Resuming from {}: {} providers done".format(
+                self.path, sum(1 for slug in self.steps if self.is_done(slug))
+            )
+        )
+        return True
+
+    def _check_arguments(self, arguments):
+        changed = sorted(
+            name
+            for name in set(arguments) | set(self.arguments)
+            if arguments.get(name) != self.arguments.get(name)
+        )
+        if changed:
+            raise JournalError(
+                "Can't resume from {}: it was written with other values of {}".format(
+                    self.path,
+                    ", ".join("--" + name.replace("_", "-") for name in changed),
+                )
+            )
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, provider_slug, step):
+        """Record that `step` is done for a provider."""
+        with self.lock:
+            self.steps[provider_slug].add(step)
+            self._write(
+                {"provider_slug": provider_slug, "step": step, "time": time.time()}
+            )
+
+    def finish(self, provider_slug):
+        """Record that all the steps of a provider are done."""
+        self.record(provider_slug, DONE_STEP)
+
+    def is_done(self, provider_slug):
+        return DONE_STEP in self.steps.get(provider_slug, ())
+
+    def is_step_done(self, provider_slug, step):
+        return step in self.steps.get(provider_slug, ())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,291 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Metrics of the API calls and of the slow local steps of a script run.
+
+Metrics are disabled by default. When a script is given `--metrics PATH` (see
+`add_argument` and `setup`), each HTTP request sent by the GitLab client (see
+`dbnomics_gitlab_ci.client`) is recorded by endpoint: count, latency histogram,
+response bytes and status. Local steps are timed with `timer`. At exit, the metrics
+are written to `PATH.json` and to `PATH.prom`, a Prometheus textfile.
+
+Endpoints are URL paths where IDs are replaced by placeholders, for example
+`GET /projects/:id/hooks`, so that the requests of all the providers are aggregated.
+"""
+
+import atexit
+import json
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlsplit
+
+# Upper bounds of the buckets of the latency histograms, in seconds.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+PROMETHEUS_PREFIX = "dbnomics_gitlab_ci"
+
+log = logging.getLogger(__name__)
+
+registry = None
+
+
+class EndpointMetrics:
+    """Metrics of the requests sent to an endpoint."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.statuses = defaultdict(int)
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def record(self, status, seconds, size):
+        self.count += 1
+        self.seconds += seconds
+        self.bytes += size
+        self.statuses[status] += 1
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+
+
+class Registry:
+    """Metrics recorded during a script run. It can be shared by threads."""
+
+    def __init__(self, script):
+        self.script = script
+        self.started_at = time.time()
+        self._start = time.monotonic()
+        self.lock = threading.Lock()
+        self.endpoints = defaultdict(EndpointMetrics)  # (method, endpoint) -> metrics
+        self.steps = defaultdict(lambda: [0, 0.0])  # name -> [count, seconds]
+
+    def record_request(self, method, url, status, seconds, size):
+        key = (method, get_endpoint(url))
+        with self.lock:
+            self.endpoints[key].record(status, seconds, size)
+
+    def record_step(self, name, seconds):
+        with self.lock:
+            step = self.steps[name]
+            step[0] += 1
+            step[1] += seconds
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "script": self.script,
+                "started_at": self.started_at,
+                "duration": time.monotonic() - self._start,
+                "requests": [
+                    {
+                        "method": method,
+                        "endpoint": endpoint,
+                        "count": metrics.count,
+                        "seconds": metrics.seconds,
+                        "bytes": metrics.bytes,
+                        "statuses": {
+                            str(status): count
+                            for status, count in sorted(metrics.statuses.items())
+                        },
+                        "latency_buckets": dict(
+                            zip(map(str, LATENCY_BUCKETS), metrics.buckets)
+                        ),
+                    }
+                    for (method, endpoint), metrics in sorted(self.endpoints.items())
+                ],
+                "steps": [
+                    {"name": name, "count": count, "seconds": seconds}
+                    for name, (count, seconds) in sorted(self.steps.items())
+                ],
+            }
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text format."""
+        data = self.to_json()
+        script = {"script": data["script"]}
+        lines = []
+
+        def add(name, kind, help, samples):
+            name = "{}_{}".format(PROMETHEUS_PREFIX, name)
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append(
+                    "{}{}{{{}}} {}".format(
+                        name,
+                        suffix,
+                        ",".join(
+                            '{}="{}"'.format(key, _escape_label(value))
+                            for key, value in dict(script, **labels).items()
+                        ),
+                        value,
+                    )
+                )
+
+        requests = data["requests"]
+        add(
+            "requests_total",
+            "counter",
+            "GitLab API requests, by endpoint and status.",
+            [
+                (
+                    "",
+                    {"method": r["method"], "endpoint": r["endpoint"], "status": s},
+                    count,
+                )
+                for r in requests
+                for s, count in r["statuses"].items()
+            ],
+        )
+        histogram_samples = []
+        for r in requests:
+            labels = {"method": r["method"], "endpoint": r["endpoint"]}
+            for bound, count in r["latency_buckets"].items():
+                histogram_samples.append(("_bucket", dict(labels, le=bound), count))
+            histogram_samples += [
+                ("_bucket", dict(labels, le="+Inf"), r["count"]),
+                ("_sum", labels, r["seconds"]),
+                ("_count", labels, r["count"]),
+            ]
+        add(
+            "request_duration_seconds",
+            "histogram",
+            "Duration of the GitLab API requests, retries included.",
+            histogram_samples,
+        )
+        add(
+            "response_bytes_total",
+            "counter",
+            "Size of the bodies of the GitLab API responses.",
+            [
+                ("", {"method": r["method"], "endpoint": r["endpoint"]}, r["bytes"])
+                for r in requests
+            ],
+        )
+        step_samples = []
+        for step in data["steps"]:
+            labels = {"step": step["name"]}
+            step_samples += [
+                ("_sum", labels, step["seconds"]),
+                ("_count", labels, step["count"]),
+            ]
+        add(
+            "step_duration_seconds",
+            "summary",
+            "Duration of the local steps.",
+            step_samples,
+        )
+        add(
+            "run_duration_seconds",
+            "gauge",
+            "Duration of the script run.",
+            [("", {}, data["duration"])],
+        )
+        add(
+            "run_timestamp_seconds",
+            "gauge",
+            "Start time of the script run.",
+            [("", {}, data["started_at"])],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the metrics to `path` with the ".json" and ".prom" suffixes."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        json_path = path.with_name(path.name + ".json")
+        json_path.write_text(json.dumps(self.to_json(), indent=2) + "\n")
+        # Write then rename, so that Prometheus never reads a partial file.
+        prom_path = path.with_name(path.name + ".prom")
+        tmp_path = path.with_name(path.name + ".prom.tmp")
+        tmp_path.write_text(self.to_prometheus())
+        tmp_path.replace(prom_path)
+        log.debug("Metrics written to {} and {}".format(json_path, prom_path))
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def get_endpoint(url):
+    """Return the endpoint of an API URL, without IDs.
+
+    >>> get_endpoint("https://gitlab.example.com/api/v4/projects/12/hooks/3")
+    '/projects/:id/hooks/:id'
+    >>> get_endpoint("http://localhost/api/v4/projects/dbnomics%2Fimporter?page=2")
+    '/projects/:id'
+    >>> get_endpoint("http://localhost/api/v4/projects/1/variables/SSH_PRIVATE_KEY")
+    '/projects/:id/variables/:key'
+    >>> get_endpoint("http://localhost/api/v4/groups/dbnomics-fetchers/projects")
+    '/groups/:id/projects'
+    """
+    path = urlsplit(url).path
+    path = re.sub(r"^.*?/api/v4(?=/)", "", path)
+    parts = path.split("/")
+    for index in range(1, len(parts)):
+        previous = parts[index - 1]
+        if previous in {"projects", "groups", "users"} or parts[index].isdigit():
+            parts[index] = ":id"
+        elif previous in {"variables", "branches"}:
+            parts[index] = ":key"
+    return "/".join(parts)
+
+
+def add_argument(parser):
+    """Add the `--metrics` option to an `argparse` parser."""
+    parser.add_argument(
+        "--metrics",
+        metavar="PATH",
+        help="record the API calls and write them to PATH.json and PATH.prom at exit",
+    )
+
+
+def setup(path, script):
+    """Start recording metrics if `path` is given, and write them at exit."""
+    global registry
+    if path is None:
+        return
+    # Command modules are named like the scripts, with underscores.
+    registry = Registry(Path(script).stem.replace("_", "-"))
+    atexit.register(registry.write, path)
+
+
+def record_request(method, url, status, seconds, size):
+    if registry is not None:
+        registry.record_request(method, url, status, seconds, size)
+
+
+@contextmanager
+def timer(name):
+    """Record the duration of the wrapped block as the local step `name`."""
+    if registry is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        registry.record_step(name, time.monotonic() - start)
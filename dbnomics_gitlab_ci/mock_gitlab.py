@@ -0,0 +1,1155 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Local stand-in for the GitLab v4 API, holding its state in memory.
+
+It serves the subset of the API used by the scripts of this repository: projects,
+groups, namespaces, triggers, hooks, deploy keys, variables, pipeline schedules,
+pipelines and jobs, plus the `projects` GraphQL query sent by
+`dbnomics_gitlab_ci.graphql`. `MockGitLab.push` calls the hooks of a project like a push
+would. A latency can be added to each request, and a rate limit can
+make it answer "429 Too Many Requests", like git.nomics.world does under load.
+
+Every request is counted by route, to measure how many API calls an operation makes.
+
+Run it with `python -m dbnomics_gitlab_ci.mock_gitlab --help`, or use
+`MockGitLabServer` in a thread, as `benchmark-scripts.py` does.
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import math
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, quote, unquote, urlsplit
+
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class NotFound(Exception):
+    pass
+
+
+class MockGitLab:
+    """In-memory state of the stand-in GitLab instance."""
+
+    def __init__(self, base_url="http://localhost"):
+        self.base_url = base_url
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.groups = {}  # id -> dict
+        self.projects = {}  # id -> dict
+        self.deploy_keys = {}  # id -> dict
+        self.triggers = collections.defaultdict(list)  # project id -> list
+        self.hooks = collections.defaultdict(list)
+        self.enabled_keys = collections.defaultdict(
+            dict
+        )  # project id -> key id -> can_push
+        self.variables = collections.defaultdict(list)
+        self.schedules = collections.defaultdict(list)
+        self.pipelines = collections.defaultdict(list)
+        self.jobs = collections.defaultdict(list)  # pipeline id -> list
+        self.traces = {}  # job id -> str
+        self.request_counts = collections.Counter()
+        # If set, active pipelines succeed when they were got this number of times.
+        self.finish_pipelines_after = None
+        # If False, /api/graphql answers 404, like GitLab instances without GraphQL.
+        self.graphql_enabled = True
+
+    def next_id(self):
+        with self.lock:
+            return next(self.ids)
+
+    # Seeding
+
+    def add_group(self, path):
+        group = {
+            "id": self.next_id(),
+            "name": path,
+            "path": path,
+            "full_path": path,
+            "kind": "group",
+        }
+        self.groups[group["id"]] = group
+        return group
+
+    def find_group(self, path):
+        for group in self.groups.values():
+            if group["full_path"] == path:
+                return group
+        return None
+
+    def add_project(self, path_with_namespace, **attributes):
+        namespace_path, _, path = path_with_namespace.rpartition("/")
+        group = self.find_group(namespace_path) or self.add_group(namespace_path)
+        project_id = attributes.pop("id", None) or self.next_id()
+        project = {
+            "id": project_id,
+            "name": path,
+            "path": path,
+            "path_with_namespace": path_with_namespace,
+            "namespace": {"id": group["id"], "full_path": group["full_path"]},
+            "description": "",
+            "visibility": "public",
+            "default_branch": "master",
+            "http_url_to_repo": "{}/{}.git".format(self.base_url, path_with_namespace),
+            "web_url": "{}/{}".format(self.base_url, path_with_namespace),
+            "last_activity_at": _now(),
+        }
+        project.update(attributes)
+        self.projects[project_id] = project
+        return project
+
+    def add_trigger(self, project_id, description, token=None):
+        trigger = {
+            "id": self.next_id(),
+            "description": description,
+            "token": token or "token{:016d}".format(self.next_id()),
+        }
+        self.triggers[project_id].append(trigger)
+        return trigger
+
+    def add_pipeline(
+        self,
+        project_id,
+        status="pending",
+        ref="master",
+        source="push",
+        variables=None,
+        created_at=None,
+        jobs=("job",),
+    ):
+        pipeline = {
+            "id": self.next_id(),
+            "project_id": project_id,
+            "status": status,
+            "ref": ref,
+            "sha": "0" * 40,
+            "source": source,
+            "created_at": created_at or _now(),
+            "updated_at": created_at or _now(),
+            "started_at": None,
+            "finished_at": None,
+            "duration": None,
+            "queued_duration": None,
+            "web_url": "{}/-/pipelines".format(self.projects[project_id]["web_url"]),
+            "_variables": [
+                {"key": key, "value": value, "variable_type": "env_var"}
+                for key, value in (variables or {}).items()
+            ],
+        }
+        self.pipelines[project_id].append(pipeline)
+        for name in jobs:
+            job = {
+                "id": self.next_id(),
+                "name": name,
+                "stage": "test",
+                "status": status,
+                "ref": ref,
+                "created_at": pipeline["created_at"],
+                "started_at": None,
+                "finished_at": None,
+                "duration": None,
+                "queued_duration": None,
+                "pipeline": {
+                    "id": pipeline["id"],
+                    "project_id": project_id,
+                    "ref": ref,
+                    "status": status,
+                },
+                "web_url": "{}/-/jobs".format(self.projects[project_id]["web_url"]),
+            }
+            self.jobs[pipeline["id"]].append(job)
+            self.traces[job["id"]] = ""
+        return pipeline
+
+    def set_pipeline_status(self, pipeline, status):
+        pipeline["status"] = status
+        pipeline["updated_at"] = _now()
+        for job in self.jobs[pipeline["id"]]:
+            job["status"] = status
+            job["pipeline"]["status"] = status
+
+    # Events
+
+    def push(self, project_id, ref="master"):
+        """Call the push hooks of a project for a push to `ref`, like GitLab does.
+
+        Return the HTTP statuses answered to the hooks, None for connection errors.
+        """
+        with self.lock:
+            project = self.get_project(str(project_id))
+            hooks = [
+                hook
+                for hook in self.hooks[project["id"]]
+                if hook["push_events"]
+                and hook.get("push_events_branch_filter") in {None, "", ref}
+            ]
+        event = {
+            "object_kind": "push",
+            "ref": "refs/heads/" + ref,
+            "project_id": project["id"],
+            "project": {"path_with_namespace": project["path_with_namespace"]},
+        }
+        statuses = []
+        for hook in hooks:
+            headers = {
+                "Content-Type": "application/json",
+                "X-Gitlab-Event": "Push Hook",
+            }
+            if hook.get("_token"):
+                headers["X-Gitlab-Token"] = hook["_token"]
+            request = urllib.request.Request(
+                hook["url"],
+                data=json.dumps(event).encode("utf-8"),
+                headers=headers,
+                method="POST",
+            )
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    statuses.append(response.status)
+            except urllib.error.HTTPError as exc:
+                statuses.append(exc.code)
+            except urllib.error.URLError:
+                statuses.append(None)
+        return statuses
+
+    # Lookup
+
+    def get_project(self, id_or_path):
+        id_or_path = unquote(id_or_path)
+        if id_or_path.isdigit():
+            project = self.projects.get(int(id_or_path))
+        else:
+            project = next(
+                (
+                    project
+                    for project in self.projects.values()
+                    if project["path_with_namespace"] == id_or_path
+                ),
+                None,
+            )
+        if project is None:
+            raise NotFound("404 Project Not Found")
+        return project
+
+    def get_group(self, id_or_path):
+        id_or_path = unquote(id_or_path)
+        group = (
+            self.groups.get(int(id_or_path))
+            if id_or_path.isdigit()
+            else self.find_group(id_or_path)
+        )
+        if group is None:
+            raise NotFound("404 Group Not Found")
+        return group
+
+    def find_pipeline(self, pipeline_id):
+        for pipelines in self.pipelines.values():
+            for pipeline in pipelines:
+                if pipeline["id"] == pipeline_id:
+                    return pipeline
+        raise NotFound("404 Pipeline Not Found")
+
+    def find_job(self, job_id):
+        for jobs in self.jobs.values():
+            for job in jobs:
+                if job["id"] == job_id:
+                    return job
+        raise NotFound("404 Job Not Found")
+
+
+def _find(items, item_id, key="id"):
+    for item in items:
+        if str(item[key]) == str(item_id):
+            return item
+    raise NotFound("404 Not Found")
+
+
+def _public(item):
+    return {key: value for key, value in item.items() if not key.startswith("_")}
+
+
+def _bool(value):
+    return value in (True, "true", "True", "1", 1)
+
+
+class Route:
+    def __init__(self, method, pattern, name):
+        self.method = method
+        self.regex = re.compile("^/api/v4" + pattern + "$")
+        self.name = name
+
+
+ROUTES = []
+
+
+def route(method, pattern):
+    """Register a handler for `method` requests on URL paths matching `pattern`."""
+
+    def decorator(func):
+        ROUTES.append((Route(method, pattern, "{} {}".format(method, pattern)), func))
+        return func
+
+    return decorator
+
+
+# Handlers: called with (gitlab, params, body, *path_groups), return (status, data)
+# or (status, data, headers).
+
+
+@route("GET", "/user")
+def get_user(gl, params, body):
+    return 200, {"id": 1, "username": "root", "name": "Administrator"}
+
+
+@route("GET", "/version")
+def get_version(gl, params, body):
+    return 200, {"version": "13.0.0", "revision": "mock"}
+
+
+@route("GET", "/groups/([^/]+)")
+def get_group(gl, params, body, group_id):
+    return 200, gl.get_group(group_id)
+
+
+@route("GET", "/groups/([^/]+)/projects")
+def list_group_projects(gl, params, body, group_id):
+    group = gl.get_group(group_id)
+    return 200, [
+        project
+        for project in gl.projects.values()
+        if project["namespace"]["id"] == group["id"]
+    ]
+
+
+@route("GET", "/namespaces")
+def list_namespaces(gl, params, body):
+    search = params.get("search", "")
+    return 200, [group for group in gl.groups.values() if search in group["full_path"]]
+
+
+@route("GET", "/namespaces/([^/]+)")
+def get_namespace(gl, params, body, namespace_id):
+    return 200, gl.get_group(namespace_id)
+
+
+@route("GET", "/projects")
+def list_projects(gl, params, body):
+    search = params.get("search", "")
+    return 200, [
+        project for project in gl.projects.values() if search in project["path"]
+    ]
+
+
+@route("POST", "/projects")
+def create_project(gl, params, body):
+    group = gl.get_group(str(body["namespace_id"]))
+    path = body.get("path") or body["name"]
+    full_path = "{}/{}".format(group["full_path"], path)
+    if any(
+        project["path_with_namespace"] == full_path for project in gl.projects.values()
+    ):
+        return 400, {"message": {"name": ["has already been taken"]}}
+    project = gl.add_project(
+        full_path,
+        description=body.get("description", ""),
+        visibility=body.get("visibility", "private"),
+    )
+    return 201, project
+
+
+@route("GET", "/projects/([^/]+)")
+def get_project(gl, params, body, project_id):
+    return 200, gl.get_project(project_id)
+
+
+# Triggers
+
+
+@route("GET", "/projects/([^/]+)/triggers")
+def list_triggers(gl, params, body, project_id):
+    return 200, gl.triggers[gl.get_project(project_id)["id"]]
+
+
+@route("POST", "/projects/([^/]+)/triggers")
+def create_trigger(gl, params, body, project_id):
+    project = gl.get_project(project_id)
+    return 201, gl.add_trigger(project["id"], body.get("description", ""))
+
+
+@route("DELETE", "/projects/([^/]+)/triggers/(\\d+)")
+def delete_trigger(gl, params, body, project_id, trigger_id):
+    triggers = gl.triggers[gl.get_project(project_id)["id"]]
+    triggers.remove(_find(triggers, trigger_id))
+    return 204, None
+
+
+@route("POST", "/projects/([^/]+)/(?:ref/([^/]+)/)?trigger/pipeline")
+def trigger_pipeline(gl, params, body, project_id, ref=None):
+    project = gl.get_project(project_id)
+    data = dict(params)
+    data.update(body or {})
+    token = data.get("token")
+    if not any(trigger["token"] == token for trigger in gl.triggers[project["id"]]):
+        return 404, {"message": "404 Not Found"}
+    variables = {
+        key[len("variables[") : -1]: value
+        for key, value in data.items()
+        if key.startswith("variables[")
+    }
+    variables.update(data.get("variables") or {})
+    pipeline = gl.add_pipeline(
+        project["id"],
+        ref=ref or data.get("ref", "master"),
+        source="trigger",
+        variables=variables,
+    )
+    return 201, _public(pipeline)
+
+
+# Hooks
+
+
+@route("GET", "/projects/([^/]+)/hooks")
+def list_hooks(gl, params, body, project_id):
+    return 200, [_public(hook) for hook in gl.hooks[gl.get_project(project_id)["id"]]]
+
+
+@route("POST", "/projects/([^/]+)/hooks")
+def create_hook(gl, params, body, project_id):
+    project = gl.get_project(project_id)
+    hook = {
+        "id": gl.next_id(),
+        "url": body["url"],
+        "project_id": project["id"],
+        "push_events": _bool(body.get("push_events", True)),
+        "push_events_branch_filter": body.get("push_events_branch_filter"),
+        # Like GitLab, the secret token is not returned.
+        "_token": body.get("token"),
+    }
+    gl.hooks[project["id"]].append(hook)
+    return 201, _public(hook)
+
+
+@route("PUT", "/projects/([^/]+)/hooks/(\\d+)")
+def update_hook(gl, params, body, project_id, hook_id):
+    hook = _find(gl.hooks[gl.get_project(project_id)["id"]], hook_id)
+    for key, value in body.items():
+        if key == "token":
+            hook["_token"] = value
+        else:
+            hook[key] = _bool(value) if key == "push_events" else value
+    return 200, _public(hook)
+
+
+@route("DELETE", "/projects/([^/]+)/hooks/(\\d+)")
+def delete_hook(gl, params, body, project_id, hook_id):
+    hooks = gl.hooks[gl.get_project(project_id)["id"]]
+    hooks.remove(_find(hooks, hook_id))
+    return 204, None
+
+
+# Deploy keys
+
+
+def _project_keys(gl, project):
+    return [
+        dict(gl.deploy_keys[key_id], can_push=can_push)
+        for key_id, can_push in gl.enabled_keys[project["id"]].items()
+    ]
+
+
+def _key_projects(gl, key_id, can_push):
+    return [
+        {
+            "id": project_id,
+            "path_with_namespace": gl.projects[project_id]["path_with_namespace"],
+        }
+        for project_id, keys in gl.enabled_keys.items()
+        if key_id in keys and keys[key_id] == can_push
+    ]
+
+
+@route("GET", "/deploy_keys")
+def list_all_deploy_keys(gl, params, body):
+    return 200, [
+        dict(
+            key,
+            projects_with_write_access=_key_projects(gl, key["id"], True),
+            projects_with_readonly_access=_key_projects(gl, key["id"], False),
+        )
+        for key in gl.deploy_keys.values()
+    ]
+
+
+@route("GET", "/projects/([^/]+)/deploy_keys")
+def list_deploy_keys(gl, params, body, project_id):
+    return 200, _project_keys(gl, gl.get_project(project_id))
+
+
+@route("POST", "/projects/([^/]+)/deploy_keys")
+def create_deploy_key(gl, params, body, project_id):
+    project = gl.get_project(project_id)
+    material = " ".join(body["key"].split()[:2])
+    key = next(
+        (
+            key
+            for key in gl.deploy_keys.values()
+            if " ".join(key["key"].split()[:2]) == material
+        ),
+        None,
+    )
+    if key is None:
+        key = {
+            "id": gl.next_id(),
+            "title": body["title"],
+            "key": body["key"].strip(),
+            "created_at": _now(),
+        }
+        gl.deploy_keys[key["id"]] = key
+    elif key["id"] in gl.enabled_keys[project["id"]]:
+        return 400, {"message": {"key": ["has already been taken"]}}
+    gl.enabled_keys[project["id"]][key["id"]] = _bool(body.get("can_push", False))
+    return 201, dict(key, can_push=gl.enabled_keys[project["id"]][key["id"]])
+
+
+@route("POST", "/projects/([^/]+)/deploy_keys/(\\d+)/enable")
+def enable_deploy_key(gl, params, body, project_id, key_id):
+    project = gl.get_project(project_id)
+    key = gl.deploy_keys.get(int(key_id))
+    if key is None:
+        raise NotFound("404 Deploy Key Not Found")
+    gl.enabled_keys[project["id"]].setdefault(key["id"], False)
+    return 201, dict(key, can_push=gl.enabled_keys[project["id"]][key["id"]])
+
+
+@route("PUT", "/projects/([^/]+)/deploy_keys/(\\d+)")
+def update_deploy_key(gl, params, body, project_id, key_id):
+    project = gl.get_project(project_id)
+    keys = gl.enabled_keys[project["id"]]
+    if int(key_id) not in keys:
+        raise NotFound("404 Deploy Key Not Found")
+    if "can_push" in body:
+        keys[int(key_id)] = _bool(body["can_push"])
+    if "title" in body:
+        gl.deploy_keys[int(key_id)]["title"] = body["title"]
+    return 200, dict(gl.deploy_keys[int(key_id)], can_push=keys[int(key_id)])
+
+
+@route("DELETE", "/projects/([^/]+)/deploy_keys/(\\d+)")
+def delete_deploy_key(gl, params, body, project_id, key_id):
+    project = gl.get_project(project_id)
+    if gl.enabled_keys[project["id"]].pop(int(key_id), None) is None:
+        raise NotFound("404 Deploy Key Not Found")
+    if not any(int(key_id) in keys for keys in gl.enabled_keys.values()):
+        del gl.deploy_keys[int(key_id)]
+    return 204, None
+
+
+# Variables
+
+
+@route("GET", "/projects/([^/]+)/variables")
+def list_variables(gl, params, body, project_id):
+    return 200, gl.variables[gl.get_project(project_id)["id"]]
+
+
+@route("POST", "/projects/([^/]+)/variables")
+def create_variable(gl, params, body, project_id):
+    variables = gl.variables[gl.get_project(project_id)["id"]]
+    if any(variable["key"] == body["key"] for variable in variables):
+        return 400, {"message": {"key": ["has already been taken"]}}
+    variable = {
+        "key": body["key"],
+        "value": body["value"],
+        "protected": False,
+        "variable_type": "env_var",
+    }
+    variables.append(variable)
+    return 201, variable
+
+
+@route("GET", "/projects/([^/]+)/variables/([^/]+)")
+def get_variable(gl, params, body, project_id, key):
+    return 200, _find(
+        gl.variables[gl.get_project(project_id)["id"]], unquote(key), key="key"
+    )
+
+
+@route("PUT", "/projects/([^/]+)/variables/([^/]+)")
+def update_variable(gl, params, body, project_id, key):
+    variable = _find(
+        gl.variables[gl.get_project(project_id)["id"]], unquote(key), key="key"
+    )
+    variable.update(body)
+    return 200, variable
+
+
+@route("DELETE", "/projects/([^/]+)/variables/([^/]+)")
+def delete_variable(gl, params, body, project_id, key):
+    variables = gl.variables[gl.get_project(project_id)["id"]]
+    variables.remove(_find(variables, unquote(key), key="key"))
+    return 204, None
+
+
+# Pipeline schedules
+
+
+@route("GET", "/projects/([^/]+)/pipeline_schedules")
+def list_schedules(gl, params, body, project_id):
+    return 200, [
+        _public(schedule) for schedule in gl.schedules[gl.get_project(project_id)["id"]]
+    ]
+
+
+@route("POST", "/projects/([^/]+)/pipeline_schedules")
+def create_schedule(gl, params, body, project_id):
+    schedule = {
+        "id": gl.next_id(),
+        "description": body.get("description", ""),
+        "ref": body.get("ref", "master"),
+        "cron": body["cron"],
+        "cron_timezone": body.get("cron_timezone", "UTC"),
+        "active": _bool(body.get("active", True)),
+        "_variables": [],
+    }
+    gl.schedules[gl.get_project(project_id)["id"]].append(schedule)
+    return 201, _public(schedule)
+
+
+@route("GET", "/projects/([^/]+)/pipeline_schedules/(\\d+)")
+def get_schedule(gl, params, body, project_id, schedule_id):
+    schedule = _find(gl.schedules[gl.get_project(project_id)["id"]], schedule_id)
+    return 200, dict(_public(schedule), variables=schedule["_variables"])
+
+
+@route("PUT", "/projects/([^/]+)/pipeline_schedules/(\\d+)")
+def update_schedule(gl, params, body, project_id, schedule_id):
+    schedule = _find(gl.schedules[gl.get_project(project_id)["id"]], schedule_id)
+    for key, value in body.items():
+        schedule[key] = _bool(value) if key == "active" else value
+    return 200, _public(schedule)
+
+
+@route("DELETE", "/projects/([^/]+)/pipeline_schedules/(\\d+)")
+def delete_schedule(gl, params, body, project_id, schedule_id):
+    schedules = gl.schedules[gl.get_project(project_id)["id"]]
+    schedules.remove(_find(schedules, schedule_id))
+    return 204, None
+
+
+@route("POST", "/projects/([^/]+)/pipeline_schedules/(\\d+)/variables")
+def create_schedule_variable(gl, params, body, project_id, schedule_id):
+    schedule = _find(gl.schedules[gl.get_project(project_id)["id"]], schedule_id)
+    variable = {"key": body["key"], "value": body["value"], "variable_type": "env_var"}
+    schedule["_variables"].append(variable)
+    return 201, variable
+
+
+@route("PUT", "/projects/([^/]+)/pipeline_schedules/(\\d+)/variables/([^/]+)")
+def update_schedule_variable(gl, params, body, project_id, schedule_id, key):
+    schedule = _find(gl.schedules[gl.get_project(project_id)["id"]], schedule_id)
+    variable = _find(schedule["_variables"], unquote(key), key="key")
+    variable.update(body)
+    return 200, variable
+
+
+# Pipelines and jobs
+
+
+@route("GET", "/projects/([^/]+)/pipelines")
+def list_pipelines(gl, params, body, project_id):
+    pipelines = gl.pipelines[gl.get_project(project_id)["id"]]
+    for name in ("status", "ref", "source", "sha"):
+        if name in params:
+            pipelines = [
+                pipeline for pipeline in pipelines if pipeline[name] == params[name]
+            ]
+    if "updated_after" in params:
+        pipelines = [p for p in pipelines if p["updated_at"] > params["updated_after"]]
+    if "updated_before" in params:
+        pipelines = [p for p in pipelines if p["updated_at"] < params["updated_before"]]
+    reverse = params.get("sort", "desc") == "desc"
+    order_by = params.get("order_by", "id")
+    pipelines = sorted(
+        pipelines, key=lambda pipeline: pipeline[order_by], reverse=reverse
+    )
+    return 200, [_public(pipeline) for pipeline in pipelines]
+
+
+@route("GET", "/projects/([^/]+)/pipelines/(\\d+)")
+def get_pipeline(gl, params, body, project_id, pipeline_id):
+    pipeline = gl.find_pipeline(int(pipeline_id))
+    if gl.finish_pipelines_after is not None and pipeline["status"] in {
+        "created",
+        "pending",
+        "running",
+    }:
+        pipeline["_polls"] = pipeline.get("_polls", 0) + 1
+        if pipeline["_polls"] >= gl.finish_pipelines_after:
+            gl.set_pipeline_status(pipeline, "success")
+    return 200, _public(pipeline)
+
+
+@route("GET", "/projects/([^/]+)/pipelines/(\\d+)/variables")
+def get_pipeline_variables(gl, params, body, project_id, pipeline_id):
+    return 200, gl.find_pipeline(int(pipeline_id))["_variables"]
+
+
+@route("POST", "/projects/([^/]+)/pipelines/(\\d+)/cancel")
+def cancel_pipeline(gl, params, body, project_id, pipeline_id):
+    pipeline = gl.find_pipeline(int(pipeline_id))
+    if pipeline["status"] in {"created", "pending", "running", "waiting_for_resource"}:
+        gl.set_pipeline_status(pipeline, "canceled")
+    return 201, _public(pipeline)
+
+
+@route("GET", "/projects/([^/]+)/pipelines/(\\d+)/jobs")
+def list_pipeline_jobs(gl, params, body, project_id, pipeline_id):
+    return 200, gl.jobs[int(pipeline_id)]
+
+
+@route("GET", "/projects/([^/]+)/jobs")
+def list_jobs(gl, params, body, project_id):
+    project_id = gl.get_project(project_id)["id"]
+    jobs = [
+        job for pipeline in gl.pipelines[project_id] for job in gl.jobs[pipeline["id"]]
+    ]
+    scopes = params.get("scope")
+    if scopes:
+        jobs = [job for job in jobs if job["status"] in scopes.split(",")]
+    return 200, sorted(jobs, key=lambda job: job["id"], reverse=True)
+
+
+@route("GET", "/projects/([^/]+)/jobs/(\\d+)")
+def get_job(gl, params, body, project_id, job_id):
+    return 200, gl.find_job(int(job_id))
+
+
+@route("GET", "/projects/([^/]+)/jobs/(\\d+)/trace")
+def get_job_trace(gl, params, body, project_id, job_id):
+    # Like GitLab, the whole trace is returned: Range headers are ignored.
+    gl.find_job(int(job_id))
+    return 200, gl.traces[int(job_id)].encode("utf-8")
+
+
+# Repository
+
+
+@route("GET", "/projects/([^/]+)/repository/compare")
+def compare(gl, params, body, project_id):
+    project = gl.get_project(project_id)
+    diffs = project.get("_compare_diffs", [])
+    return 200, {
+        "commit": {"id": params.get("to")},
+        "commits": [],
+        "diffs": [
+            {
+                "old_path": path,
+                "new_path": path,
+                "new_file": False,
+                "deleted_file": False,
+                "renamed_file": False,
+            }
+            for path in diffs
+        ],
+        "compare_timeout": False,
+        "compare_same_ref": params.get("from") == params.get("to"),
+    }
+
+
+@route("GET", "/projects/([^/]+)/repository/branches/([^/]+)")
+def get_branch(gl, params, body, project_id, branch):
+    project = gl.get_project(project_id)
+    return 200, {
+        "name": unquote(branch),
+        "commit": {"id": project.get("_head_sha", "f" * 40)},
+    }
+
+
+# GraphQL
+
+
+def _graphql_arguments(text, variables):
+    arguments = {}
+    for name, value in re.findall(r"(\w+):\s*(\$?\w+)", text):
+        arguments[name] = variables.get(value[1:]) if value.startswith("$") else value
+    return arguments
+
+
+def _graphql_pipeline(pipeline):
+    return {
+        "id": "gid://gitlab/Ci::Pipeline/{}".format(pipeline["id"]),
+        "iid": str(pipeline["id"]),
+        "status": pipeline["status"].upper(),
+        "ref": pipeline["ref"],
+        "source": pipeline["source"],
+        "createdAt": pipeline["created_at"],
+        "updatedAt": pipeline["updated_at"],
+        "duration": pipeline["duration"],
+    }
+
+
+def graphql(gl, body):
+    """Answer the `projects` query, with `pipelines` connections as only fields."""
+    query = body.get("query", "")
+    variables = body.get("variables") or {}
+    match = re.search(r"{\s*projects\(([^)]*)\)", query)
+    if match is None:
+        return 200, {"errors": [{"message": "Unsupported query"}]}
+    arguments = _graphql_arguments(match.group(1), variables)
+    full_paths = arguments.get("fullPaths") or []
+    projects = [
+        project
+        for project in gl.projects.values()
+        if project["path_with_namespace"] in full_paths
+    ]
+    start = int(arguments.get("after") or 0)
+    first = int(arguments.get("first") or MAX_PER_PAGE)
+    connections = [
+        (alias, _graphql_arguments(text, variables))
+        for alias, text in re.findall(r"(\w+):\s*pipelines\(([^)]*)\)", query)
+    ]
+    nodes = []
+    for project in projects[start : start + first]:
+        node = {
+            "id": "gid://gitlab/Project/{}".format(project["id"]),
+            "fullPath": project["path_with_namespace"],
+        }
+        for alias, connection_arguments in connections:
+            pipelines = sorted(
+                gl.pipelines[project["id"]], key=lambda pipeline: -pipeline["id"]
+            )
+            for name in ("status", "ref", "source"):
+                value = connection_arguments.get(name)
+                if value is None:
+                    continue
+                if name == "status":
+                    value = value.lower()
+                pipelines = [
+                    pipeline for pipeline in pipelines if pipeline[name] == value
+                ]
+            size = int(connection_arguments.get("first") or MAX_PER_PAGE)
+            node[alias] = {
+                "pageInfo": {"hasNextPage": len(pipelines) > size},
+                "nodes": [_graphql_pipeline(pipeline) for pipeline in pipelines[:size]],
+            }
+        nodes.append(node)
+    end = start + first
+    return 200, {
+        "data": {
+            "projects": {
+                "pageInfo": {
+                    "hasNextPage": end < len(projects),
+                    "endCursor": str(end),
+                },
+                "nodes": nodes,
+            }
+        }
+    }
+
+
+class RateLimiter:
+    """Allow at most `limit` requests by sliding window of `period` seconds."""
+
+    def __init__(self, limit, period=1.0):
+        self.limit = limit
+        self.period = period
+        self.timestamps = collections.deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Return (allowed, remaining, reset), `reset` being a Unix timestamp."""
+        now = time.monotonic()
+        with self.lock:
+            while self.timestamps and self.timestamps[0] <= now - self.period:
+                self.timestamps.popleft()
+            allowed = len(self.timestamps) < self.limit
+            if allowed:
+                self.timestamps.append(now)
+            reset = time.time() + self.timestamps[0] + self.period - now
+            return allowed, self.limit - len(self.timestamps), math.ceil(reset)
+
+
+def make_handler(gitlab, latency=0.0, rate_limiter=None, per_page=DEFAULT_PER_PAGE):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.handle_api("GET")
+
+        def do_POST(self):
+            self.handle_api("POST")
+
+        def do_PUT(self):
+            self.handle_api("PUT")
+
+        def do_DELETE(self):
+            self.handle_api("DELETE")
+
+        def handle_api(self, method):
+            split = urlsplit(self.path)
+            params = dict(parse_qsl(split.query, keep_blank_values=True))
+            length = int(self.headers.get("Content-Length") or 0)
+            raw_body = self.rfile.read(length) if length else b""
+            body = {}
+            if raw_body:
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("application/json"):
+                    body = json.loads(raw_body.decode("utf-8"))
+                else:
+                    body = dict(parse_qsl(raw_body.decode("utf-8")))
+
+            if latency:
+                time.sleep(latency)
+
+            headers = {}
+            if rate_limiter is not None:
+                allowed, remaining, reset = rate_limiter.acquire()
+                headers["RateLimit-Limit"] = str(rate_limiter.limit)
+                headers["RateLimit-Remaining"] = str(remaining)
+                headers["RateLimit-Reset"] = str(reset)
+                if not allowed:
+                    headers["Retry-After"] = "1"
+                    with gitlab.lock:
+                        gitlab.request_counts["429"] += 1
+                    self.send(429, {"message": "429 Too Many Requests"}, headers)
+                    return
+
+            path = split.path
+            if method == "POST" and path == "/api/graphql" and gitlab.graphql_enabled:
+                with gitlab.lock:
+                    gitlab.request_counts["POST /graphql"] += 1
+                    try:
+                        status, data = graphql(gitlab, body)
+                    except (KeyError, ValueError) as exc:
+                        status, data = 200, {"errors": [{"message": str(exc)}]}
+                self.send(status, data, headers)
+                return
+            for route, func in ROUTES:
+                if route.method != method:
+                    continue
+                match = route.regex.match(path)
+                if match is None:
+                    continue
+                with gitlab.lock:
+                    gitlab.request_counts[route.name] += 1
+                    try:
+                        result = func(gitlab, params, body, *match.groups())
+                    except NotFound as exc:
+                        result = (404, {"message": str(exc)})
+                    except (KeyError, ValueError) as exc:
+                        result = (400, {"error": "bad request: {}".format(exc)})
+                status, data = result[:2]
+                if len(result) > 2:
+                    headers.update(result[2])
+                if method == "GET" and isinstance(data, list):
+                    data = self.paginate(split, params, data, headers)
+                self.send(status, data, headers)
+                return
+            with gitlab.lock:
+                gitlab.request_counts["404 {} {}".format(method, path)] += 1
+            self.send(404, {"error": "404 Not Found"}, headers)
+
+        def paginate(self, split, params, items, headers):
+            page_size = min(int(params.get("per_page", per_page)), MAX_PER_PAGE)
+            page = max(int(params.get("page", 1)), 1)
+            total_pages = max((len(items) + page_size - 1) // page_size, 1)
+            headers.update(
+                {
+                    "X-Page": str(page),
+                    "X-Per-Page": str(page_size),
+                    "X-Total": str(len(items)),
+                    "X-Total-Pages": str(total_pages),
+                    "X-Next-Page": str(page + 1) if page < total_pages else "",
+                    "X-Prev-Page": str(page - 1) if page > 1 else "",
+                }
+            )
+            if page < total_pages:
+                next_params = dict(params, page=str(page + 1), per_page=str(page_size))
+                next_url = "http://{}:{}{}?{}".format(
+                    self.server.server_address[0],
+                    self.server.server_address[1],
+                    split.path,
+                    "&".join(
+                        "{}={}".format(key, quote(str(value), safe=""))
+                        for key, value in next_params.items()
+                    ),
+                )
+                headers["Link"] = '<{}>; rel="next"'.format(next_url)
+            return items[(page - 1) * page_size : page * page_size]
+
+        def send(self, status, data, headers):
+            if isinstance(data, bytes):
+                payload = data
+                content_type = "text/plain"
+            elif data is None:
+                payload = b""
+                content_type = "application/json"
+            else:
+                payload = json.dumps(data).encode("utf-8")
+                content_type = "application/json"
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+
+class MockGitLabServer:
+    """Serve a `MockGitLab` over HTTP in a background thread.
+
+    Use it as a context manager; `url` is the base URL to give to the scripts.
+    """
+
+    def __init__(
+        self,
+        gitlab=None,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        rate_limit=None,
+        per_page=DEFAULT_PER_PAGE,
+    ):
+        self.gitlab = gitlab or MockGitLab()
+        rate_limiter = None if rate_limit is None else RateLimiter(rate_limit)
+        self.httpd = ThreadingHTTPServer(
+            (host, port),
+            make_handler(
+                self.gitlab,
+                latency=latency,
+                rate_limiter=rate_limiter,
+                per_page=per_page,
+            ),
+        )
+        self.httpd.daemon_threads = True
+        host, port = self.httpd.server_address[:2]
+        self.url = "http://{}:{}".format(host, port)
+        self.gitlab.base_url = self.url
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def seed_fleet(
+    gitlab, provider_slugs, importer_project_id=42, data_model_project_id=40
+):
+    """Create the projects of DBnomics and of the given providers."""
+    importer = gitlab.add_project("dbnomics/dbnomics-importer", id=importer_project_id)
+    data_model = gitlab.add_project(
+        "dbnomics/dbnomics-data-model", id=data_model_project_id
+    )
+    gitlab.ids = itertools.count(max(importer_project_id, data_model_project_id) + 1)
+    gitlab.add_trigger(importer["id"], "importer")
+    gitlab.add_trigger(data_model["id"], "data model")
+    for namespace in (
+        "dbnomics-fetchers",
+        "dbnomics-source-data",
+        "dbnomics-json-data",
+        "dbnomics-data-dev",
+    ):
+        if gitlab.find_group(namespace) is None:
+            gitlab.add_group(namespace)
+    for provider_slug in provider_slugs:
+        gitlab.add_project("dbnomics-fetchers/{}-fetcher".format(provider_slug))
+        gitlab.add_project("dbnomics-source-data/{}-source-data".format(provider_slug))
+        gitlab.add_project("dbnomics-json-data/{}-json-data".format(provider_slug))
+        gitlab.add_project("dbnomics-data-dev/{}-source-data".format(provider_slug))
+        gitlab.add_project("dbnomics-data-dev/{}-json-data".format(provider_slug))
+    return gitlab
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "provider_slugs",
+        metavar="provider_slug",
+        nargs="*",
+        help="providers whose projects are created at startup",
+    )
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds to wait before answering each request",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=int,
+        help="maximum number of requests per second, then answer 429",
+    )
+    args = parser.parse_args()
+
+    server = MockGitLabServer(
+        seed_fleet(MockGitLab(), args.provider_slugs),
+        port=args.port,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+    )
+    print("Serving GitLab API stand-in on {}".format(server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(dict(server.gitlab.request_counts), indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""List GitLab objects through all the pages of a listing.
+
+The `list` methods of python-gitlab return the first page of 20 objects only, unless
+`all=True` is given, which requests pages of 20 objects and keeps them all in memory.
+`iter_all` yields the objects of all the pages, requesting pages of 100 objects as
+they are consumed; with `prefetch=True`, the next page is requested while the objects
+of the current one are processed. Keyset pagination is used by the listings
+supporting it (see `KEYSET_PATHS`): GitLab serves their last pages as fast as the
+first ones.
+
+Every listing of the package goes through `iter_all` or `list_all`.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Maximum page size accepted by GitLab.
+MAX_PER_PAGE = 100
+
+# Listings supporting keyset pagination, when ordered by ID.
+KEYSET_PATHS = frozenset(["/projects"])
+
+
+def iter_all(manager, per_page=MAX_PER_PAGE, prefetch=False, **filters):
+    """Yield the objects listed by `manager`, with `filters` as query parameters.
+
+    Pages of `per_page` objects are requested as the objects are consumed, following
+    the links given by GitLab. With `prefetch`, pages are requested by number
+    instead, in a thread: the next page while the objects of the current one are
+    consumed. Nothing is requested before the first object is consumed.
+    """
+    per_page = min(per_page, MAX_PER_PAGE)
+    if manager.path in KEYSET_PATHS and filters.get("order_by", "id") == "id":
+        filters.update(pagination="keyset", order_by="id")
+        # The link to the next page is only known from the previous one.
+        prefetch = False
+    if not prefetch:
+        yield from manager.list(as_list=False, per_page=per_page, **filters)
+        return
+
+    def get_page(page):
+        return manager.list(page=page, per_page=per_page, **filters)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = 1
+        future = executor.submit(get_page, page)
+        while future is not None:
+            objects = future.result()
+            page += 1
+            # A page shorter than requested is the last one.
+            future = (
+                executor.submit(get_page, page) if len(objects) == per_page else None
+            )
+            yield from objects
+
+
+def list_all(manager, per_page=MAX_PER_PAGE, **filters):
+    """Return the objects listed by `manager` in all the pages (see `iter_all`)."""
+    return list(iter_all(manager, per_page=per_page, **filters))
@@ -0,0 +1,332 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Follow the pipelines triggered by the scripts."""
+
+import codecs
+import logging
+import sys
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+import requests
+from gitlab.exceptions import GitlabError, GitlabGetError
+
+from .fleet import ProviderResult
+from .pagination import iter_all, list_all
+
+log = logging.getLogger(__name__)
+
+# Statuses of the pipelines that are not finished yet.
+ACTIVE_STATUSES = {
+    "created",
+    "waiting_for_resource",
+    "preparing",
+    "pending",
+    "running",
+    "scheduled",
+}
+
+# Statuses of the pipelines listed to find the duplicates of a pipeline to trigger:
+# one request each. Other active statuses are transient or not triggered.
+DUPLICATE_STATUSES = ("created", "pending", "running")
+
+# What to do when triggering a pipeline identical to an active one (see
+# `find_duplicates`): trigger it anyway, skip it and use the active one instead,
+# trigger it and cancel the active one, or wait for the active one to finish.
+DUPLICATE_POLICIES = ("allow", "skip", "supersede", "queue")
+DEFAULT_DUPLICATE_POLICY = "allow"
+
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_POLL_INTERVAL = 10
+
+# A pipeline whose status could not be read this number of times in a row is
+# considered failed by `run_with_limit`.
+MAX_REFRESH_FAILURES = 5
+
+
+class PipelineFailed(Exception):
+    """A pipeline finished with another status than "success"."""
+
+    def __init__(self, pipeline):
+        super().__init__("pipeline {} {}".format(pipeline.id, pipeline.status))
+        self.pipeline = pipeline
+
+
+def parse_datetime(value):
+    """Parse a date-time returned by GitLab.
+
+    >>> parse_datetime("2020-01-31T01:00:00.123Z")
+    datetime.datetime(2020, 1, 31, 1, 0, 0, 123000, tzinfo=datetime.timezone.utc)
+    """
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.fromisoformat(value)
+
+
+def is_active(pipeline):
+    return pipeline.status in ACTIVE_STATUSES
+
+
+def find_duplicates(project, ref, variables):
+    """Return the active pipelines of `project` identical to the one to trigger.
+
+    Identical pipelines were triggered for `ref` with exactly `variables`. Only the
+    pipelines started by a trigger and having a status of `DUPLICATE_STATUSES` are
+    listed, then the variables of each of them are read. Return the most recent
+    pipelines first.
+    """
+    candidates = [
+        pipeline
+        for status in DUPLICATE_STATUSES
+        for pipeline in iter_all(
+            project.pipelines, status=status, ref=ref, source="trigger"
+        )
+        # Old GitLab versions neither filter by source, nor return it.
+        if pipeline.attributes.get("source", "trigger") == "trigger"
+    ]
+    duplicates = [
+        pipeline
+        for pipeline in candidates
+        if {variable.key: variable.value for variable in iter_all(pipeline.variables)}
+        == variables
+    ]
+    return sorted(duplicates, key=lambda pipeline: pipeline.id, reverse=True)
+
+
+def wait_for_pipelines(
+    pipelines, poll_interval=DEFAULT_POLL_INTERVAL, sleep=time.sleep
+):
+    """Wait until `pipelines` are finished, polling them every `poll_interval` seconds."""
+    pipelines = list(pipelines)
+    while pipelines:
+        sleep(poll_interval)
+        for pipeline in pipelines:
+            pipeline.refresh()
+        pipelines = [pipeline for pipeline in pipelines if is_active(pipeline)]
+
+
+def run_with_limit(
+    trigger,
+    provider_slugs,
+    max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+    poll_interval=DEFAULT_POLL_INTERVAL,
+    sleep=time.sleep,
+):
+    """Call `trigger(provider_slug)` for each provider, keeping few pipelines active.
+
+    `trigger` returns the triggered pipeline, or None if there is nothing to do for
+    the provider. At most `max_in_flight` pipelines are
+    active at once: their status is polled every `poll_interval` seconds, and the next
+    provider is triggered as soon as one of them finishes.
+
+    A provider fails if `trigger` raises an exception, if its pipeline does not
+    succeed, or if its status can't be read `MAX_REFRESH_FAILURES` times in a row:
+    this does not stop the other providers.
+
+    Return the results in the order of `provider_slugs`, their value being the
+    finished pipeline.
+    """
+    remaining_slugs = deque(provider_slugs)
+    in_flight = OrderedDict()  # provider slug -> (pipeline, start time)
+    refresh_failures = {}  # provider slug -> consecutive failures
+    results = {}
+
+    def finish(provider_slug, start, pipeline=None, error=None):
+        del in_flight[provider_slug]
+        results[provider_slug] = ProviderResult(
+            provider_slug,
+            value=pipeline,
+            error=error,
+            duration=time.monotonic() - start,
+        )
+
+    while remaining_slugs or in_flight:
+        while remaining_slugs and len(in_flight) < max_in_flight:
+            provider_slug = remaining_slugs.popleft()
+            start = time.monotonic()
+            try:
+                pipeline = trigger(provider_slug)
+            except Exception as exc:
+                log.exception("Provider {!r} failed".format(provider_slug))
+                results[provider_slug] = ProviderResult(
+                    provider_slug, error=exc, duration=time.monotonic() - start
+                )
+                continue
+            if pipeline is None:
+                log.info("Nothing to do for {!r}".format(provider_slug))
+                results[provider_slug] = ProviderResult(
+                    provider_slug, duration=time.monotonic() - start
+                )
+                continue
+            log.info(
+                "Pipeline {} triggered for {!r} ({} remaining)".format(
+                    pipeline.id, provider_slug, len(remaining_slugs)
+                )
+            )
+            in_flight[provider_slug] = (pipeline, start)
+
+        if not in_flight:
+            break
+        sleep(poll_interval)
+
+        for provider_slug, (pipeline, start) in list(in_flight.items()):
+            try:
+                pipeline.refresh()
+            except (GitlabError, requests.RequestException) as exc:
+                log.exception("Could not get pipeline {}".format(pipeline.id))
+                refresh_failures[provider_slug] = (
+                    refresh_failures.get(provider_slug, 0) + 1
+                )
+                if refresh_failures[provider_slug] >= MAX_REFRESH_FAILURES:
+                    finish(provider_slug, start, pipeline, error=exc)
+                continue
+            refresh_failures.pop(provider_slug, None)
+            if is_active(pipeline):
+                continue
+            log.info(
+                "Pipeline {} of {!r} finished: {}".format(
+                    pipeline.id, provider_slug, pipeline.status
+                )
+            )
+            finish(
+                provider_slug,
+                start,
+                pipeline,
+                error=(
+                    None if pipeline.status == "success" else PipelineFailed(pipeline)
+                ),
+            )
+
+    return [results[provider_slug] for provider_slug in provider_slugs]
+
+
+class Backoff:
+    """Delays between polls, growing while nothing changes.
+
+    >>> backoff = Backoff(min_delay=1, max_delay=5, factor=2)
+    >>> [backoff.next_delay() for _ in range(4)]
+    [1, 2, 4, 5]
+    >>> backoff.reset()
+    >>> backoff.next_delay()
+    1
+    """
+
+    def __init__(self, min_delay=1, max_delay=30, factor=1.5):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.delay = min_delay
+
+    def next_delay(self):
+        delay = self.delay
+        self.delay = min(self.delay * self.factor, self.max_delay)
+        return delay
+
+    def reset(self):
+        self.delay = self.min_delay
+
+
+def read_trace(gl, project_id, job_id, offset=0):
+    """Return the bytes of the trace of a job, starting at `offset`.
+
+    The trace API of GitLab has no way to request a part of a trace: it ignores
+    `Range` headers, so the whole trace is downloaded at each call, and the bytes
+    before `offset` are dropped. Following a job with a long log therefore downloads
+    it many times; `follow_pipeline` polls less often while it does not change.
+    """
+    response = gl.session.get(
+        "{}/projects/{}/jobs/{}/trace".format(gl.api_url, project_id, job_id),
+        headers=gl.headers,
+        timeout=gl.timeout,
+    )
+    if response.status_code != 200:
+        raise GitlabGetError(
+            response_code=response.status_code, error_message=response.text
+        )
+    return response.content[offset:]
+
+
+class JobTrace:
+    """Part of the trace of a job that was already read."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.offset = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.complete = False
+
+
+def follow_pipeline(
+    gl,
+    pipeline,
+    output=sys.stdout,
+    backoff=None,
+    sleep=time.sleep,
+):
+    """Write the traces of the jobs of `pipeline` to `output`, while they run.
+
+    Jobs are polled with an adaptive delay (see `Backoff`): it is reset each time a
+    trace grows or a job status changes. Only the new bytes of the traces are
+    written, but GitLab sends whole traces at each poll (see `read_trace`).
+
+    Return the pipeline, once finished.
+    """
+    if backoff is None:
+        backoff = Backoff()
+    traces = {}  # job ID -> JobTrace
+    job_statuses = {}
+    current_job_id = None
+
+    while True:
+        changed = False
+        jobs = sorted(list_all(pipeline.jobs), key=lambda job: job.id)
+        for job in jobs:
+            if job_statuses.get(job.id) != job.status:
+                job_statuses[job.id] = job.status
+                changed = True
+            trace = traces.setdefault(job.id, JobTrace(job.id))
+            if trace.complete or job.status in {"created", "manual", "skipped"}:
+                continue
+            active = job.status in ACTIVE_STATUSES
+            data = read_trace(gl, pipeline.project_id, job.id, trace.offset)
+            trace.offset += len(data)
+            # The trace is complete when it was read after the end of the job.
+            trace.complete = not active
+            if not data:
+                continue
+            changed = True
+            if current_job_id != job.id:
+                output.write("\n==> job {} ({}) <==\n".format(job.name, job.id))
+                current_job_id = job.id
+            output.write(trace.decoder.decode(data, final=trace.complete))
+            output.flush()
+
+        if all(
+            traces[job.id].complete or job.status not in ACTIVE_STATUSES for job in jobs
+        ):
+            pipeline.refresh()
+            if not is_active(pipeline):
+                return pipeline
+
+        if changed:
+            backoff.reset()
+        sleep(backoff.next_delay())
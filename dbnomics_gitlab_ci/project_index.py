@@ -0,0 +1,411 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Local index of GitLab projects and trigger tokens, stored in a SQLite database.
+
+Looking up a project by its path costs an API call (`gl.projects.get(path)`), repeated
+for each provider and each run. The index maps project paths to project IDs, so that
+scripts can build "lazy" project objects without requesting the API.
+
+The index of a namespace is filled in bulk, from one paginated listing of the projects
+of its group, and refreshed when older than a TTL. A project missing from a fresh
+index is fetched by path, as before.
+
+Deploy keys are indexed by fingerprint, from one listing of all the deploy keys of
+the instance (which requires an administrator token), so that existing keys can be
+enabled instead of creating new ones.
+
+As the index can be outdated (project renamed or deleted, trigger recreated),
+operations can be retried once with a refreshed index when GitLab answers 404: see
+`ProjectIndex.call_with_projects`.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from gitlab.exceptions import GitlabError
+from gitlab.v4.objects import Project
+
+from .pagination import iter_all, list_all
+from .ssh_keys import get_fingerprint
+
+DEFAULT_TTL = 24 * 3600  # seconds
+
+CachedTrigger = namedtuple("CachedTrigger", ["id", "description", "token"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS namespaces (
+    gitlab_url TEXT NOT NULL,
+    namespace TEXT NOT NULL,
+    refreshed_at REAL NOT NULL,
+    PRIMARY KEY (gitlab_url, namespace)
+);
+CREATE TABLE IF NOT EXISTS projects (
+    gitlab_url TEXT NOT NULL,
+    path_with_namespace TEXT NOT NULL,
+    namespace TEXT NOT NULL,
+    project_id INTEGER NOT NULL,
+    PRIMARY KEY (gitlab_url, path_with_namespace)
+);
+CREATE TABLE IF NOT EXISTS triggers (
+    gitlab_url TEXT NOT NULL,
+    project_id INTEGER NOT NULL,
+    trigger_id INTEGER NOT NULL,
+    description TEXT,
+    token TEXT NOT NULL,
+    refreshed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS triggers_project ON triggers (gitlab_url, project_id);
+CREATE TABLE IF NOT EXISTS deploy_keys (
+    gitlab_url TEXT NOT NULL,
+    key_id INTEGER NOT NULL,
+    title TEXT,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (gitlab_url, key_id)
+);
+CREATE INDEX IF NOT EXISTS deploy_keys_fingerprint ON deploy_keys (gitlab_url, fingerprint);
+CREATE TABLE IF NOT EXISTS deploy_key_listings (
+    gitlab_url TEXT NOT NULL PRIMARY KEY,
+    refreshed_at REAL NOT NULL
+);
+"""
+
+log = logging.getLogger(__name__)
+
+
+def get_default_path():
+    """Return the path of the index database, in the user cache directory."""
+    cache_dir = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_dir) / "dbnomics-gitlab-ci" / "projects.sqlite"
+
+
+def is_not_found(exc):
+    return isinstance(exc, GitlabError) and exc.response_code == 404
+
+
+class ProjectIndex:
+    """Index of the projects of a GitLab instance.
+
+    It can be shared by threads: the SQLite connection is protected by a lock, and
+    each namespace is refreshed by one thread at a time, without blocking the others.
+    """
+
+    def __init__(self, gitlab_url, path=None, ttl=DEFAULT_TTL):
+        self.gitlab_url = gitlab_url.rstrip("/")
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self._namespace_locks = {}
+        self._deploy_keys_lock = threading.Lock()
+        self._deploy_keys_unavailable = False
+        self.connection = self._connect(get_default_path() if path is None else path)
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    @staticmethod
+    def _connect(path):
+        if path != ":memory:":
+            try:
+                path = Path(path)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # The index stores trigger tokens: keep it private.
+                path.touch(mode=0o600, exist_ok=True)
+                return sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+            except (OSError, sqlite3.Error) as exc:
+                log.warning(
+                    "Could not open project index {}, using a memory one: {}".format(
+                        path, exc
+                    )
+                )
+        return sqlite3.connect(":memory:", check_same_thread=False)
+
+    # Projects
+
+    def refresh_namespace(self, gl, namespace):
+        """Replace the indexed projects of `namespace` by those listed by the API."""
+        projects = list_all(gl.groups.get(namespace, lazy=True).projects, simple=True)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM projects WHERE gitlab_url = ? AND namespace = ?",
+                (self.gitlab_url, namespace),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        self.gitlab_url,
+                        project.path_with_namespace,
+                        namespace,
+                        project.id,
+                    )
+                    for project in projects
+                ],
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO namespaces VALUES (?, ?, ?)",
+                (self.gitlab_url, namespace, time.time()),
+            )
+        log.debug("{} projects indexed for {}".format(len(projects), namespace))
+
+    def _is_fresh(self, namespace):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT refreshed_at FROM namespaces "
+                "WHERE gitlab_url = ? AND namespace = ?",
+                (self.gitlab_url, namespace),
+            ).fetchone()
+        return row is not None and time.time() - row[0] < self.ttl
+
+    def _ensure_fresh(self, gl, namespace):
+        with self.lock:
+            namespace_lock = self._namespace_locks.setdefault(
+                namespace, threading.Lock()
+            )
+        with namespace_lock:
+            if not self._is_fresh(namespace):
+                self.refresh_namespace(gl, namespace)
+
+    def list_project_paths(self, gl, namespace):
+        """Return the paths of the projects of `namespace`, refreshed if needed."""
+        self._ensure_fresh(gl, namespace)
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path_with_namespace FROM projects "
+                "WHERE gitlab_url = ? AND namespace = ? ORDER BY path_with_namespace",
+                (self.gitlab_url, namespace),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def get_project_id(self, gl, path_with_namespace):
+        """Return the ID of a project, or None if it is not in its namespace listing."""
+        namespace = path_with_namespace.rpartition("/")[0]
+        self._ensure_fresh(gl, namespace)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT project_id FROM projects "
+                "WHERE gitlab_url = ? AND path_with_namespace = ?",
+                (self.gitlab_url, path_with_namespace),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def get_project(self, gl, path_with_namespace):
+        """Return a project by path, without requesting the API when it is indexed.
+
+        Indexed projects are returned as lazy objects: only their `id`,
+        `path_with_namespace` and `path` attributes are set, but their managers
+        (`project.triggers`, `project.hooks`...) can be used.
+        """
+        project_id = self.get_project_id(gl, path_with_namespace)
+        if project_id is None:
+            project = gl.projects.get(path_with_namespace)
+            self.add_project(project)
+            return project
+        return Project(
+            gl.projects,
+            {
+                "id": project_id,
+                "path_with_namespace": path_with_namespace,
+                "path": path_with_namespace.rpartition("/")[2],
+            },
+        )
+
+    def get_projects(self, gl, paths_with_namespace):
+        """Return many projects by path, refreshing their namespaces concurrently."""
+        namespaces = {path.rpartition("/")[0] for path in paths_with_namespace}
+        if len(namespaces) > 1:
+            with ThreadPoolExecutor(max_workers=len(namespaces)) as executor:
+                for _ in executor.map(
+                    lambda namespace: self._ensure_fresh(gl, namespace), namespaces
+                ):
+                    pass
+        return [self.get_project(gl, path) for path in paths_with_namespace]
+
+    def add_project(self, project):
+        namespace = project.path_with_namespace.rpartition("/")[0]
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?)",
+                (self.gitlab_url, project.path_with_namespace, namespace, project.id),
+            )
+
+    def forget(self, *paths_with_namespace):
+        """Remove projects from the index and mark their namespace as outdated."""
+        with self.lock, self.connection:
+            for path_with_namespace in paths_with_namespace:
+                namespace = path_with_namespace.rpartition("/")[0]
+                self.connection.execute(
+                    "DELETE FROM namespaces WHERE gitlab_url = ? AND namespace = ?",
+                    (self.gitlab_url, namespace),
+                )
+                self.connection.execute(
+                    "DELETE FROM triggers WHERE gitlab_url = ? AND project_id IN "
+                    "(SELECT project_id FROM projects "
+                    "WHERE gitlab_url = ? AND path_with_namespace = ?)",
+                    (self.gitlab_url, self.gitlab_url, path_with_namespace),
+                )
+                self.connection.execute(
+                    "DELETE FROM projects "
+                    "WHERE gitlab_url = ? AND path_with_namespace = ?",
+                    (self.gitlab_url, path_with_namespace),
+                )
+
+    def call_with_projects(self, gl, paths_with_namespace, func):
+        """Call `func` with the projects of `paths_with_namespace` as arguments.
+
+        If GitLab answers 404, the index of these projects is refreshed and `func`
+        is called again, once.
+        """
+        projects = self.get_projects(gl, paths_with_namespace)
+        try:
+            return func(*projects)
+        except GitlabError as exc:
+            if not is_not_found(exc):
+                raise
+            log.debug(
+                "Not found with indexed projects, refreshing them: {}".format(
+                    ", ".join(paths_with_namespace)
+                )
+            )
+        self.forget(*paths_with_namespace)
+        projects = self.get_projects(gl, paths_with_namespace)
+        return func(*projects)
+
+    # Triggers
+
+    def get_triggers(self, project):
+        """Return the triggers of `project` as `CachedTrigger` tuples.
+
+        They are listed from the API when not indexed, or older than the TTL.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT trigger_id, description, token, refreshed_at FROM triggers "
+                "WHERE gitlab_url = ? AND project_id = ? ORDER BY trigger_id",
+                (self.gitlab_url, project.id),
+            ).fetchall()
+        if rows and time.time() - rows[0][3] < self.ttl:
+            return [CachedTrigger(*row[:3]) for row in rows]
+        triggers = [
+            CachedTrigger(trigger.id, trigger.description, trigger.token)
+            for trigger in iter_all(project.triggers)
+        ]
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM triggers WHERE gitlab_url = ? AND project_id = ?",
+                (self.gitlab_url, project.id),
+            )
+            self.connection.executemany(
+                "INSERT INTO triggers VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (self.gitlab_url, project.id) + tuple(trigger) + (now,)
+                    for trigger in triggers
+                ],
+            )
+        return triggers
+
+    def forget_triggers(self, project):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM triggers WHERE gitlab_url = ? AND project_id = ?",
+                (self.gitlab_url, project.id),
+            )
+
+    # Deploy keys
+
+    def refresh_deploy_keys(self, gl, keys=None):
+        """Replace the indexed deploy keys by those of the instance.
+
+        They are listed from the API, unless `keys` is given: an already fetched
+        listing of all the deploy keys (`list_all(gl.deploykeys)`).
+        """
+        if keys is None:
+            keys = list_all(gl.deploykeys)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM deploy_keys WHERE gitlab_url = ?", (self.gitlab_url,)
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO deploy_keys VALUES (?, ?, ?, ?)",
+                [
+                    (self.gitlab_url, key.id, key.title, get_fingerprint(key.key))
+                    for key in keys
+                ],
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO deploy_key_listings VALUES (?, ?)",
+                (self.gitlab_url, time.time()),
+            )
+        log.debug("{} deploy keys indexed".format(len(keys)))
+
+    def _ensure_fresh_deploy_keys(self, gl):
+        """Refresh the deploy keys if needed, returning False if they can't be listed."""
+        with self._deploy_keys_lock:
+            if self._deploy_keys_unavailable:
+                return False
+            with self.lock:
+                row = self.connection.execute(
+                    "SELECT refreshed_at FROM deploy_key_listings WHERE gitlab_url = ?",
+                    (self.gitlab_url,),
+                ).fetchone()
+            if row is not None and time.time() - row[0] < self.ttl:
+                return True
+            try:
+                self.refresh_deploy_keys(gl)
+            except GitlabError as exc:
+                if exc.response_code not in {401, 403}:
+                    raise
+                log.warning(
+                    "Deploy keys can't be listed without an administrator token, "
+                    "existing keys won't be reused: {}".format(exc)
+                )
+                self._deploy_keys_unavailable = True
+                return False
+            return True
+
+    def find_deploy_key(self, gl, fingerprint, title=None):
+        """Return the ID of a deploy key of the instance by fingerprint, or None.
+
+        If many keys have the same fingerprint, the one named `title` is preferred.
+        Return None if the deploy keys of the instance can't be listed.
+        """
+        if not self._ensure_fresh_deploy_keys(gl):
+            return None
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key_id, title FROM deploy_keys "
+                "WHERE gitlab_url = ? AND fingerprint = ? ORDER BY key_id",
+                (self.gitlab_url, fingerprint),
+            ).fetchall()
+        if not rows:
+            return None
+        return next((row[0] for row in rows if row[1] == title), rows[0][0])
+
+    def forget_deploy_keys(self, *key_ids):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM deploy_keys WHERE gitlab_url = ? AND key_id = ?",
+                [(self.gitlab_url, key_id) for key_id in key_ids],
+            )
@@ -0,0 +1,834 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Reconcile the CI objects of a provider with the layout they should have.
+
+The live state of the provider projects is read first, then compared to the desired
+state, giving a plan made only of the creations, updates and deletions that are needed.
+The plan can be displayed (dry run) or applied.
+
+Independent API calls are sent concurrently: the live state is read with one request
+per object kind at the same time, and actions of the plan only wait for the actions
+they depend on (for example the deploy key must be created before being enabled on
+the JSON data repo).
+
+Desired state:
+- fetcher repo: a trigger described as `GENERATED_OBJECTS_TAG`
+- fetcher repo: a `SSH_PRIVATE_KEY` variable holding the private key of the deploy key
+- fetcher repo: a pipeline schedule running the download job (except for "dummy")
+- source data repo: a hook triggering the convert job of the fetcher repo
+- source data repo: a deploy key that can push, named "{provider_slug} CI jobs"
+- JSON data repo: the same deploy key enabled, that can push
+- JSON data repo: a hook triggering the Solr indexation job of the importer repo
+- JSON data repo: a hook triggering the validation job of the data model repo
+
+The hooks of the JSON data repo can call a `dbnomics_gitlab_ci.dispatcher` service
+instead of the trigger API, to coalesce bursts of pushes (see `Settings`).
+
+The deploy key is also mirrored to the repos of the dev data namespace: see
+`build_dev_data_plan`.
+
+See https://git.nomics.world/dbnomics-fetchers/documentation/wikis/ci-jobs
+"""
+
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from gitlab.exceptions import GitlabError
+
+from .pagination import list_all
+from .ssh_keys import (
+    generate_ssh_key,
+    get_fingerprint,
+    get_public_key,
+    same_public_key,
+)
+
+GENERATED_OBJECTS_TAG = "CI jobs"
+
+# GitLab only shows the first characters of the tokens of triggers owned by others.
+MIN_TRIGGER_TOKEN_LENGTH = 20
+
+NEW_TRIGGER_TOKEN = "<token of new trigger>"
+
+VERB_SIGNS = {"create": "+", "update": "~", "delete": "-"}
+
+# Kind of difference with the desired state revealed by each verb, for audits.
+VERB_VIOLATIONS = {"create": "missing", "update": "outdated", "delete": "unexpected"}
+
+DEFAULT_SCHEDULE_TIME = (1, 0)
+
+# Maximum number of concurrent API calls for a provider.
+MAX_CONCURRENT_CALLS = 6
+
+log = logging.getLogger(__name__)
+
+
+class Settings:
+    """Settings shared by all the providers."""
+
+    def __init__(
+        self,
+        api_base_url,
+        importer_project_id,
+        importer_trigger_token,
+        data_model_project_id,
+        data_model_trigger_token,
+        schedule_time,
+        purge=False,
+        generate_ssh_key=generate_ssh_key,
+        schedule_times=None,
+        find_deploy_key=None,
+        dispatcher_url=None,
+        dispatcher_token=None,
+    ):
+        self.api_base_url = api_base_url
+        self.importer_project_id = importer_project_id
+        self.importer_trigger_token = importer_trigger_token
+        self.data_model_project_id = data_model_project_id
+        self.data_model_trigger_token = data_model_trigger_token
+        # (hour, minute), or None to accept the time of an existing schedule.
+        self.schedule_time = schedule_time
+        # Schedule time of some providers, overriding `schedule_time` (see `schedules`).
+        self.schedule_times = schedule_times or {}
+        self.purge = purge
+        # Function generating a key pair from a comment, like `ssh_keys.generate_ssh_key`.
+        self.generate_ssh_key = generate_ssh_key
+        # Function returning the ID of an existing deploy key from its fingerprint and
+        # preferred title, or None, like `ProjectIndex.find_deploy_key`.
+        self.find_deploy_key = find_deploy_key
+        # Base URL of the dispatcher called by the JSON data repo hooks, or None to
+        # call the trigger API directly.
+        self.dispatcher_url = dispatcher_url
+        # Secret token sent by the hooks calling the dispatcher, in the X-Gitlab-Token
+        # header. GitLab does not return it: it is set when a hook is created or
+        # updated.
+        self.dispatcher_token = dispatcher_token
+
+
+class Action:
+    """A change to apply to a GitLab project."""
+
+    def __init__(self, verb, description, run, api_calls=1, after=()):
+        assert verb in VERB_SIGNS, verb
+        self.verb = verb
+        self.description = description
+        self.run = run
+        self.api_calls = api_calls
+        # Actions that must be done before running this one.
+        self.after = [action for action in after if action is not None]
+
+    def __str__(self):
+        return "{} {}".format(VERB_SIGNS[self.verb], self.description)
+
+
+class Plan:
+    """Actions needed to reconcile the CI objects of a provider.
+
+    Creations and updates run before deletions, so that the provider is never left
+    without its hooks or its deploy key while the plan is applied.
+    """
+
+    def __init__(self, provider_slug):
+        self.provider_slug = provider_slug
+        self.actions = []
+        self.read_api_calls = 0
+        self._lock = threading.Lock()
+
+    def add(self, verb, description, run, api_calls=1, after=()):
+        action = Action(verb, description, run, api_calls=api_calls, after=after)
+        self.actions.append(action)
+        return action
+
+    def read(self, func):
+        """Call `func` reading the live state, counting it as an API call."""
+        with self._lock:
+            self.read_api_calls += 1
+        return func()
+
+    @property
+    def write_api_calls(self):
+        return sum(action.api_calls for action in self.actions)
+
+    def format(self):
+        lines = ["Plan for provider {!r}:".format(self.provider_slug)]
+        lines.extend("  {}".format(action) for action in self.sorted_actions())
+        if not self.actions:
+            lines.append("  (nothing to change)")
+        lines.append(
+            "  API calls: {} to read the live state, {} to apply the plan".format(
+                self.read_api_calls, self.write_api_calls
+            )
+        )
+        return "\n".join(lines)
+
+    def sorted_actions(self):
+        return sorted(self.actions, key=lambda action: action.verb == "delete")
+
+    def violations(self):
+        """Return the differences between the live and the desired state.
+
+        They are returned as dicts with `provider_slug`, `violation` ("missing",
+        "outdated" or "unexpected") and `object` keys, to be serialized as JSON.
+        """
+        return [
+            {
+                "provider_slug": self.provider_slug,
+                "violation": VERB_VIOLATIONS[action.verb],
+                "object": action.description,
+            }
+            for action in self.sorted_actions()
+        ]
+
+    def apply(
+        self,
+        verbs=frozenset(VERB_SIGNS),
+        log=log,
+        max_workers=MAX_CONCURRENT_CALLS,
+        on_done=None,
+    ):
+        """Run the actions whose verb is in `verbs`, concurrently when possible.
+
+        `on_done` is called with each action once it is done, for example to record
+        it in a `journal.Journal`.
+        """
+        actions = []
+        for action in self.actions:
+            if action.verb in verbs:
+                actions.append(action)
+            else:
+                log.debug("skipped: {}".format(action))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            _run_actions(
+                executor,
+                [action for action in actions if action.verb != "delete"],
+                log,
+                on_done,
+            )
+            _run_actions(
+                executor,
+                [action for action in actions if action.verb == "delete"],
+                log,
+                on_done,
+            )
+
+
+def _run_actions(executor, actions, log, on_done=None):
+    """Run `actions` with `executor`, each one once the actions it depends on are done.
+
+    Dependencies that are not part of `actions` are considered as done. The first error
+    is raised once the running actions are finished; pending actions are not started.
+    `on_done` is called with each action that succeeded, including those finishing
+    after an error.
+    """
+    pending = list(actions)
+    running = {}
+    done = set()
+    error = None
+    try:
+        while running or (pending and error is None):
+            if error is None:
+                for action in list(pending):
+                    if all(dep in done or dep not in actions for dep in action.after):
+                        pending.remove(action)
+                        running[executor.submit(action.run)] = action
+            assert running, "Circular dependency between actions: {}".format(pending)
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                action = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                done.add(action)
+                log.debug("done: {}".format(action))
+                if on_done is not None:
+                    on_done(action)
+    finally:
+        wait(running)
+    if error is not None:
+        raise error
+
+
+def trigger_url(settings, project_id, token, variables, base_url=None):
+    """Return the URL of the trigger API to be called by a hook.
+
+    The request is sent to `base_url` (a dispatcher) instead of the API, if given.
+
+    >>> settings = Settings("https://example.com/api/v4", 42, "t", 40, "t", (1, 0))
+    >>> trigger_url(settings, 42, "itoken", {"PROVIDER_SLUG": "ecb"}).split("?")
+    ['https://example.com/api/v4/projects/42/ref/master/trigger/pipeline', \
+'token=itoken&variables[PROVIDER_SLUG]=ecb']
+    >>> trigger_url(settings, 42, "itoken", {}, base_url="http://dispatcher:8080")
+    'http://dispatcher:8080/projects/42/ref/master/trigger/pipeline?token=itoken'
+    """
+    base_url = (base_url or settings.api_base_url).rstrip("/")
+    return base_url + "/projects/{}/ref/master/trigger/pipeline?token={}{}".format(
+        project_id,
+        token,
+        "".join(
+            "&variables[{}]={}".format(key, value) for key, value in variables.items()
+        ),
+    )
+
+
+def deploy_key_title(provider_slug):
+    return provider_slug + " " + GENERATED_OBJECTS_TAG
+
+
+def build_plan(
+    provider_slug, fetcher_project, source_data_project, json_data_project, settings
+):
+    """Read the live state of the projects of a provider, and return a plan."""
+    plan = Plan(provider_slug)
+    # Values computed while applying the plan, used by the actions depending on them.
+    state = {}
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CALLS) as executor:
+        futures = {
+            name: executor.submit(plan.read, lambda manager=manager: list_all(manager))
+            for name, manager in [
+                ("triggers", fetcher_project.triggers),
+                ("variables", fetcher_project.variables),
+                ("schedules", fetcher_project.pipelineschedules),
+                ("source_data_hooks", source_data_project.hooks),
+                ("source_data_keys", source_data_project.keys),
+                ("json_data_hooks", json_data_project.hooks),
+                ("json_data_keys", json_data_project.keys),
+            ]
+        }
+        live = {name: future.result() for name, future in futures.items()}
+
+    trigger_action = _plan_fetcher_trigger(
+        plan, state, fetcher_project, live["triggers"], settings
+    )
+    _plan_hooks(
+        plan,
+        state,
+        fetcher_project,
+        source_data_project,
+        json_data_project,
+        live,
+        settings,
+        trigger_action,
+    )
+    _plan_deploy_key(
+        plan,
+        state,
+        provider_slug,
+        fetcher_project,
+        source_data_project,
+        json_data_project,
+        live,
+        settings,
+    )
+    _plan_pipeline_schedule(
+        plan, provider_slug, fetcher_project, live["schedules"], settings
+    )
+    return plan
+
+
+def _plan_fetcher_trigger(plan, state, fetcher_project, triggers, settings):
+    """Plan the fetcher trigger, returning the action creating it if needed."""
+    kept_trigger = None
+    for trigger in triggers:
+        if (
+            kept_trigger is None
+            and trigger.description == GENERATED_OBJECTS_TAG
+            and len(trigger.token) >= MIN_TRIGGER_TOKEN_LENGTH
+        ):
+            kept_trigger = trigger
+        elif settings.purge or trigger.description == GENERATED_OBJECTS_TAG:
+            plan.add(
+                "delete", "fetcher repo trigger {}".format(trigger.id), trigger.delete
+            )
+
+    if kept_trigger is not None:
+        state["fetcher_trigger_token"] = kept_trigger.token
+        return None
+
+    state["fetcher_trigger_token"] = NEW_TRIGGER_TOKEN
+
+    def create_trigger():
+        trigger = fetcher_project.triggers.create(
+            {"description": GENERATED_OBJECTS_TAG}
+        )
+        state["fetcher_trigger_token"] = trigger.token
+
+    return plan.add(
+        "create",
+        "fetcher repo trigger {!r}".format(GENERATED_OBJECTS_TAG),
+        create_trigger,
+    )
+
+
+def _plan_hooks(
+    plan,
+    state,
+    fetcher_project,
+    source_data_project,
+    json_data_project,
+    live,
+    settings,
+    trigger_action,
+):
+    provider_slug = plan.provider_slug
+    source_data_hooks = [
+        (
+            "convert job",
+            fetcher_project.id,
+            lambda: trigger_url(
+                settings,
+                fetcher_project.id,
+                state["fetcher_trigger_token"],
+                {"JOB": "convert"},
+            ),
+        ),
+    ]
+    json_data_hooks = [
+        (
+            "Solr indexation job",
+            settings.importer_project_id,
+            lambda: trigger_url(
+                settings,
+                settings.importer_project_id,
+                settings.importer_trigger_token,
+                {"PROVIDER_SLUG": provider_slug},
+                base_url=settings.dispatcher_url,
+            ),
+        ),
+        (
+            "validation job",
+            settings.data_model_project_id,
+            lambda: trigger_url(
+                settings,
+                settings.data_model_project_id,
+                settings.data_model_trigger_token,
+                {"PROVIDER_SLUG": provider_slug},
+                base_url=settings.dispatcher_url,
+            ),
+        ),
+    ]
+    # The convert hook uses the token of the fetcher trigger, which may be created.
+    _plan_project_hooks(
+        plan,
+        "source data",
+        source_data_project,
+        live["source_data_hooks"],
+        source_data_hooks,
+        settings,
+        after=[trigger_action],
+    )
+    _plan_project_hooks(
+        plan,
+        "JSON data",
+        json_data_project,
+        live["json_data_hooks"],
+        json_data_hooks,
+        settings,
+        token=settings.dispatcher_token if settings.dispatcher_url else None,
+    )
+
+
+def _plan_project_hooks(
+    plan, repo_name, project, live_hooks, desired_hooks, settings, after=(), token=None
+):
+    kept_hook_ids = set()
+    for job_name, target_project_id, get_url in desired_hooks:
+        description = "{} repo hook triggering {} (project {})".format(
+            repo_name, job_name, target_project_id
+        )
+        target = "/projects/{}/".format(target_project_id)
+        hook = next(
+            (
+                hook
+                for hook in live_hooks
+                if target in hook.url and hook.id not in kept_hook_ids
+            ),
+            None,
+        )
+
+        def hook_data(get_url=get_url):
+            data = {
+                "url": get_url(),
+                "push_events": True,
+                "push_events_branch_filter": "master",
+            }
+            if token is not None:
+                data["token"] = token
+            return data
+
+        if hook is None:
+            plan.add(
+                "create",
+                description,
+                lambda hook_data=hook_data: project.hooks.create(hook_data()),
+                after=after,
+            )
+            continue
+
+        kept_hook_ids.add(hook.id)
+        desired_url = get_url()
+        if (
+            hook.url != desired_url
+            or not hook.push_events
+            or getattr(hook, "push_events_branch_filter", None) != "master"
+        ):
+            changed = "URL" if hook.url != desired_url else "push events"
+
+            def update_hook(hook=hook, hook_data=hook_data):
+                project.hooks.update(hook.id, hook_data())
+
+            plan.add(
+                "update",
+                "{} ({} changed)".format(description, changed),
+                update_hook,
+                after=after,
+            )
+
+    targets = [
+        "/projects/{}/".format(target_project_id)
+        for _, target_project_id, _ in desired_hooks
+    ]
+    for hook in live_hooks:
+        if hook.id in kept_hook_ids:
+            continue
+        if settings.purge or any(target in hook.url for target in targets):
+            plan.add(
+                "delete", "{} repo hook {}".format(repo_name, hook.id), hook.delete
+            )
+
+
+def _plan_deploy_key(
+    plan,
+    state,
+    provider_slug,
+    fetcher_project,
+    source_data_project,
+    json_data_project,
+    live,
+    settings,
+):
+    title = deploy_key_title(provider_slug)
+    variable = next(
+        (
+            variable
+            for variable in live["variables"]
+            if variable.key == "SSH_PRIVATE_KEY"
+        ),
+        None,
+    )
+    source_data_keys = live["source_data_keys"]
+    json_data_keys = live["json_data_keys"]
+
+    public_key = None if variable is None else get_public_key(variable.value)
+    source_data_key = None
+    existing_key_id = None
+    if public_key is not None:
+        source_data_key = next(
+            (
+                key
+                for key in source_data_keys
+                if key.title == title and same_public_key(key.key, public_key)
+            ),
+            None,
+        )
+        if source_data_key is None:
+            existing_key_id = _find_existing_deploy_key(
+                public_key, title, json_data_keys, settings
+            )
+
+    def create_key_pair():
+        public_key, private_key = settings.generate_ssh_key(
+            "{}-fetcher@db.nomics.world".format(provider_slug)
+        )
+        if variable is None:
+            fetcher_project.variables.create(
+                {"key": "SSH_PRIVATE_KEY", "value": private_key}
+            )
+        else:
+            fetcher_project.variables.update("SSH_PRIVATE_KEY", {"value": private_key})
+        key = source_data_project.keys.create(
+            {"title": title, "key": public_key, "can_push": True}
+        )
+        state["deploy_key_id"] = key.id
+
+    def enable_existing_key():
+        try:
+            _enable_deploy_key(source_data_project, existing_key_id, title)
+        except GitlabError as exc:
+            if exc.response_code != 404:
+                raise
+            log.debug(
+                "Deploy key {} was deleted, creating a new pair".format(existing_key_id)
+            )
+            create_key_pair()
+
+    key_pair_action = None
+    if source_data_key is not None:
+        kept_key_id = state["deploy_key_id"] = source_data_key.id
+        if not source_data_key.can_push:
+            plan.add(
+                "update",
+                "source data repo deploy key {!r} (can push)".format(title),
+                lambda: source_data_project.keys.update(
+                    kept_key_id, {"can_push": True}
+                ),
+            )
+    elif existing_key_id is not None:
+        # The deploy key of the private key exists, but is not enabled on the source
+        # data repo (only on the JSON data or dev data repos): enable it.
+        kept_key_id = state["deploy_key_id"] = existing_key_id
+        key_pair_action = plan.add(
+            "create",
+            "source data repo deploy key {!r} (existing key {})".format(
+                title, existing_key_id
+            ),
+            enable_existing_key,
+            api_calls=2,
+        )
+    else:
+        # The private key of the fetcher repo matches no deploy key: use a new pair.
+        kept_key_id = None
+        key_pair_action = plan.add(
+            "create",
+            "SSH_PRIVATE_KEY variable and source data repo deploy key {!r}".format(
+                title
+            ),
+            create_key_pair,
+            api_calls=2,
+        )
+
+    json_data_key = next(
+        (
+            key
+            for key in json_data_keys
+            if kept_key_id is not None and key.id == kept_key_id
+        ),
+        None,
+    )
+    if json_data_key is None:
+        plan.add(
+            "create",
+            "JSON data repo deploy key {!r}".format(title),
+            lambda: _enable_deploy_key(json_data_project, state["deploy_key_id"]),
+            api_calls=2,
+            after=[key_pair_action],
+        )
+    elif not json_data_key.can_push:
+        plan.add(
+            "update",
+            "JSON data repo deploy key {!r} (can push)".format(title),
+            lambda: json_data_project.keys.update(kept_key_id, {"can_push": True}),
+        )
+
+    for repo_name, keys in [
+        ("source data", source_data_keys),
+        ("JSON data", json_data_keys),
+    ]:
+        for key in keys:
+            if key.id != kept_key_id and (settings.purge or key.title == title):
+                plan.add(
+                    "delete",
+                    "{} repo deploy key {} {!r}".format(repo_name, key.id, key.title),
+                    key.delete,
+                )
+
+
+def _find_existing_deploy_key(public_key, title, json_data_keys, settings):
+    """Return the ID of an existing deploy key of `public_key`, or None.
+
+    The key is looked for in the keys of the JSON data repo, then with
+    `settings.find_deploy_key`.
+    """
+    fingerprint = get_fingerprint(public_key)
+    for key in json_data_keys:
+        if get_fingerprint(key.key) == fingerprint:
+            return key.id
+    if settings.find_deploy_key is None:
+        return None
+    return settings.find_deploy_key(fingerprint, title)
+
+
+def _enable_deploy_key(project, key_id, title=None):
+    project.keys.enable(key_id)
+    changes = {"can_push": True}
+    if title is not None:
+        changes["title"] = title
+    project.keys.update(key_id, changes)
+
+
+def _plan_pipeline_schedule(plan, provider_slug, fetcher_project, schedules, settings):
+    description = "{} {}".format(provider_slug, GENERATED_OBJECTS_TAG)
+    schedule_time = settings.schedule_times.get(provider_slug, settings.schedule_time)
+    hour, minute = schedule_time or DEFAULT_SCHEDULE_TIME
+    desired = {
+        "active": True,
+        "ref": "master",
+        "cron": "{} {} * * *".format(minute, hour),
+    }
+    schedules = [
+        schedule
+        for schedule in schedules
+        if settings.purge or schedule.description == description
+    ]
+
+    # "dummy" provider should not be scheduled.
+    kept_schedule = None
+    if provider_slug != "dummy":
+        kept_schedule = next(
+            (schedule for schedule in schedules if schedule.description == description),
+            None,
+        )
+        if kept_schedule is None:
+
+            def create_schedule():
+                schedule = fetcher_project.pipelineschedules.create(
+                    dict(desired, description=description)
+                )
+                schedule.variables.create({"key": "JOB", "value": "download"})
+
+            plan.add(
+                "create",
+                "pipeline schedule {!r} ({})".format(description, desired["cron"]),
+                create_schedule,
+                api_calls=2,
+            )
+        else:
+            if schedule_time is None:
+                desired.pop("cron")
+            _plan_pipeline_schedule_update(
+                plan, description, desired, fetcher_project, kept_schedule
+            )
+
+    for schedule in schedules:
+        if schedule is not kept_schedule:
+            plan.add(
+                "delete",
+                "pipeline schedule {} {!r}".format(schedule.id, schedule.description),
+                schedule.delete,
+            )
+
+
+def _plan_pipeline_schedule_update(
+    plan, description, desired, fetcher_project, schedule
+):
+    changes = {
+        key: value
+        for key, value in desired.items()
+        if getattr(schedule, key, None) != value
+    }
+    if changes:
+        plan.add(
+            "update",
+            "pipeline schedule {!r} ({})".format(
+                description,
+                ", ".join(
+                    "{}={!r}".format(key, value)
+                    for key, value in sorted(changes.items())
+                ),
+            ),
+            lambda: fetcher_project.pipelineschedules.update(schedule.id, changes),
+        )
+
+    # Variables of pipeline schedules are only returned when getting a single schedule.
+    variables = plan.read(
+        lambda: fetcher_project.pipelineschedules.get(schedule.id)
+    ).attributes.get("variables", [])
+    job_variable = next(
+        (variable for variable in variables if variable["key"] == "JOB"), None
+    )
+    if job_variable is None:
+        plan.add(
+            "create",
+            "pipeline schedule {!r} variable JOB=download".format(description),
+            lambda: schedule.variables.create({"key": "JOB", "value": "download"}),
+        )
+    elif job_variable["value"] != "download":
+        plan.add(
+            "update",
+            "pipeline schedule {!r} variable JOB=download".format(description),
+            lambda: schedule.variables.update("JOB", {"value": "download"}),
+        )
+
+
+def build_dev_data_plan(
+    provider_slug,
+    prod_source_data_project,
+    dev_source_data_project,
+    dev_json_data_project,
+    purge=False,
+):
+    """Return a plan mirroring the deploy key of a provider to its dev data repos.
+
+    The deploy key named "{provider_slug} CI jobs" of the source data repo is enabled
+    on the source data and JSON data repos of the dev namespace, with push access.
+    Keys are compared by fingerprint, so a dev repo already having the key is left
+    as is. The other keys of the dev repos having the same name are deleted, and
+    all the other keys if `purge` is True.
+    """
+    plan = Plan(provider_slug)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        prod_keys, dev_source_data_keys, dev_json_data_keys = executor.map(
+            lambda project: plan.read(lambda: list_all(project.keys)),
+            [prod_source_data_project, dev_source_data_project, dev_json_data_project],
+        )
+
+    title = deploy_key_title(provider_slug)
+    prod_keys = [key for key in prod_keys if key.title == title]
+    if len(prod_keys) != 1:
+        raise ValueError(
+            "{} deploy keys named {!r} found in {}, 1 expected".format(
+                len(prod_keys), title, prod_source_data_project.path_with_namespace
+            )
+        )
+    prod_key = prod_keys[0]
+    fingerprint = get_fingerprint(prod_key.key)
+
+    for repo_name, project, keys in [
+        ("dev source data", dev_source_data_project, dev_source_data_keys),
+        ("dev JSON data", dev_json_data_project, dev_json_data_keys),
+    ]:
+        kept_key = next(
+            (key for key in keys if get_fingerprint(key.key) == fingerprint), None
+        )
+        if kept_key is None:
+            plan.add(
+                "create",
+                "{} repo deploy key {!r}".format(repo_name, title),
+                lambda project=project: _enable_deploy_key(project, prod_key.id),
+                api_calls=2,
+            )
+        elif not kept_key.can_push:
+            plan.add(
+                "update",
+                "{} repo deploy key {!r} (can push)".format(repo_name, title),
+                lambda project=project, key_id=kept_key.id: project.keys.update(
+                    key_id, {"can_push": True}
+                ),
+            )
+        for key in keys:
+            if key is not kept_key and (purge or key.title == title):
+                plan.add(
+                    "delete",
+                    "{} repo deploy key {} {!r}".format(repo_name, key.id, key.title),
+                    key.delete,
+                )
+    return plan
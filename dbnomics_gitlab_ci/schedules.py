@@ -0,0 +1,169 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Spread the download schedules of the fetchers over a time window.
+
+When all the fetchers start downloading at the same minute, the runners and the
+source websites are saturated. Instead, providers are placed one by one in a time
+window, longest download first, at the start time where the number of downloads
+already running during the whole download is the lowest.
+
+Download durations are estimated from the last successful scheduled pipelines.
+"""
+
+import itertools
+import logging
+import statistics
+from collections import defaultdict
+
+from . import graphql
+from .pagination import iter_all
+
+log = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+
+DEFAULT_SLOT_MINUTES = 10
+
+# Number of recent scheduled pipelines used to estimate a download duration.
+HISTORY_SIZE = 10
+
+
+def get_download_duration(fetcher_project, history_size=HISTORY_SIZE):
+    """Return the median duration of the last scheduled pipelines, in seconds.
+
+    Pipelines are listed without their duration, so jobs are listed too and the
+    durations of the jobs of each pipeline are summed: this usually takes 2 API calls.
+    Jobs are listed most recent first, until one created before the oldest pipeline.
+
+    Return None if the project has no successful scheduled pipeline.
+    """
+    pipelines = list(
+        itertools.islice(
+            iter_all(
+                fetcher_project.pipelines,
+                per_page=history_size,
+                source="schedule",
+                status="success",
+            ),
+            history_size,
+        )
+    )
+    if not pipelines:
+        return None
+    pipeline_ids = {pipeline.id for pipeline in pipelines}
+    oldest_created_at = min(
+        pipeline.attributes.get("created_at") or "" for pipeline in pipelines
+    )
+    durations = defaultdict(float)
+    for job in iter_all(fetcher_project.jobs, scope="success"):
+        created_at = job.attributes.get("created_at")
+        if created_at is not None and created_at < oldest_created_at:
+            break
+        pipeline_id = job.attributes.get("pipeline", {}).get("id")
+        if pipeline_id in pipeline_ids and job.attributes.get("duration"):
+            durations[pipeline_id] += job.duration
+    if not durations:
+        return None
+    return statistics.median(durations.values())
+
+
+def get_download_durations(gl, fetcher_paths, history_size=HISTORY_SIZE):
+    """Return the download durations of many fetcher projects, by project path.
+
+    The last scheduled pipelines of the projects are read by batches with GraphQL
+    (see `dbnomics_gitlab_ci.graphql`), which returns their duration directly. The
+    duration of a project is the median of those of its pipelines, or None.
+
+    Raise `graphql.GraphQLError` if GraphQL is not available.
+    """
+    projects = graphql.list_pipelines(
+        gl,
+        fetcher_paths,
+        statuses=["success"],
+        source="schedule",
+        per_project=history_size,
+    )
+    durations = {}
+    for path, project in projects.items():
+        pipeline_durations = [
+            pipeline["duration"]
+            for pipeline in project.pipelines
+            if pipeline["duration"]
+        ]
+        durations[path] = (
+            statistics.median(pipeline_durations) if pipeline_durations else None
+        )
+    return durations
+
+
+def stagger(durations, window, slot_minutes=DEFAULT_SLOT_MINUTES):
+    """Return the start time of each provider, as a dict of `(hour, minute)` tuples.
+
+    `durations` maps provider slugs to download durations in seconds, or None when
+    unknown (then the median of the known durations is used). `window` is a
+    `((hour, minute), (hour, minute))` tuple; it can go past midnight.
+
+    Providers are placed longest first, at the start slot minimizing the number of
+    downloads running at the same time, then the total of that number over the
+    download, then the start time.
+
+    >>> stagger({"a": 3600, "b": 1800, "c": 1800, "d": None}, ((1, 0), (3, 0)), 30)
+    {'a': (1, 0), 'b': (2, 0), 'c': (2, 30), 'd': (1, 0)}
+    >>> stagger({"a": 60, "b": 60}, ((23, 50), (0, 10)), 10)
+    {'a': (23, 50), 'b': (0, 0)}
+    >>> stagger({"a": 1800, "b": 1800, "c": 1200}, ((1, 15), (2, 15)), 30)
+    {'a': (1, 15), 'b': (1, 45), 'c': (1, 15)}
+    """
+    (start_hour, start_minute), (end_hour, end_minute) = window
+    start = start_hour * 60 + start_minute
+    window_minutes = (end_hour * 60 + end_minute - start) % MINUTES_PER_DAY
+    if window_minutes == 0:
+        window_minutes = MINUTES_PER_DAY
+    slot_count = max(1, window_minutes // slot_minutes)
+    day_slot_count = MINUTES_PER_DAY // slot_minutes
+
+    known_durations = [duration for duration in durations.values() if duration]
+    default_duration = (
+        statistics.median(known_durations) if known_durations else slot_minutes * 60
+    )
+
+    # Number of downloads running during each slot of the day, the first slot starting
+    # at the start of the window, so that downloads start at the start of a slot.
+    loads = [0] * day_slot_count
+    start_times = {}
+    for provider_slug, duration in sorted(
+        durations.items(), key=lambda item: (-(item[1] or default_duration), item[0])
+    ):
+        span = max(1, -(-int(duration or default_duration) // (slot_minutes * 60)))
+        span = min(span, day_slot_count)
+
+        def cost(slot):
+            occupied = [
+                loads[(slot + offset) % day_slot_count] for offset in range(span)
+            ]
+            return (max(occupied), sum(occupied), slot)
+
+        slot = min(range(slot_count), key=cost)
+        for offset in range(span):
+            loads[(slot + offset) % day_slot_count] += 1
+        minutes = (start + slot * slot_minutes) % MINUTES_PER_DAY
+        start_times[provider_slug] = divmod(minutes, 60)
+    return {provider_slug: start_times[provider_slug] for provider_slug in durations}
@@ -0,0 +1,239 @@
+# dbnomics-gitlab-ci -- Scripts around DBnomics GitLab-CI
+# By: Christophe Benz <christophe.benz@cepremap.org>
+#
+# Copyright (C) 2017-2020 Cepremap
+# https://git.nomics.world/dbnomics/dbnomics-gitlab-ci
+#
+# dbnomics-gitlab-ci is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbnomics-gitlab-ci is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Generate SSH key pairs used as deploy keys by the CI jobs.
+
+Keys are generated in-process with the `cryptography` package, without writing
+temporary files. If it is not installed, `ssh-keygen` is used instead.
+
+RSA keys (4096 bits) are generated by default, for compatibility; Ed25519 keys are
+much faster to generate. To avoid waiting for RSA key generation in batch runs,
+`KeyPool` generates keys ahead of need, in parallel.
+
+`cryptography` is imported on first use only, so that commands which merely compare
+fingerprints do not pay for loading it.
+"""
+
+import base64
+import hashlib
+import os
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from types import SimpleNamespace
+
+from . import metrics
+
+KEY_TYPES = ("rsa", "ed25519")
+DEFAULT_KEY_TYPE = "rsa"
+RSA_KEY_SIZE = 4096
+
+
+@lru_cache(maxsize=None)
+def _load_cryptography():
+    """Import the parts of `cryptography` used here, or return None if missing."""
+    try:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+    except ImportError:
+        return None
+    return SimpleNamespace(
+        default_backend=default_backend,
+        serialization=serialization,
+        ed25519=ed25519,
+        rsa=rsa,
+    )
+
+
+def generate_ssh_key(comment, key_type=DEFAULT_KEY_TYPE):
+    """Generate a key pair, returned as a `(public_key, private_key)` tuple.
+
+    Keys are returned in OpenSSH format, the public one ending with `comment`.
+    """
+    public_key, private_key = _generate_key_pair(key_type)
+    return (_add_comment(public_key, comment), private_key)
+
+
+def _add_comment(public_key, comment):
+    return "{} {}\n".format(" ".join(public_key.split()[:2]), comment)
+
+
+def _generate_key_pair(key_type):
+    if key_type not in KEY_TYPES:
+        raise ValueError("Invalid key type {!r}".format(key_type))
+    with metrics.timer("generate_ssh_key"):
+        return _generate_key_pair_with_backend(key_type)
+
+
+def _generate_key_pair_with_backend(key_type):
+    crypto = _load_cryptography()
+    if crypto is None:
+        return _generate_key_pair_with_ssh_keygen(key_type)
+    if key_type == "ed25519":
+        private_key = crypto.ed25519.Ed25519PrivateKey.generate()
+    else:
+        private_key = crypto.rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=RSA_KEY_SIZE,
+            backend=crypto.default_backend(),
+        )
+    serialization = crypto.serialization
+    private_bytes = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption(),
+    )
+    return (
+        _public_key_to_openssh(private_key.public_key()),
+        private_bytes.decode("ascii"),
+    )
+
+
+def _generate_key_pair_with_ssh_keygen(key_type):
+    with tempfile.TemporaryDirectory(prefix="_ssh_key") as tmpdir:
+        private_key_path = Path(tmpdir) / "id"
+        command = ["ssh-keygen", "-q", "-f", str(private_key_path), "-t", key_type]
+        if key_type == "rsa":
+            command += ["-b", str(RSA_KEY_SIZE)]
+        subprocess.run(command + ["-N", "", "-C", ""], check=True)
+        public_key = private_key_path.with_suffix(".pub").read_text()
+        private_key = private_key_path.read_text()
+    return (public_key, private_key)
+
+
+def _public_key_to_openssh(public_key):
+    serialization = _load_cryptography().serialization
+    return public_key.public_bytes(
+        serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH
+    ).decode("ascii")
+
+
+def get_public_key(private_key):
+    """Return the public key matching `private_key`, or None if it can't be read."""
+    crypto = _load_cryptography()
+    if crypto is None:
+        return _get_public_key_with_ssh_keygen(private_key)
+    data = private_key.encode("utf-8")
+    try:
+        if b"BEGIN OPENSSH PRIVATE KEY" in data:
+            key = crypto.serialization.load_ssh_private_key(
+                data, password=None, backend=crypto.default_backend()
+            )
+        else:
+            key = crypto.serialization.load_pem_private_key(
+                data, password=None, backend=crypto.default_backend()
+            )
+    except (ValueError, TypeError):
+        return None
+    return _public_key_to_openssh(key.public_key())
+
+
+def _get_public_key_with_ssh_keygen(private_key):
+    with tempfile.NamedTemporaryFile(mode="w", prefix="_ssh_key") as tmpfile:
+        tmpfile.write(private_key)
+        tmpfile.flush()
+        completed = subprocess.run(
+            ["ssh-keygen", "-y", "-f", tmpfile.name],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        )
+    if completed.returncode != 0:
+        return None
+    return completed.stdout
+
+
+def same_public_key(public_key1, public_key2):
+    """Tell if two OpenSSH public keys are the same, ignoring their comment.
+
+    >>> same_public_key("ssh-rsa AAAA foo@example.com", "ssh-rsa AAAA")
+    True
+    >>> same_public_key("ssh-rsa AAAA", "ssh-rsa BBBB")
+    False
+    """
+    return public_key1.split()[:2] == public_key2.split()[:2]
+
+
+def get_fingerprint(public_key):
+    """Return the SHA256 fingerprint of an OpenSSH public key, like `ssh-keygen -l`.
+
+    >>> get_fingerprint(
+    ...     "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAILpzucvJqtQ+dP23AcXNj5YuooD5OUhJLLSsE9XULDOi"
+    ...     " ecb-fetcher@db.nomics.world"
+    ... )
+    'SHA256:Tll+/7ss7FAHFqU8mlRUn/uncS4e0AnQcPyRJQrUDV4'
+    """
+    blob = base64.b64decode(public_key.split()[1])
+    digest = base64.b64encode(hashlib.sha256(blob).digest()).decode("ascii")
+    return "SHA256:" + digest.rstrip("=")
+
+
+class KeyPool:
+    """Pool of key pairs generated ahead of need, in parallel on all the CPU cores.
+
+    The pool keeps `size` key pairs being generated or ready: each one taken with
+    `generate_ssh_key` is replaced by a new one. OpenSSL (and ssh-keygen) do not hold
+    the GIL while generating keys, so threads are enough to use all the cores.
+
+    Use it as a context manager, to stop generating keys when done.
+    """
+
+    def __init__(self, size, key_type=DEFAULT_KEY_TYPE, max_workers=None):
+        if key_type not in KEY_TYPES:
+            raise ValueError("Invalid key type {!r}".format(key_type))
+        self.key_type = key_type
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or os.cpu_count() or 1
+        )
+        self._lock = threading.Lock()
+        self._futures = deque(self._submit() for _ in range(size))
+
+    def _submit(self):
+        return self._executor.submit(_generate_key_pair, self.key_type)
+
+    def generate_ssh_key(self, comment):
+        """Take a key pair from the pool, like `generate_ssh_key`."""
+        with self._lock:
+            if self._futures:
+                future = self._futures.popleft()
+                self._futures.append(self._submit())
+            else:
+                future = self._submit()
+        with metrics.timer("key_pool_wait"):
+            public_key, private_key = future.result()
+        return (_add_comment(public_key, comment), private_key)
+
+    def close(self):
+        with self._lock:
+            for future in self._futures:
+                future.cancel()
+            self._futures.clear()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,4 @@
+from setuptools import setup
+
+# Metadata and options are declared in setup.cfg.
+setup()